@@ -0,0 +1,556 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, Optional, Tuple
+import json
+import multiprocessing
+import queue
+import subprocess
+import threading
+import wave
+import numpy as np
+from loguru import logger
+from sqlalchemy import func, or_
+from config import setting
+from database import SessionLocal
+from models import AudioFile
+from cache import AUDIOS, response_cache
+import renditions
+import storage
+
+# Values of AudioFile.analysis_status (NULL: uploaded before analysis existed)
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+# Tempo and key are estimated on a mono signal decimated to about this rate
+ANALYSIS_RATE = 11025
+# STFT frame and hop, in samples at the analysis rate
+FRAME_SIZE = 1024
+HOP_SIZE = 256
+# Tempo range searched, in beats per minute
+MIN_BPM = 60
+MAX_BPM = 200
+# Centre of the tempo prior that breaks ties between a tempo and its half or double
+PRIOR_BPM = 120
+# Ids read per query while queueing the library for a bulk run
+BACKFILL_BATCH_SIZE = 1000
+# Frames decoded at a time when a whole file is scanned (duration, loudness, waveform peaks)
+STREAM_BLOCK_FRAMES = 65536
+# Seconds the dispatcher waits for new files or finished analyses before checking for shutdown
+DISPATCH_POLL_SECONDS = 0.1
+
+# Key profiles (Krumhansl-Kessler), from C upwards
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+PITCH_CLASSES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+
+class AnalysisError(Exception):
+    pass
+
+
+def _pcm_to_float(raw: bytes, sample_width: int, channels: int) -> np.ndarray:
+    """Convert interleaved little-endian PCM to float32 samples in [-1, 1], shaped (frames, channels)."""
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768
+    elif sample_width == 3:
+        octets = np.frombuffer(raw[:len(raw) // 3 * 3], dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = octets[:, 0] | (octets[:, 1] << 8) | (octets[:, 2] << 16)
+        # Sign-extend the 24 bit values
+        samples = ((values ^ 0x800000) - 0x800000).astype(np.float32) / 8388608
+    elif sample_width == 4:
+        samples = np.frombuffer(raw, dtype="<i4").astype(np.float32) / 2147483648
+    else:
+        raise AnalysisError(f"Unsupported sample width: {sample_width} bytes")
+    return samples[:len(samples) // channels * channels].reshape(-1, channels)
+
+
+def _probe(path: str) -> Tuple[int, int, Optional[int]]:
+    try:
+        probe = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries",
+             "stream=sample_rate,channels,duration:format=duration", "-of", "json", path],
+            capture_output=True, check=True, timeout=60,
+        )
+        info = json.loads(probe.stdout)
+        stream = info["streams"][0]
+        rate, channels = int(stream["sample_rate"]), int(stream["channels"])
+    except FileNotFoundError:
+        raise AnalysisError("ffmpeg is not installed")
+    except (subprocess.SubprocessError, KeyError, IndexError, ValueError) as e:
+        raise AnalysisError(f"ffprobe could not read the file: {e}")
+    # Containers without an index (e.g. MP3 without a Xing header) only give an estimate, if any
+    duration = stream.get("duration") or info.get("format", {}).get("duration")
+    try:
+        frames = round(float(duration) * rate) if duration is not None else None
+    except ValueError:
+        frames = None
+    return rate, channels, frames
+
+
+def audio_info(path: str) -> Tuple[int, int, Optional[int]]:
+    """Sample rate, channels and length in frames (``None`` if unknown) of a file, from its header."""
+    if storage.is_wav(path):
+        try:
+            with wave.open(path, "rb") as wav:
+                return wav.getframerate(), wav.getnchannels(), wav.getnframes()
+        except (wave.Error, EOFError):
+            pass
+    return _probe(path)
+
+
+def _decode_wav(path: str, max_seconds: Optional[float]) -> Tuple[np.ndarray, int]:
+    with wave.open(path, "rb") as wav:
+        channels, sample_width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        frames = wav.getnframes()
+        if max_seconds is not None:
+            frames = min(frames, int(rate * max_seconds))
+        raw = wav.readframes(frames)
+    return _pcm_to_float(raw, sample_width, channels), rate
+
+
+def _ffmpeg_command(path: str, max_seconds: Optional[float] = None) -> list:
+    # Formats the wave module cannot read (MP3, float WAV, ...) are decoded by ffmpeg to 16 bit PCM
+    command = ["ffmpeg", "-v", "error", "-i", path, "-map", "0:a:0"]
+    if max_seconds is not None:
+        command += ["-t", str(max_seconds)]
+    return command + ["-f", "s16le", "-acodec", "pcm_s16le", "-"]
+
+
+def _decode_ffmpeg(path: str, max_seconds: Optional[float]) -> Tuple[np.ndarray, int]:
+    rate, channels, _ = _probe(path)
+    try:
+        decoded = subprocess.run(_ffmpeg_command(path, max_seconds), capture_output=True, check=True, timeout=600)
+    except FileNotFoundError:
+        raise AnalysisError("ffmpeg is not installed")
+    except subprocess.SubprocessError as e:
+        raise AnalysisError(f"ffmpeg could not decode the file: {e}")
+    return _pcm_to_float(decoded.stdout, 2, channels), rate
+
+
+def decode_audio(path: str, max_seconds: Optional[float] = None) -> Tuple[np.ndarray, int]:
+    """
+    Decode an audio file into float32 samples shaped (frames, channels) and its sample rate.
+
+    With ``max_seconds`` only the beginning of the file is decoded, memory then does not depend
+    on the length of the file.
+    """
+    if storage.is_wav(path):
+        try:
+            return _decode_wav(path, max_seconds)
+        except (wave.Error, EOFError, AnalysisError):
+            pass
+    return _decode_ffmpeg(path, max_seconds)
+
+
+def _stream_ffmpeg(path: str, channels: int, block_frames: int) -> Iterator[np.ndarray]:
+    try:
+        process = subprocess.Popen(_ffmpeg_command(path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise AnalysisError("ffmpeg is not installed")
+    block_size = block_frames * channels * 2
+    try:
+        while True:
+            raw = process.stdout.read(block_size)
+            if not raw:
+                break
+            yield _pcm_to_float(raw, 2, channels)
+        if process.wait(timeout=60):
+            error = process.stderr.read().decode(errors="replace").strip()
+            raise AnalysisError(f"ffmpeg could not decode the file: {error}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.stderr.close()
+        process.wait()
+
+
+def stream_audio(path: str, block_frames: int = STREAM_BLOCK_FRAMES) -> Iterator[np.ndarray]:
+    """
+    Decode a whole audio file block by block, as float32 arrays shaped (frames, channels) of at
+    most ``block_frames`` frames, so memory does not grow with the file.
+    """
+    if storage.is_wav(path):
+        try:
+            with wave.open(path, "rb") as wav:
+                channels, sample_width = wav.getnchannels(), wav.getsampwidth()
+                if sample_width in (1, 2, 3, 4):
+                    while True:
+                        raw = wav.readframes(block_frames)
+                        if not raw:
+                            return
+                        yield _pcm_to_float(raw, sample_width, channels)
+        except (wave.Error, EOFError):
+            pass
+    _, channels, _ = _probe(path)
+    yield from _stream_ffmpeg(path, channels, block_frames)
+
+
+def _spectrogram(signal: np.ndarray) -> np.ndarray:
+    # Magnitude STFT, shaped (frames, bins), from strided views of the signal (no copies until the FFT)
+    windows = np.lib.stride_tricks.sliding_window_view(signal, FRAME_SIZE)[::HOP_SIZE]
+    return np.abs(np.fft.rfft(windows * np.hanning(FRAME_SIZE).astype(np.float32), axis=1))
+
+
+def estimate_bpm(spectrogram: np.ndarray, rate: float) -> Optional[float]:
+    """
+    Estimate the tempo from the autocorrelation of the spectral flux onset envelope.
+
+    Lags between ``MIN_BPM`` and ``MAX_BPM`` are weighted by a log-normal prior around
+    ``PRIOR_BPM``, so the metrical level closest to a typical tempo wins over its half and double.
+    """
+    flux = np.diff(np.log1p(1000 * spectrogram), axis=0)
+    onsets = np.maximum(flux, 0).sum(axis=1)
+    onsets -= onsets.mean()
+    frame_rate = rate / HOP_SIZE
+    min_lag, max_lag = int(60 * frame_rate / MAX_BPM), int(np.ceil(60 * frame_rate / MIN_BPM))
+    if len(onsets) < 2 * max_lag or not onsets.any():
+        return None
+    # Autocorrelation through the FFT, zero padded to avoid wrap-around
+    size = 1 << int(np.ceil(np.log2(2 * len(onsets))))
+    spectrum = np.fft.rfft(onsets, size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:max_lag + 2]
+    lags = np.arange(min_lag, max_lag + 1)
+    bpms = 60 * frame_rate / lags
+    weights = np.exp(-0.5 * (np.log2(bpms / PRIOR_BPM)) ** 2)
+    scores = autocorrelation[lags] * weights
+    best = int(np.argmax(scores))
+    if scores[best] <= 0:
+        return None
+    lag = float(lags[best])
+    if 0 < best < len(scores) - 1:
+        # Parabolic interpolation between the neighbouring lags
+        left, centre, right = scores[best - 1], scores[best], scores[best + 1]
+        denominator = left - 2 * centre + right
+        if denominator < 0:
+            lag += 0.5 * (left - right) / denominator
+    return round(60 * frame_rate / lag, 1)
+
+
+def estimate_key(spectrogram: np.ndarray, rate: float) -> Optional[str]:
+    """Estimate the musical key (e.g. ``"A"`` or ``"F#m"``) by matching the chroma profile to key profiles."""
+    frequencies = np.fft.rfftfreq(FRAME_SIZE, 1 / rate)
+    audible = (frequencies >= 55) & (frequencies <= 2000)
+    pitch_classes = np.round(12 * np.log2(frequencies[audible] / 440) + 69).astype(int) % 12
+    energy = (spectrogram[:, audible] ** 2).sum(axis=0)
+    chroma = np.bincount(pitch_classes, weights=energy, minlength=12)
+    if not chroma.any():
+        return None
+    # Correlation with all 24 rotated profiles at once
+    profiles = np.array(
+        [np.roll(MAJOR_PROFILE, tonic) for tonic in range(12)] + [np.roll(MINOR_PROFILE, tonic) for tonic in range(12)]
+    )
+    profiles = (profiles - profiles.mean(axis=1, keepdims=True)) / profiles.std(axis=1, keepdims=True)
+    normalized = (chroma - chroma.mean()) / (chroma.std() or 1)
+    best = int(np.argmax(profiles @ normalized))
+    return PITCH_CLASSES[best % 12] + ("m" if best >= 12 else "")
+
+
+def _loudness(sum_of_squares: float, frames: int) -> Optional[float]:
+    # RMS level in dBFS
+    rms = np.sqrt(sum_of_squares / frames) if frames else 0.0
+    return round(float(20 * np.log10(rms)), 2) if rms > 0 else None
+
+
+def analyze_samples(samples: np.ndarray, rate: int, max_seconds: float) -> dict:
+    """Metadata of a file decoded as a whole; duration and loudness are those of ``samples``."""
+    frames, channels = samples.shape
+    mono = samples.mean(axis=1)
+    result = {
+        "duration": frames / rate,
+        "sample_rate": rate,
+        "channels": channels,
+        "loudness": _loudness(float(np.sum(np.square(mono, dtype=np.float64))), frames),
+        "bpm_estimate": None,
+        "key_estimate": None,
+    }
+    # Tempo and key are estimated on the beginning of the file, decimated by block averaging
+    factor = max(1, rate // ANALYSIS_RATE)
+    clip = mono[:int(max_seconds * rate) // factor * factor]
+    signal = clip.reshape(-1, factor).mean(axis=1) if factor > 1 else clip
+    if len(signal) >= FRAME_SIZE:
+        spectrogram = _spectrogram(signal)
+        result["bpm_estimate"] = estimate_bpm(spectrogram, rate / factor)
+        result["key_estimate"] = estimate_key(spectrogram, rate / factor)
+    return result
+
+
+def _scan_file(path: str, rate: int) -> Tuple[float, Optional[float], bytes]:
+    # Duration, loudness and waveform peaks of the whole file, decoded block by block
+    _, _, expected_frames = audio_info(path)
+    envelope = renditions.PeakEnvelope(expected_frames)
+    frames, sum_of_squares = 0, 0.0
+    for block in stream_audio(path):
+        envelope.add(block)
+        frames += len(block)
+        sum_of_squares += float(np.sum(np.square(block.mean(axis=1), dtype=np.float64)))
+    return frames / rate, _loudness(sum_of_squares, frames), envelope.peaks()
+
+
+def analyze_file(path: str, max_seconds: float, content_hash: Optional[str] = None) -> dict:
+    """
+    Decode and analyze one file. Runs in the worker processes.
+
+    Only the beginning of the file is decoded at once: ``max_seconds`` for the tempo and key, or
+    the length of the preview if that is longer. When the file is longer than that, its duration,
+    loudness and waveform peaks come from a second pass over the whole file, block by block. With
+    a ``content_hash`` the peaks and preview of the blob are written, followed by its
+    pre-compressed variants.
+    """
+    head_seconds = max(max_seconds, renditions.PREVIEW_SECONDS)
+    samples, rate = decode_audio(path, head_seconds)
+    result = analyze_samples(samples, rate, max_seconds)
+    if len(samples) < int(head_seconds * rate):
+        # The beginning is the whole file
+        peaks = renditions.compute_peaks(samples) if content_hash is not None else None
+    else:
+        result["duration"], result["loudness"], peaks = _scan_file(path, rate)
+    if content_hash is not None:
+        try:
+            renditions.write_renditions(content_hash, peaks, samples, rate)
+        except OSError as e:
+            # The metadata is still worth saving
+            logger.error(f"Failed to write the renditions of blob {content_hash}: {e}")
+        storage.precompress_blob(content_hash)
+    return result
+
+
+def save_result(audio_id: int, result: dict) -> None:
+    # Uploader supplied values win, estimates only fill in missing ones
+    with SessionLocal() as db:
+        db.query(AudioFile).filter(AudioFile.id == audio_id).update(
+            {
+                AudioFile.duration: result["duration"],
+                AudioFile.sample_rate: result["sample_rate"],
+                AudioFile.channels: result["channels"],
+                AudioFile.loudness: result["loudness"],
+                AudioFile.bpm_estimate: result["bpm_estimate"],
+                AudioFile.bpm: func.coalesce(
+                    AudioFile.bpm, round(result["bpm_estimate"]) if result["bpm_estimate"] else None
+                ),
+                AudioFile.key: func.coalesce(AudioFile.key, result["key_estimate"]),
+                AudioFile.analysis_status: DONE,
+            },
+            synchronize_session=False,
+        )
+        db.commit()
+    response_cache.invalidate(AUDIOS)
+
+
+def save_failure(audio_id: int) -> None:
+    with SessionLocal() as db:
+        db.query(AudioFile).filter(AudioFile.id == audio_id).update(
+            {AudioFile.analysis_status: FAILED}, synchronize_session=False
+        )
+        db.commit()
+    response_cache.invalidate(AUDIOS)
+
+
+class AnalysisQueue:
+    """
+    Background analysis of uploaded audio files.
+
+    Audio file ids wait in a bounded queue; a dispatcher thread hands them to a process pool, at
+    most one per worker process at a time, so decoding and NumPy work never run in the API
+    process and a burst of uploads cannot pile up unbounded work. The same thread saves the
+    results, the pool's callback thread only hands them over. ``submit`` never blocks: when
+    the queue is full the file keeps its ``pending`` status and is picked up by the next bulk run
+    (``backfill``), which feeds the queue with backpressure instead.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self._queue: "queue.Queue[int]" = queue.Queue(maxsize=queue_size)
+        self._results: "queue.Queue[Tuple[int, Future]]" = queue.Queue()
+        self._stopping = threading.Event()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._dispatcher: Optional[threading.Thread] = None
+        self._backfill: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._dispatcher is not None
+
+    def start(self) -> None:
+        if not setting.analysis_enabled or self.running:
+            return
+        self._stopping.clear()
+        # Spawned workers do not inherit the API process' threads, sockets and connection pools
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self._dispatcher = threading.Thread(target=self._dispatch, name="audio-analysis", daemon=True)
+        self._dispatcher.start()
+
+    def close(self) -> None:
+        if not self.running:
+            return
+        self._stopping.set()
+        self._dispatcher.join()
+        self._dispatcher = None
+        # Queued files stay pending and are analyzed by a later bulk run
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def submit(self, audio_id: int) -> bool:
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait(audio_id)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f"Analysis queue is full, audio file {audio_id} stays pending")
+            return False
+
+    def backfill(self, only_missing: bool = True) -> int:
+        """
+        Queue the library for analysis in a background thread; returns the number of files queued.
+
+        With ``only_missing`` only files that were never analyzed successfully are included.
+        Raises ``RuntimeError`` if the analysis is not running or a bulk run is in progress.
+        """
+        with self._lock:
+            if not self.running:
+                raise RuntimeError("Audio analysis is not running")
+            if self._backfill is not None and self._backfill.is_alive():
+                raise RuntimeError("A bulk analysis is already running")
+            with SessionLocal() as db:
+                query = db.query(AudioFile.id)
+                if only_missing:
+                    query = query.filter(or_(AudioFile.analysis_status.is_(None), AudioFile.analysis_status != DONE))
+                ids = [audio_id for (audio_id,) in query.order_by(AudioFile.id)]
+            self._backfill = threading.Thread(target=self._feed, args=(ids,), name="audio-analysis-backfill", daemon=True)
+            self._backfill.start()
+        return len(ids)
+
+    def join(self) -> None:
+        """Wait until the bulk run, the queue and the files being analyzed are all done."""
+        if self._backfill is not None:
+            self._backfill.join()
+        self._queue.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {
+                "in_flight": self._in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            **counters,
+            "backfill_running": self._backfill is not None and self._backfill.is_alive(),
+        }
+
+    def _feed(self, ids) -> None:
+        for audio_id in ids:
+            while not self._stopping.is_set():
+                try:
+                    self._queue.put(audio_id, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if self._stopping.is_set():
+                return
+
+    def _dispatch(self) -> None:
+        while not self._stopping.is_set():
+            # Saving a result frees its worker
+            self._save_results()
+            if self._in_flight >= self.workers:
+                # Every worker is busy, the queue is where files wait
+                self._save_results(timeout=DISPATCH_POLL_SECONDS)
+                continue
+            try:
+                audio_id = self._queue.get(timeout=DISPATCH_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            self._schedule(audio_id)
+        # Analyses that finished meanwhile; the ones still running are left to a later bulk run
+        self._save_results()
+
+    def _schedule(self, audio_id: int) -> None:
+        try:
+            with SessionLocal() as db:
+                row = db.query(AudioFile.file_path, AudioFile.content_hash).filter(AudioFile.id == audio_id).first()
+            if row is None:
+                # Deleted while waiting
+                self._queue.task_done()
+                return
+            file_path, content_hash = row
+            if content_hash is not None and file_path != storage.blob_path(content_hash):
+                # Files stored before the blob store existed get no renditions
+                content_hash = None
+            future = self._executor.submit(analyze_file, file_path, setting.analysis_max_seconds, content_hash)
+        except Exception as e:
+            logger.error(f"Failed to schedule the analysis of audio file {audio_id}: {e}")
+            self._queue.task_done()
+            return
+        with self._lock:
+            self._in_flight += 1
+        # Runs in the pool's callback thread: hand the result over to the dispatcher
+        future.add_done_callback(lambda future, audio_id=audio_id: self._results.put((audio_id, future)))
+
+    def _save_results(self, timeout: Optional[float] = None) -> None:
+        # Save the finished analyses; with a timeout, wait that long for the first one
+        try:
+            item = self._results.get(timeout=timeout) if timeout else self._results.get_nowait()
+        except queue.Empty:
+            return
+        while True:
+            self._finished(*item)
+            try:
+                item = self._results.get_nowait()
+            except queue.Empty:
+                return
+
+    def _finished(self, audio_id: int, future: Future) -> None:
+        try:
+            if future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f"Analysis of audio file {audio_id} failed: {e}")
+                save_failure(audio_id)
+                with self._lock:
+                    self.failed += 1
+                return
+            save_result(audio_id, result)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            logger.error(f"Failed to save the analysis of audio file {audio_id}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._queue.task_done()
+
+
+analysis_queue = AnalysisQueue(setting.analysis_workers, setting.analysis_queue_size)
+
+
+if __name__ == "__main__":
+    # Bulk run over the existing library: pipenv run python analysis.py [--all]
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Analyze the audio files that are missing their metadata")
+    parser.add_argument("--all", action="store_true", help="Re-analyze every audio file")
+    args = parser.parse_args()
+    analysis_queue.start()
+    try:
+        print(f"Queued {analysis_queue.backfill(only_missing=not args.all)} audio files")
+        analysis_queue.join()
+        print(analysis_queue.stats())
+    finally:
+        analysis_queue.close()
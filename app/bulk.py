@@ -0,0 +1,141 @@
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import delete, inspect, insert, update
+from sqlalchemy.orm import ONETOMANY, Session
+from typing import Generic, List, Optional, Sequence, TypeVar
+from listing import model_fields
+
+# Largest number of items accepted by one bulk request
+BULK_MAX_ITEMS = 5000
+
+
+# Pydantic model for bulk deletes
+class BulkDelete(BaseModel):
+    ids: List[int]
+
+# Pydantic models for bulk results; errors point at items by their index in the request
+class BulkError(BaseModel):
+    index: int
+    detail: str
+
+Row = TypeVar("Row")
+
+class BulkCreateResult(BaseModel, Generic[Row]):
+    created: List[Row]
+    errors: List[BulkError]
+
+class BulkUpdateResult(BaseModel):
+    updated: List[int]
+    errors: List[BulkError]
+
+class BulkDeleteResult(BaseModel):
+    deleted: List[int]
+    errors: List[BulkError]
+
+
+def _check_size(items: Sequence):
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} items per request")
+
+
+def _parent_errors(db: Session, items: List[dict], parent_model, parent_key: str) -> dict:
+    """Map item index to an error for every item whose parent id is invalid, using one query."""
+    errors = {}
+    parent_ids = set()
+    for index, item in enumerate(items):
+        if parent_key not in item:
+            continue
+        if item[parent_key] is None:
+            errors[index] = f"{parent_key} is required"
+            continue
+        try:
+            item[parent_key] = int(item[parent_key])
+        except (TypeError, ValueError):
+            errors[index] = f"{parent_model.__name__} ID {item[parent_key]} not found"
+            continue
+        parent_ids.add(item[parent_key])
+    existing = {parent_id for (parent_id,) in db.query(parent_model.id).filter(parent_model.id.in_(parent_ids))}
+    for index, item in enumerate(items):
+        if index not in errors and parent_key in item and item[parent_key] not in existing:
+            errors[index] = f"{parent_model.__name__} ID {item[parent_key]} not found"
+    return errors
+
+
+def bulk_create(db: Session, model, items: List[dict], parent_model, parent_key: str) -> dict:
+    """
+    Insert ``items`` into ``model`` in one transaction.
+
+    Parent ids are validated with a single query and every valid item is written by one multi-row
+    ``INSERT ... RETURNING``. Items with an unknown parent are reported in ``errors`` by their index
+    in the request; each created row carries its request ``index`` too.
+    """
+    _check_size(items)
+    errors = _parent_errors(db, items, parent_model, parent_key)
+    indexes = [index for index in range(len(items)) if index not in errors]
+    created = []
+    if indexes:
+        columns = [getattr(model, column) for column in model_fields(model)]
+        result = db.execute(
+            insert(model).returning(*columns, sort_by_parameter_order=True),
+            [items[index] for index in indexes],
+        )
+        created = [{"index": index, **row._mapping} for index, row in zip(indexes, result)]
+        db.commit()
+    return {
+        "created": created,
+        "errors": [{"index": index, "detail": detail} for index, detail in sorted(errors.items())],
+    }
+
+
+def bulk_update(db: Session, model, items: List[dict], parent_model, parent_key: Optional[str]) -> dict:
+    """
+    Update rows of ``model`` by id in one transaction; each item holds ``id`` and the fields to set.
+
+    Ids (and parent ids, when changed) are validated with one query each, and the updates are sent
+    as executemany batches of ``UPDATE ... WHERE id = ?``.
+    """
+    _check_size(items)
+    errors = _parent_errors(db, items, parent_model, parent_key) if parent_key else {}
+    ids = {item["id"] for item in items}
+    existing = {row_id for (row_id,) in db.query(model.id).filter(model.id.in_(ids))}
+    for index, item in enumerate(items):
+        if index not in errors and item["id"] not in existing:
+            errors[index] = f"{model.__name__} ID {item['id']} not found"
+    updates = [item for index, item in enumerate(items) if index not in errors and len(item) > 1]
+    if updates:
+        db.execute(update(model), updates)
+        db.commit()
+    return {
+        "updated": [item["id"] for index, item in enumerate(items) if index not in errors],
+        "errors": [{"index": index, "detail": detail} for index, detail in sorted(errors.items())],
+    }
+
+
+def bulk_delete(db: Session, model, ids: List[int]) -> dict:
+    """
+    Delete rows of ``model`` by id with one ``DELETE ... RETURNING``; unknown ids are reported.
+
+    As with ``db.delete`` on a single row, children keep existing with their foreign key set to
+    NULL: one ``UPDATE`` per one-to-many relationship, in the same transaction.
+    """
+    _check_size(ids)
+    for relationship in inspect(model).relationships:
+        if relationship.direction is not ONETOMANY:
+            continue
+        for _, child_column in relationship.local_remote_pairs:
+            db.execute(
+                update(child_column.table).where(child_column.in_(ids)).values({child_column.name: None})
+            )
+    result = db.execute(
+        delete(model).where(model.id.in_(ids)).returning(model.id).execution_options(synchronize_session=False)
+    )
+    deleted = [row_id for (row_id,) in result]
+    db.commit()
+    found = set(deleted)
+    return {
+        "deleted": deleted,
+        "errors": [
+            {"index": index, "detail": f"{model.__name__} ID {row_id} not found"}
+            for index, row_id in enumerate(ids) if row_id not in found
+        ],
+    }
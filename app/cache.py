@@ -0,0 +1,291 @@
+from collections import OrderedDict
+from fastapi import Request, Response
+from loguru import logger
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+from urllib.parse import urlencode
+import functools
+import inspect
+import orjson
+import threading
+import time
+from config import setting
+from database import run_blocking, run_encoder
+from responses import render_json
+
+# Cache namespaces, one per group of tables; writes invalidate the namespaces they touch
+AUDIOS = "audios"
+CONFIGS = "configs"
+TRACKS = "tracks"
+EVENTS = "events"
+ACTIONS = "actions"
+# Everything a config graph is built from
+GRAPH = (CONFIGS, AUDIOS, TRACKS, EVENTS, ACTIONS)
+
+
+class CacheBackend:
+    """
+    Storage behind the response cache.
+
+    Values are bytes stored under string keys for ``ttl`` seconds. Invalidation is per namespace:
+    every namespace has a generation counter that is part of the keys built by ``cached``, so
+    bumping it makes all entries of that namespace unreachable at once (they are then evicted by
+    the backend's size bound or the TTL).
+    """
+
+    name = "base"
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        # A TTL of zero or less turns the cache off, ``cached`` then always runs the endpoint
+        return self.ttl > 0
+
+    def start(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes) -> None:
+        raise NotImplementedError
+
+    def generations(self, namespaces: Sequence[str]) -> Tuple[int, ...]:
+        raise NotImplementedError
+
+    def invalidate(self, *namespaces: str) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl}
+
+
+class MemoryBackend(CacheBackend):
+    """Thread-safe in-process LRU cache, private to one worker process."""
+
+    name = "memory"
+
+    def __init__(self, ttl: float, max_entries: int):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generations(self, namespaces: Sequence[str]) -> Tuple[int, ...]:
+        with self._lock:
+            return tuple(self._generations.get(namespace, 0) for namespace in namespaces)
+
+    def invalidate(self, *namespaces: str) -> None:
+        with self._lock:
+            for namespace in namespaces:
+                self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**super().stats(), "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+class RedisBackend(CacheBackend):
+    """
+    Cache shared by every worker through a Redis server (or anything speaking its protocol).
+
+    Entries are plain keys with a TTL; bound their memory on the server with ``maxmemory`` and
+    ``maxmemory-policy allkeys-lru``. Namespace generations live in a Redis hash and every worker
+    keeps a local copy, kept current by the invalidations published on ``CHANNEL``, so a lookup
+    costs a single GET. ``client`` is a ``redis.Redis`` instance or a compatible fake.
+    Redis errors are logged and treated as cache misses. Redis calls go through ``run_blocking``,
+    so they never stall the event loop when endpoints run on the async engine.
+    """
+
+    name = "redis"
+    KEY_PREFIX = "sonicstride:cache:"
+    GENERATIONS_KEY = KEY_PREFIX + "generations"
+    CHANNEL = KEY_PREFIX + "invalidate"
+
+    def __init__(self, ttl: float, client):
+        super().__init__(ttl)
+        self.client = client
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._listener = None
+
+    def start(self) -> None:
+        # Subscribe before loading the generations so no invalidation is missed in between
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.CHANNEL: self._on_invalidate})
+        self._listener = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        generations = self.client.hgetall(self.GENERATIONS_KEY)
+        with self._lock:
+            for namespace, generation in generations.items():
+                self._set_generation(_text(namespace), int(generation))
+
+    def close(self) -> None:
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def _set_generation(self, namespace: str, generation: int) -> None:
+        # Messages can arrive out of order, generations only move forward
+        self._generations[namespace] = max(self._generations.get(namespace, 0), generation)
+
+    def _on_invalidate(self, message: dict) -> None:
+        namespace, _, generation = _text(message["data"]).partition("=")
+        with self._lock:
+            self._set_generation(namespace, int(generation))
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            value = run_blocking(self.client.get, self.KEY_PREFIX + key)
+        except Exception as e:
+            logger.warning(f"Cache read failed: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        try:
+            run_blocking(self.client.set, self.KEY_PREFIX + key, value, px=max(1, int(self.ttl * 1000)))
+        except Exception as e:
+            logger.warning(f"Cache write failed: {e}")
+
+    def generations(self, namespaces: Sequence[str]) -> Tuple[int, ...]:
+        if self._listener is None:
+            # Not started (e.g. in a script): read the shared counters directly
+            values = run_blocking(self.client.hmget, self.GENERATIONS_KEY, list(namespaces))
+            return tuple(int(value or 0) for value in values)
+        with self._lock:
+            return tuple(self._generations.get(namespace, 0) for namespace in namespaces)
+
+    def invalidate(self, *namespaces: str) -> None:
+        try:
+            generations = run_blocking(self._publish_invalidation, namespaces)
+        except Exception as e:
+            logger.error(f"Cache invalidation of {namespaces} failed, entries may be stale for {self.ttl}s: {e}")
+            return
+        with self._lock:
+            for namespace, generation in zip(namespaces, generations):
+                self._set_generation(namespace, generation)
+
+
+    def _publish_invalidation(self, namespaces: Sequence[str]) -> list:
+        pipeline = self.client.pipeline()
+        for namespace in namespaces:
+            pipeline.hincrby(self.GENERATIONS_KEY, namespace, 1)
+        generations = pipeline.execute()
+        pipeline = self.client.pipeline()
+        for namespace, generation in zip(namespaces, generations):
+            pipeline.publish(self.CHANNEL, f"{namespace}={generation}")
+        pipeline.execute()
+        return generations
+
+
+def _text(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def create_backend() -> CacheBackend:
+    # "auto" is resolved by gunicorn_conf.py for production; a single process keeps a memory cache
+    if setting.cache_backend == "redis":
+        import redis
+        return RedisBackend(setting.cache_ttl_seconds, redis.Redis.from_url(setting.cache_redis_url))
+    return MemoryBackend(setting.cache_ttl_seconds, setting.cache_max_entries)
+
+
+response_cache = create_backend()
+
+
+def cache_key(namespaces: Sequence[str], key: str) -> str:
+    generations = response_cache.generations(namespaces)
+    return ",".join(f"{namespace}:{generation}" for namespace, generation in zip(namespaces, generations)) + "|" + key
+
+
+def cached_value(namespaces: Sequence[str], key: str, build: Callable[[], Any]) -> Any:
+    """Read-through cache for a JSON-serializable value; ``None`` results are not cached."""
+    if not response_cache.enabled:
+        return build()
+    full_key = cache_key(namespaces, key)
+    value = response_cache.get(full_key)
+    if value is not None:
+        return orjson.loads(value)
+    result = build()
+    if result is not None:
+        response_cache.set(full_key, render_json(result))
+    return result
+
+
+def cached(*namespaces: str):
+    """
+    Read-through cache for a GET endpoint whose result depends on the tables of ``namespaces``.
+
+    Responses are cached by path and query string, pre-serialized, together with the headers the
+    endpoint set on its ``response``; a hit skips both the database and JSON encoding. Endpoints
+    returning a ``Response`` themselves (e.g. streaming exports) are never cached, and nothing is
+    when ``cache_ttl_seconds`` is zero.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        parameters = list(signature.parameters.values())
+        has_request = "request" in signature.parameters
+        has_response = "response" in signature.parameters
+        # FastAPI injects Request/Response by annotation, add them when the endpoint does not ask for them
+        if not has_request:
+            parameters.append(inspect.Parameter("_cache_request", inspect.Parameter.KEYWORD_ONLY, annotation=Request))
+        if not has_response:
+            parameters.append(inspect.Parameter("_cache_response", inspect.Parameter.KEYWORD_ONLY, annotation=Response))
+
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            request = kwargs["request"] if has_request else kwargs.pop("_cache_request")
+            response = kwargs["response"] if has_response else kwargs.pop("_cache_response")
+            if not response_cache.enabled:
+                return func(**kwargs)
+            key = cache_key(namespaces, request.url.path + "?" + urlencode(sorted(request.query_params.multi_items())))
+            entry = response_cache.get(key)
+            if entry is None:
+                result = func(**kwargs)
+                if isinstance(result, Response):
+                    return result
+                # Entry layout: the headers as one JSON line, then the body
+                entry = orjson.dumps(dict(response.headers)) + b"\n" + run_encoder(wrapper.encode_result, result)
+                response_cache.set(key, entry)
+            headers, _, body = entry.partition(b"\n")
+            return Response(content=body, media_type="application/json", headers=orjson.loads(headers))
+
+        wrapper.__signature__ = signature.replace(parameters=parameters)
+        # Replaced by responses.render_endpoint with the encoder of the route's response_model
+        wrapper.encode_result = render_json
+        return wrapper
+    return decorator
@@ -0,0 +1,150 @@
+from typing import Optional, Sequence
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from config import setting
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# Content codings the server can produce, preferred first when the client accepts several equally
+SUPPORTED_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+# Responses compressed on the fly; audio is served from pre-compressed files instead (see storage.py)
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/csv")
+
+
+def negotiate_encoding(accept_encoding: Optional[str], available: Sequence[str]) -> Optional[str]:
+    """
+    Pick the content coding to use from ``available`` for an ``Accept-Encoding`` header.
+
+    The highest ``q`` value wins, ties go to the earlier entry of ``available``; ``*`` matches
+    every coding the header does not name and ``q=0`` refuses one. Returns ``None`` when the
+    response should be sent uncompressed.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding] = weight
+    best, best_weight = None, 0.0
+    for coding in available:
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+class _Encoder:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=setting.compression_brotli_quality)
+            self.compress, self.flush, self.finish = (
+                self._compressor.process, self._compressor.flush, self._compressor.finish
+            )
+        else:
+            # wbits 31: zlib stream with a gzip header and trailer
+            self._compressor = zlib.compressobj(setting.compression_gzip_level, zlib.DEFLATED, 31)
+            self.compress, self.finish = self._compressor.compress, self._compressor.flush
+            self.flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    """
+    Compress JSON, NDJSON and CSV responses with brotli or gzip, as negotiated by ``Accept-Encoding``.
+
+    Bodies smaller than ``compression_min_size`` are sent as they are, since the coding overhead
+    outweighs the savings. Streaming responses (exports) are compressed chunk by chunk, each chunk
+    flushed so the client can decode it right away instead of waiting for the encoder's buffer
+    to fill. Responses
+    of other types, partial responses and responses that already carry a ``Content-Encoding`` pass
+    through untouched.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"), SUPPORTED_ENCODINGS)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressionResponder(self.app, encoding)(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str):
+        self.app = app
+        self.encoding = encoding
+        self.send: Send = None
+        self.start_message: Optional[Message] = None
+        self.encoder: Optional[_Encoder] = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+            self.passthrough = (
+                message["status"] not in (200, 201)
+                or "content-encoding" in headers
+                or media_type not in COMPRESSIBLE_TYPES
+            )
+            if self.passthrough:
+                await self.send(message)
+            else:
+                # Held back until the first body chunk tells whether compression is worth it
+                self.start_message = message
+            return
+        if self.passthrough or message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.encoder is None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body and len(body) < setting.compression_min_size:
+                await self.send(self.start_message)
+                await self.send(message)
+                self.passthrough = True
+                return
+            self.encoder = _Encoder(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            if "content-length" in headers:
+                del headers["content-length"]
+            if not more_body:
+                body = self.encoder.compress(body) + self.encoder.finish()
+                headers["Content-Length"] = str(len(body))
+                await self.send(self.start_message)
+                await self.send({"type": "http.response.body", "body": body, "more_body": False})
+                return
+            await self.send(self.start_message)
+
+        if not more_body:
+            body = self.encoder.compress(body) + self.encoder.finish()
+        elif body:
+            body = self.encoder.compress(body) + self.encoder.flush()
+        if body or not more_body:
+            await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
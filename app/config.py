@@ -8,7 +8,73 @@ class Setting(BaseSettings):
     database_user: str
     database_password: str
     database_port: str
+    # Run the endpoints on an async (asyncpg) engine instead of the threadpool
+    database_async: bool = False
+    # Connection pool: connections kept open, extra connections allowed under load, seconds to
+    # wait for a free connection, seconds before a connection is replaced, and whether to test
+    # connections before use. In async mode each worker has one pool per engine.
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 30
+    database_pool_recycle: int = 1800
+    database_pool_pre_ping: bool = True
+    # Server side statement timeout in milliseconds (0 disables it)
+    database_statement_timeout_ms: int = 30000
+    # Connection waits longer than this are logged
+    database_pool_wait_warning_ms: float = 100
+
+    # List endpoints config: page size used when no limit is given (0 returns every row, as the
+    # endpoints did before pagination; clients page by sending a limit), and the largest allowed
+    list_default_limit: int = 0
+    list_max_limit: int = 1000
+
+    # Read cache config: "memory" keeps a private cache per worker process, "redis" shares one
+    # between all workers, "auto" picks redis when gunicorn runs several workers (see
+    # gunicorn_conf.py) and memory otherwise (entry TTL in seconds, 0 disables the cache;
+    # max_entries only bounds the memory backend)
+    cache_backend: str = "auto"
+    cache_redis_url: str = "redis://localhost:6379/0"
+    cache_ttl_seconds: float = 60
+    cache_max_entries: int = 1024
+
+    # Response compression: JSON/NDJSON/CSV bodies of at least min_size bytes are compressed on
+    # the fly (levels favour speed; audio uses pre-compressed files instead)
+    compression_min_size: int = 1024
+    compression_gzip_level: int = 6
+    compression_brotli_quality: int = 4
+
+    # Background audio analysis (see analysis.py): worker processes per API process, files that
+    # may wait for a worker, and how many seconds from the start of a file tempo and key use
+    analysis_enabled: bool = True
+    analysis_workers: int = 2
+    analysis_queue_size: int = 1000
+    analysis_max_seconds: float = 120
+
+    # Metrics (see metrics.py): requests taking at least this many milliseconds are logged with
+    # the SQL statements they ran (0 disables the slow request log)
+    metrics_slow_request_ms: float = 0
+
+    # Logging (see request_log.py): lowest level written, and the share of successful GET/HEAD
+    # requests that get a request log record (errors and writes are always logged)
+    log_level: str = "INFO"
+    log_request_sample_rate: float = 1.0
+
+    # Mixdown renderer (see render.py): worker processes per API process, longest mix in
+    # seconds, and disk space of the rendered mixes kept, least recently used first out
+    render_workers: int = 1
+    render_max_seconds: float = 600
+    render_cache_max_mb: float = 1024
+
+    # Production server (see gunicorn_conf.py): address, worker processes (0 = one per CPU
+    # core; each has its own connection pool and analysis pool), seconds a worker's event loop
+    # may stay unresponsive before it is restarted, seconds in-flight requests get to finish on
+    # shutdown or reload, and seconds an idle keep-alive connection is kept open
+    server_bind: str = "0.0.0.0:80"
+    server_workers: int = 0
+    server_timeout: int = 120
+    server_graceful_timeout: int = 30
+    server_keepalive: int = 5
 
 path = os.getenv("../.env")
 setting = Setting(_env_file=path, _env_file_encoding="utf-8")
-# setting = Setting()
\ No newline at end of file
+# setting = Setting()
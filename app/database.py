@@ -1,8 +1,24 @@
-from sqlalchemy import create_engine
+from collections import deque
+from contextvars import ContextVar
+from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.routing import APIRoute
+from loguru import logger
+from sqlalchemy import create_engine, inspect as inspect_object
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from typing import Optional
+import functools
+import inspect
+import threading
+import time
 # Local Application Imports
 from config import setting
+from responses import render_endpoint
+from metrics import instrument_engine
 
 # Format the SQLAlchemy database URL
 SQLALCHEMY_DATABASE_URL = (
@@ -13,12 +29,287 @@ SQLALCHEMY_DATABASE_URL = (
 #     f"postgresql://sonicstride:password123"
 #     f"@test-music-db:5432/music_library_db"
 # )
+
+
+class PoolMonitor:
+    """
+    Checkout statistics of a connection pool: how long requests waited for a connection and how
+    close the pool came to running out. Waits above ``database_pool_wait_warning_ms`` are logged
+    together with the pool state at that moment.
+    """
+
+    # Number of recent checkouts the wait percentiles are computed over
+    WINDOW = 1024
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.peak_checked_out = 0
+        self._waits = deque(maxlen=self.WINDOW)
+        self._lock = threading.Lock()
+
+    def record(self, pool: QueuePool, wait: float) -> None:
+        checked_out = pool.checkedout()
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+            self._waits.append(wait)
+        if wait * 1000 >= setting.database_pool_wait_warning_ms:
+            logger.warning(f"Waited {wait * 1000:.1f}ms for a database connection ({_usage(checked_out)})")
+
+    def record_timeout(self, pool: QueuePool) -> None:
+        with self._lock:
+            self.timeouts += 1
+        logger.error(f"Timed out waiting for a database connection ({_usage(pool.checkedout())})")
+
+    def stats(self, pool: QueuePool) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            checkouts, timeouts = self.checkouts, self.timeouts
+            total_wait, max_wait, peak = self.total_wait, self.max_wait, self.peak_checked_out
+
+        def percentile(fraction: float) -> float:
+            return waits[min(len(waits) - 1, int(len(waits) * fraction))] * 1000 if waits else 0.0
+
+        checked_out = pool.checkedout()
+        capacity = _pool_capacity()
+        return {
+            "size": pool.size(),
+            "capacity": capacity,
+            "checked_out": checked_out,
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            # Share of the capacity in use, now and at the busiest checkout (None when unbounded)
+            "saturation": checked_out / capacity if capacity else None,
+            "peak_saturation": peak / capacity if capacity else None,
+            "checkouts": checkouts,
+            "timeouts": timeouts,
+            "wait_ms": {
+                "avg": total_wait / checkouts * 1000 if checkouts else 0.0,
+                "max": max_wait * 1000,
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+            },
+        }
+
+
+def _pool_capacity() -> Optional[int]:
+    # Most connections a pool may hold, None when overflow is unlimited
+    if setting.database_pool_size == 0 or setting.database_max_overflow < 0:
+        return None
+    return setting.database_pool_size + setting.database_max_overflow
+
+
+def _usage(checked_out: int) -> str:
+    return f"{checked_out}/{_pool_capacity() or 'unbounded'} checked out"
+
+
+# Start of the checkout in progress in this thread or task (QueuePool._do_get retries by calling
+# itself, only the outer call is recorded)
+_checkout_started: ContextVar[Optional[float]] = ContextVar("checkout_started", default=None)
+
+
+class MonitoredQueuePool(QueuePool):
+    """
+    QueuePool that reports every checkout, and how long it was blocked waiting for a connection to
+    be returned, to its ``monitor``. Opening new connections, reconnecting recycled ones and the
+    pre-ping are not waiting for the pool and are left out.
+    """
+
+    monitor = PoolMonitor()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Seconds spent opening a new connection, by record, until its checkout is recorded
+        self._connect_times = {}
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        record = super()._create_connection()
+        self._connect_times[id(record)] = time.perf_counter() - started
+        return record
+
+    def _do_get(self):
+        if _checkout_started.get() is not None:
+            return super()._do_get()
+        started = time.perf_counter()
+        token = _checkout_started.set(started)
+        try:
+            record = super()._do_get()
+        except PoolTimeoutError:
+            self.monitor.record_timeout(self)
+            raise
+        finally:
+            _checkout_started.reset(token)
+        # Recycling and the pre-ping happen after _do_get, only a new connection has to be taken out
+        wait = time.perf_counter() - started - self._connect_times.pop(id(record), 0.0)
+        self.monitor.record(self, max(wait, 0.0))
+        return record
+
+
+def pool_options() -> dict:
+    """Engine keyword arguments for the pool settings in ``config.Setting``."""
+    return {
+        "pool_size": setting.database_pool_size,
+        "max_overflow": setting.database_max_overflow,
+        "pool_timeout": setting.database_pool_timeout,
+        "pool_recycle": setting.database_pool_recycle,
+        "pool_pre_ping": setting.database_pool_pre_ping,
+    }
+
+
+# Server side statement timeout, 0 leaves the server default in place
+STATEMENT_TIMEOUT_OPTIONS = (
+    {"options": f"-c statement_timeout={setting.database_statement_timeout_ms}"}
+    if setting.database_statement_timeout_ms else {}
+)
+
 # Create a SQLAlchemy engine instance which provides a source of connectivity to our database
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    poolclass=MonitoredQueuePool,
+    connect_args=STATEMENT_TIMEOUT_OPTIONS,
+    **pool_options()
+)
+# Time every statement for the /metrics endpoint and the slow request log
+instrument_engine(engine)
 
 # Create a factory for SQLAlchemy session instances that are bound to our database engine
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Create the declarative base model that other models will inherit from
 # This is a class that includes directives to describe the actual database table it will be mapped to
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+# Dependency to get a database session, shared by every router
+def get_database():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Async mode: endpoints run on an asyncpg engine instead of holding a threadpool slot per request.
+# The sync engine above stays available for startup, scripts and streaming exports.
+if setting.database_async:
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+    from sqlalchemy.util.concurrency import await_only, in_greenlet
+
+    class MonitoredAsyncQueuePool(MonitoredQueuePool, AsyncAdaptedQueuePool):
+        """AsyncAdaptedQueuePool with its own checkout statistics."""
+
+        monitor = PoolMonitor()
+
+    ASYNC_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=MonitoredAsyncQueuePool,
+        connect_args=(
+            {"server_settings": {"statement_timeout": str(setting.database_statement_timeout_ms)}}
+            if setting.database_statement_timeout_ms else {}
+        ),
+        **pool_options()
+    )
+    instrument_engine(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False)
+
+    # Dependency to get an async database session
+    async def get_async_database():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+
+def run_blocking(function, *args, **kwargs):
+    """
+    Call ``function``, blocking work other than database calls (Redis, the filesystem), from code
+    that may run in an endpoint body.
+
+    In async mode endpoint bodies run on the event loop (see ``use_async_session``), where such a
+    call would stall every request of the worker: it is moved to the threadpool instead, and
+    awaited through SQLAlchemy's greenlet bridge (the one ``run_sync`` awaits database round trips
+    with). Everywhere else it is a plain call.
+    """
+    if setting.database_async and in_greenlet():
+        return await_only(run_in_threadpool(function, *args, **kwargs))
+    return function(*args, **kwargs)
+
+
+def run_encoder(encode, content) -> bytes:
+    """
+    Validate and encode an endpoint result with ``encode`` (see ``responses.response_encoder``)
+    through ``run_blocking``: in async mode a large page or graph is not turned into JSON on the
+    event loop.
+
+    ORM objects are encoded in place instead: validating them reads their attributes, which may
+    load from the database and so needs the session's greenlet. Endpoints only return single
+    objects that way, large results are plain rows.
+    """
+    sample = content[0] if isinstance(content, list) and content else content
+    if inspect_object(sample, raiseerr=False) is not None:
+        return encode(content)
+    return run_blocking(encode, content)
+
+
+def use_async_session(endpoint):
+    """
+    Turn a sync endpoint taking a ``db: Session`` into an ``async def`` one running on the async engine.
+
+    The endpoint body is executed with ``AsyncSession.run_sync``: it keeps using the regular ORM API,
+    but every database round trip is awaited on the event loop through asyncpg instead of blocking
+    a threadpool thread. The rest of the body runs on the event loop too, so any other blocking
+    call in it must go through ``run_blocking`` (the Redis cache, the blob store and the encoding
+    of results do). Returns
+    ``endpoint`` unchanged when async mode is off, for coroutine endpoints, and for endpoints
+    without a ``Session`` parameter.
+    """
+    if not setting.database_async or inspect.iscoroutinefunction(endpoint):
+        return endpoint
+    signature = inspect.signature(endpoint)
+    session_names = [name for name, parameter in signature.parameters.items() if parameter.annotation is Session]
+    if not session_names:
+        return endpoint
+    session_name = session_names[0]
+
+    @functools.wraps(endpoint)
+    async def wrapper(**kwargs):
+        async_db = kwargs[session_name]
+        return await async_db.run_sync(lambda db: endpoint(**{**kwargs, session_name: db}))
+
+    wrapper.__signature__ = signature.replace(parameters=[
+        parameter.replace(annotation=AsyncSession, default=Depends(get_async_database))
+        if parameter.name == session_name else parameter
+        for parameter in signature.parameters.values()
+    ])
+    return wrapper
+
+
+class DatabaseRoute(APIRoute):
+    """
+    Route class for the API routers: endpoint results are validated against the route's
+    ``response_model`` and encoded in one pass (see ``responses.render_endpoint``, run by
+    ``run_encoder``) and, in async mode, endpoints run on the async engine.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        response_model = kwargs.get("response_model")
+        if isinstance(response_model, DefaultPlaceholder):
+            response_model = response_model.value
+        endpoint = render_endpoint(
+            endpoint, kwargs.get("status_code"), response_model, kwargs.get("response_model_exclude_unset", False),
+            run_encoder
+        )
+        super().__init__(path, use_async_session(endpoint), **kwargs)
+
+
+def pool_stats() -> dict:
+    """Checkout statistics of every engine's pool."""
+    # Engines replaced by scripts or tests may use other pool classes, which are not monitored
+    pools = {"sync": engine.pool}
+    if setting.database_async:
+        pools["async"] = async_engine.sync_engine.pool
+    return {name: pool.monitor.stats(pool) for name, pool in pools.items() if isinstance(pool, MonitoredQueuePool)}
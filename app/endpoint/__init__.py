@@ -1,6 +1,6 @@
 from fastapi import APIRouter
 # Local Application Imports
-from endpoint import configs, audios, tracks, events, actions, others
+from endpoint import configs, audios, tracks, events, actions, others, stats, metrics
 
 ROUTER = APIRouter()
 ROUTER.include_router(configs.router)
@@ -8,4 +8,6 @@ ROUTER.include_router(audios.router)
 ROUTER.include_router(tracks.router)
 ROUTER.include_router(events.router)
 ROUTER.include_router(actions.router)
-ROUTER.include_router(others.router)
\ No newline at end of file
+ROUTER.include_router(others.router)
+ROUTER.include_router(stats.router)
+ROUTER.include_router(metrics.router)
\ No newline at end of file
@@ -1,19 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from database import SessionLocal
+from database import DatabaseRoute, get_database
 from models import Action, Event
+from bulk import BulkCreateResult, BulkDelete, BulkDeleteResult, BulkUpdateResult, bulk_create, bulk_delete, bulk_update
+from cache import ACTIONS, response_cache
+from listing import ListParams, export_rows, fetch_page, model_fields, parse_fields, row_model
+from responses import Message
 
-router = APIRouter(prefix="/api/actions", tags=["Actions"])
-
-# Dependency to get a database session
-def get_database():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+router = APIRouter(prefix="/api/actions", tags=["Actions"], route_class=DatabaseRoute)
 
 # Pydantic model for Action
 class ActionCreate(BaseModel):
@@ -31,14 +27,52 @@ class ActionUpdate(BaseModel):
     value: Optional[float] = None
     end_time: Optional[float] = None
 
-# Endpoint to list all actions
-@router.get("/list", response_model=List[dict])
-def list_actions(db: Session = Depends(get_database)):
-    actions_list = db.query(Action).all()
-    return [{"id": action.id, "event_id": action.event_id, "target": action.target, "property": action.property, "method": action.method, "value": action.value, "end_time": action.end_time} for action in actions_list]
+class ActionBulkUpdate(ActionUpdate):
+    id: int
+
+# Pydantic models for Action responses
+class ActionOut(BaseModel):
+    id: int
+    event_id: Optional[int] = None
+    target: Optional[str] = None
+    property: Optional[str] = None
+    method: Optional[str] = None
+    value: Optional[float] = None
+    end_time: Optional[float] = None
+
+class ActionCreated(ActionOut):
+    index: int
+
+# Pydantic model for Action list rows; fields= may select any subset of the ActionOut fields
+ActionRow = row_model(ActionOut)
+
+# Endpoint to list actions (paginated, see listing.py)
+@router.get("/list", response_model=List[ActionRow], response_model_exclude_unset=True)
+def list_actions(
+    response: Response,
+    params: ListParams = Depends(),
+    event_id: Optional[int] = Query(None, description="Only actions of this event"),
+    target: Optional[str] = Query(None, description="Only actions on this target"),
+    property: Optional[str] = Query(None, description="Only actions on this property"),
+    method: Optional[str] = Query(None, description="Only actions using this method"),
+    db: Session = Depends(get_database)
+):
+    columns = parse_fields(params.fields, model_fields(Action), model_fields(Action))
+    criteria = []
+    if event_id is not None:
+        criteria.append(Action.event_id == event_id)
+    if target is not None:
+        criteria.append(Action.target == target)
+    if property is not None:
+        criteria.append(Action.property == property)
+    if method is not None:
+        criteria.append(Action.method == method)
+    if params.format:
+        return export_rows(Action, columns, criteria, params)
+    return fetch_page(db, Action, columns, criteria, params, response)
 
 # Endpoint to create a new action
-@router.post("/", response_model=dict)
+@router.post("/", response_model=ActionOut)
 def create_action(action: ActionCreate, db: Session = Depends(get_database)):
     # Check if the Event id exists in the database
     config = db.query(Event).filter(Event.id == action.event_id).first()
@@ -55,21 +89,42 @@ def create_action(action: ActionCreate, db: Session = Depends(get_database)):
     )
     db.add(db_action)
     db.commit()
+    response_cache.invalidate(ACTIONS)
     db.refresh(db_action)
     return {"id": db_action.id, "event_id": db_action.event_id, "target": db_action.target, "property": db_action.property, "method": db_action.method, "value": db_action.value, "end_time": db_action.end_time}
 
+# Endpoints to create, update and delete many actions in one request (see bulk.py)
+@router.post("/bulk", response_model=BulkCreateResult[ActionCreated])
+def create_actions(actions: List[ActionCreate], db: Session = Depends(get_database)):
+    result = bulk_create(db, Action, [action.dict() for action in actions], Event, "event_id")
+    response_cache.invalidate(ACTIONS)
+    return result
+
+@router.put("/bulk", response_model=BulkUpdateResult)
+def update_actions(actions: List[ActionBulkUpdate], db: Session = Depends(get_database)):
+    result = bulk_update(db, Action, [action.dict(exclude_unset=True) for action in actions], Event, None)
+    response_cache.invalidate(ACTIONS)
+    return result
+
+@router.post("/bulk/delete", response_model=BulkDeleteResult)
+def delete_actions(body: BulkDelete, db: Session = Depends(get_database)):
+    result = bulk_delete(db, Action, body.ids)
+    response_cache.invalidate(ACTIONS)
+    return result
+
 # Endpoint to delete an action
-@router.delete("/{action_id}", response_model=dict)
+@router.delete("/{action_id}", response_model=Message)
 def delete_action(action_id: int, db: Session = Depends(get_database)):
     db_action = db.query(Action).filter(Action.id == action_id).first()
     if not db_action:
         raise HTTPException(status_code=404, detail="Action not found")
     db.delete(db_action)
     db.commit()
+    response_cache.invalidate(ACTIONS)
     return {"message": "Action deleted successfully"}
 
 # Endpoint to update an action
-@router.put("/{action_id}", response_model=dict)
+@router.put("/{action_id}", response_model=ActionOut)
 def update_action(action_id: int, action: ActionUpdate, db: Session = Depends(get_database)):
     db_action = db.query(Action).filter(Action.id == action_id).first()
     if not db_action:
@@ -80,12 +135,14 @@ def update_action(action_id: int, action: ActionUpdate, db: Session = Depends(ge
         setattr(db_action, key, value)
     
     db.commit()
+    response_cache.invalidate(ACTIONS)
     db.refresh(db_action)
     return {"id": db_action.id, "event_id": db_action.event_id, "target": db_action.target, "property": db_action.property, "method": db_action.method, "value": db_action.value, "end_time": db_action.end_time}
 
 # Endpoint to delete all actions
-@router.delete("/delete_all", response_model=dict)
+@router.delete("/delete_all", response_model=Message)
 def delete_all_actions(db: Session = Depends(get_database)):
     db.query(Action).delete()
     db.commit()
+    response_cache.invalidate(ACTIONS)
     return {"message": "All actions deleted successfully"}
\ No newline at end of file
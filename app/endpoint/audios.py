@@ -1,22 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import os
+import re
+import time
 from loguru import logger
-from database import SessionLocal
-from models import AudioFile, GenreEnum
+from config import setting
+from database import DatabaseRoute, get_database, run_blocking
+from models import AudioBlob, AudioFile, GenreEnum
+from listing import ListParams, export_rows, fetch_page, model_fields, parse_fields, row_model
+import storage
+from cache import AUDIOS, cached, cached_value, response_cache
+from compression import negotiate_encoding
+import analysis
+import renditions
+from tempo_index import tempo_index
+from responses import Message, RangeFileResponse
 
-router = APIRouter(prefix="/api/audiofiles", tags=["AudioFiles"])
+router = APIRouter(prefix="/api/audiofiles", tags=["AudioFiles"], route_class=DatabaseRoute)
 
-# Dependency to get a database session
-def get_database():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Download-by-id responses are revalidated on every use (a cheap 304 thanks to the ETag),
+# while content-addressed URLs never change and can be cached forever
+REVALIDATE_CACHE_CONTROL = "no-cache"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The renditions of an audio file never change once written, but only exist after its analysis
+RENDITION_CACHE_CONTROL = "public, max-age=86400"
+CONTENT_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
 
 # Pydantic model for AudioFile update
 class AudioFileUpdate(BaseModel):
@@ -27,22 +38,117 @@ class AudioFileUpdate(BaseModel):
     key: Optional[str] = None
     bpm: Optional[int] = None
 
-# Endpoint to list all audio files with important information
-@router.get("/list", response_model=List[dict])
-def list_audio_files(db: Session = Depends(get_database)):
-    audio_files_list = db.query(AudioFile).all()
-    return [
-        {
-            "id": audio_file.id,
-            "name": audio_file.name,
-            "author": audio_file.author,
-            "genre": audio_file.genre,
-            "file_path": audio_file.file_path
-        } for audio_file in audio_files_list
-    ]
+# Pydantic model for AudioFile responses
+class AudioFileOut(BaseModel):
+    id: int
+    name: str
+    author: Optional[str] = None
+    type: str
+    genre: Optional[GenreEnum] = None
+    key: Optional[str] = None
+    bpm: Optional[int] = None
+    file_path: str
+    filename: Optional[str] = None
+    content_hash: Optional[str] = None
+    duration: Optional[float] = None
+    sample_rate: Optional[int] = None
+    channels: Optional[int] = None
+    loudness: Optional[float] = None
+    bpm_estimate: Optional[float] = None
+    analysis_status: Optional[str] = None
+
+# Pydantic model for bulk analysis runs
+class AnalysisQueued(BaseModel):
+    queued: int
+
+# Pydantic model for tempo matches
+class TempoMatch(BaseModel):
+    id: int
+    name: str
+    type: str
+    genre: Optional[GenreEnum] = None
+    key: Optional[str] = None
+    bpm: int
+    relation: str
+    distance: float
+
+LIST_FIELDS = ["id", "name", "author", "genre", "file_path", "content_hash"]
+
+# Pydantic model for AudioFile list rows; fields= may select any subset of the AudioFileOut fields
+AudioFileRow = row_model(AudioFileOut)
+
+# Endpoint to list audio files with important information (paginated, see listing.py)
+@router.get("/list", response_model=List[AudioFileRow], response_model_exclude_unset=True)
+@cached(AUDIOS)
+def list_audio_files(
+    response: Response,
+    params: ListParams = Depends(),
+    type: Optional[str] = Query(None, description="Only audio files of this type"),
+    genre: Optional[GenreEnum] = Query(None, description="Only audio files of this genre"),
+    author: Optional[str] = Query(None, description="Only audio files by this author"),
+    key: Optional[str] = Query(None, description="Only audio files in this musical key"),
+    bpm_min: Optional[int] = Query(None, description="Lowest BPM, inclusive"),
+    bpm_max: Optional[int] = Query(None, description="Highest BPM, inclusive"),
+    db: Session = Depends(get_database)
+):
+    columns = parse_fields(params.fields, model_fields(AudioFile), LIST_FIELDS)
+    criteria = []
+    if type is not None:
+        criteria.append(AudioFile.type == type)
+    if genre is not None:
+        criteria.append(AudioFile.genre == genre)
+    if author is not None:
+        criteria.append(AudioFile.author == author)
+    if key is not None:
+        criteria.append(AudioFile.key == key)
+    if bpm_min is not None:
+        criteria.append(AudioFile.bpm >= bpm_min)
+    if bpm_max is not None:
+        criteria.append(AudioFile.bpm <= bpm_max)
+    if params.format:
+        return export_rows(AudioFile, columns, criteria, params)
+    return fetch_page(db, AudioFile, columns, criteria, params, response)
+
+# Endpoint to find audio files matching a cadence, including half and double tempo (see tempo_index.py)
+@router.get("/match", response_model=List[TempoMatch])
+def match_audio_files(
+    response: Response,
+    bpm: float = Query(..., gt=0, le=400, description="Cadence to match, in beats (steps) per minute"),
+    tolerance: float = Query(5, ge=0, le=50, description="Largest allowed BPM difference from the cadence"),
+    genre: Optional[GenreEnum] = Query(None, description="Only audio files of this genre"),
+    type: Optional[str] = Query(None, description="Only audio files of this type"),
+    limit: int = Query(20, ge=1, le=setting.list_max_limit, description="Maximum number of matches to return"),
+    db: Session = Depends(get_database)
+):
+    started = time.perf_counter()
+    matches = tempo_index.match(db, bpm, tolerance, genre, type, limit)
+    response.headers["server-timing"] = f"match;dur={(time.perf_counter() - started) * 1000:.3f}"
+    return matches
+
+def save_audio_file(db: Session, db_audio_file: AudioFile, staged: storage.StagedUpload):
+    try:
+        db.add(db_audio_file)
+        storage.acquire_blob(db, staged.content_hash, staged.size)
+        db.commit()
+    except Exception:
+        staged.discard()
+        raise
+    # The blob only becomes visible once its reference is committed
+    try:
+        storage.store_blob(staged)
+    except OSError as e:
+        logger.error(f"Failed to move file into place: {e}")
+        staged.discard()
+        last_reference = storage.release_blob(db, staged.content_hash)
+        db.delete(db_audio_file)
+        db.commit()
+        if last_reference:
+            storage.remove_blob(db, staged.content_hash)
+        raise HTTPException(status_code=500, detail="Internal Server Error while saving file")
+    db.refresh(db_audio_file)
 
 # Endpoint to create a new audio file with file upload
-@router.post("/", response_model=dict)
+@router.post("/", response_model=AudioFileOut)
 async def create_audio_file(
     name: str = Form(..., description="Name of the audio file"),
     author: Optional[str] = Form(None, description="Author of the audio file"),
@@ -53,16 +159,15 @@ async def create_audio_file(
     audio_file: UploadFile = File(..., description="Audio file (MP3, WAV)"),
     db: Session = Depends(get_database)
 ):
-    os.makedirs("audio_files", exist_ok=True)
-    file_location = os.path.join("audio_files", audio_file.filename)
-    logger.info(f"Saving file to {file_location}")
-
     try:
-        with open(file_location, "wb+") as file_object:
-            file_object.write(audio_file.file.read())
+        staged = await storage.stage_upload(audio_file)
+    except storage.UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File too large")
     except Exception as e:
         logger.error(f"Failed to save file: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error while saving file")
+    file_location = storage.blob_path(staged.content_hash)
+    logger.info(f"Saving file {audio_file.filename} to {file_location}")
 
     db_audio_file = AudioFile(
         name=name,
@@ -71,34 +176,77 @@ async def create_audio_file(
         genre=genre,
         key=key,
         bpm=bpm,
-        file_path=file_location
+        file_path=file_location,
+        filename=audio_file.filename,
+        content_hash=staged.content_hash,
+        analysis_status=analysis.PENDING
     )
-    
-    db.add(db_audio_file)
-    db.commit()
-    db.refresh(db_audio_file)
+    # Database and filesystem work are blocking, keep them off the event loop
+    await run_in_threadpool(save_audio_file, db, db_audio_file, staged)
+    response_cache.invalidate(AUDIOS)
+    # Duration, loudness, tempo and key, the renditions and the pre-compressed variants served to
+    # clients accepting them are all written by the analysis workers, never by this request
+    analysis.analysis_queue.submit(db_audio_file.id)
     return {
+        "id": db_audio_file.id,
         "name": db_audio_file.name,
         "author": db_audio_file.author,
         "type": db_audio_file.type,
         "genre": db_audio_file.genre,
         "key": db_audio_file.key,
         "bpm": db_audio_file.bpm,
-        "file_path": db_audio_file.file_path
+        "file_path": db_audio_file.file_path,
+        "filename": db_audio_file.filename,
+        "content_hash": db_audio_file.content_hash,
+        "analysis_status": db_audio_file.analysis_status
     }
 
+# Endpoint to (re-)run the audio analysis over the library in the background
+@router.post("/analyze", response_model=AnalysisQueued)
+def analyze_audio_files(
+    all: bool = Query(False, description="Re-analyze every audio file instead of only those not analyzed yet")
+):
+    try:
+        queued = analysis.analysis_queue.backfill(only_missing=not all)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"queued": queued}
+
+# Endpoint to delete all audio files
+# (declared before /{audio_file_id} so "delete_all" is not taken for an id)
+@router.delete("/delete_all", response_model=Message)
+def delete_all_audio_files(db: Session = Depends(get_database)):
+    # Every blob reference belongs to an audio file, so all blobs go with them
+    content_hashes = [content_hash for (content_hash,) in db.query(AudioBlob.content_hash).all()]
+    db.query(AudioFile).delete()
+    db.query(AudioBlob).update({AudioBlob.ref_count: 0}, synchronize_session=False)
+    db.commit()
+    response_cache.invalidate(AUDIOS)
+    # Each blob is checked again under its row lock, an upload may have referenced it since
+    for content_hash in content_hashes:
+        storage.remove_blob(db, content_hash)
+    return {"message": "All audio files deleted successfully"}
+
 # Endpoint to delete an audio file
-@router.delete("/{audio_file_id}", response_model=dict)
+@router.delete("/{audio_file_id}", response_model=Message)
 def delete_audio_file(audio_file_id: str, db: Session = Depends(get_database)):
     db_audio_file = db.query(AudioFile).filter(AudioFile.id == audio_file_id).first()
     if not db_audio_file:
         raise HTTPException(status_code=404, detail="AudioFile not found")
+    content_hash = db_audio_file.content_hash
+    # Files stored before the blob store existed hold no blob reference
+    in_blob_store = content_hash is not None and db_audio_file.file_path == storage.blob_path(content_hash)
+    last_reference = in_blob_store and storage.release_blob(db, content_hash)
     db.delete(db_audio_file)
     db.commit()
+    response_cache.invalidate(AUDIOS)
+    # The blob is shared by every upload of the same content, remove it with its last reference
+    if last_reference:
+        storage.remove_blob(db, content_hash)
     return {"message": "AudioFile deleted successfully"}
 
 # Endpoint to update an audio file
-@router.put("/{audio_file_id}", response_model=dict)
+@router.put("/{audio_file_id}", response_model=AudioFileOut)
 def update_audio_file(audio_file_id: str, audio_file: AudioFileUpdate, db: Session = Depends(get_database)):
     db_audio_file = db.query(AudioFile).filter(AudioFile.id == audio_file_id).first()
     if not db_audio_file:
@@ -109,6 +257,7 @@ def update_audio_file(audio_file_id: str, audio_file: AudioFileUpdate, db: Sessi
         setattr(db_audio_file, key, value)
     
     db.commit()
+    response_cache.invalidate(AUDIOS)
     db.refresh(db_audio_file)
     return {
         "id": db_audio_file.id,
@@ -118,21 +267,91 @@ def update_audio_file(audio_file_id: str, audio_file: AudioFileUpdate, db: Sessi
         "genre": db_audio_file.genre,
         "key": db_audio_file.key,
         "bpm": db_audio_file.bpm,
-        "file_path": db_audio_file.file_path
+        "file_path": db_audio_file.file_path,
+        "filename": db_audio_file.filename,
+        "content_hash": db_audio_file.content_hash,
+        "duration": db_audio_file.duration,
+        "sample_rate": db_audio_file.sample_rate,
+        "channels": db_audio_file.channels,
+        "loudness": db_audio_file.loudness,
+        "bpm_estimate": db_audio_file.bpm_estimate,
+        "analysis_status": db_audio_file.analysis_status
     }
 
-# Endpoint to download audio file by ID
+def audio_file_metadata(db: Session, criterion) -> Optional[dict]:
+    row = (
+        db.query(AudioFile.file_path, AudioFile.filename, AudioFile.content_hash)
+        .filter(criterion)
+        .first()
+    )
+    return dict(row._mapping) if row else None
+
+def audio_file_response(request: Request, metadata: dict, cache_control: str) -> RangeFileResponse:
+    path = metadata["file_path"]
+    content_hash = metadata["content_hash"]
+    headers = {"cache-control": cache_control, "vary": "Accept-Encoding"}
+    if content_hash:
+        # Files uploaded before content hashing fall back to the mtime/size based ETag
+        headers["etag"] = f'"{content_hash}"'
+    # A pre-compressed variant replaces the whole body, so range requests always get the file itself
+    if content_hash and "range" not in request.headers and path == storage.blob_path(content_hash):
+        sidecars = run_blocking(storage.available_sidecars, content_hash)
+        encoding = negotiate_encoding(request.headers.get("accept-encoding"), sidecars)
+        if encoding is not None:
+            path = storage.sidecar_path(content_hash, encoding)
+            headers["content-encoding"] = encoding
+            # Every representation needs its own ETag
+            headers["etag"] = f'"{content_hash}-{encoding}"'
+    return RangeFileResponse(
+        path=path,
+        filename=metadata["filename"] or os.path.basename(metadata["file_path"]),
+        headers=headers
+    )
+
+# Endpoint to download audio file by ID (supports HTTP Range requests and conditional GET)
 @router.get("/download/{id}")
-def download_audio_file(id: str, db: Session = Depends(get_database)):
-    audio_file = db.query(AudioFile).filter(AudioFile.id == id).first()
-    if audio_file is None:
+def download_audio_file(id: str, request: Request, db: Session = Depends(get_database)):
+    # The file metadata is cached, so repeated downloads (and 304s) skip the database
+    metadata = cached_value([AUDIOS], f"download:{id}", lambda: audio_file_metadata(db, AudioFile.id == id))
+    if metadata is None:
         raise HTTPException(status_code=404, detail="AudioFile not found")
-    return FileResponse(path=audio_file.file_path, filename=os.path.basename(audio_file.file_path))
+    return audio_file_response(request, metadata, REVALIDATE_CACHE_CONTROL)
 
+# Endpoint to download audio file by content hash, cacheable forever
+@router.get("/blob/{content_hash}")
+def download_audio_blob(content_hash: str, request: Request, db: Session = Depends(get_database)):
+    metadata = None
+    if CONTENT_HASH_PATTERN.match(content_hash):
+        metadata = cached_value(
+            [AUDIOS], f"blob:{content_hash}", lambda: audio_file_metadata(db, AudioFile.content_hash == content_hash)
+        )
+    if metadata is None:
+        raise HTTPException(status_code=404, detail="AudioFile not found")
+    return audio_file_response(request, metadata, IMMUTABLE_CACHE_CONTROL)
 
-# Endpoint to delete all audio files
-@router.delete("/delete_all", response_model=dict)
-def delete_all_audio_files(db: Session = Depends(get_database)):
-    db.query(AudioFile).delete()
-    db.commit()
-    return {"message": "All audio files deleted successfully"}
\ No newline at end of file
+def rendition_response(db: Session, id: str, name: str) -> RangeFileResponse:
+    metadata = cached_value([AUDIOS], f"download:{id}", lambda: audio_file_metadata(db, AudioFile.id == id))
+    if metadata is None:
+        raise HTTPException(status_code=404, detail="AudioFile not found")
+    content_hash = metadata["content_hash"]
+    # Renditions are written next to the blob by the analysis workers
+    path = storage.rendition_path(content_hash, name) if content_hash else None
+    if path is None or metadata["file_path"] != storage.blob_path(content_hash) or not run_blocking(os.path.exists, path):
+        raise HTTPException(status_code=404, detail=f"No {name} available for this audio file (yet)")
+    media_type = renditions.PEAKS_MEDIA_TYPE if name == "peaks" else run_blocking(renditions.preview_media_type, path)
+    return RangeFileResponse(
+        path=path,
+        media_type=media_type,
+        headers={"cache-control": RENDITION_CACHE_CONTROL, "etag": f'"{content_hash}-{name}"'}
+    )
+
+# Endpoint to get the waveform peaks of an audio file: signed 8 bit (min, max) pairs, one per
+# bucket of the file, interleaved (see renditions.py)
+@router.get("/peaks/{id}")
+def get_audio_peaks(id: str, db: Session = Depends(get_database)):
+    return rendition_response(db, id, "peaks")
+
+# Endpoint to get a short low bitrate preview of an audio file, MP3 (supports HTTP Range requests)
+@router.get("/preview/{id}")
+def get_audio_preview(id: str, db: Session = Depends(get_database)):
+    return rendition_response(db, id, "preview")
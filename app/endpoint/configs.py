@@ -1,19 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from loguru import logger
 from pydantic import BaseModel, Field
-from sqlalchemy.orm import Session
+from sqlalchemy import insert
+from sqlalchemy.orm import Session, joinedload, selectinload
 from typing import List, Optional
-from database import SessionLocal
-from models import Config, AudioFile, ConfigAudio
+from datetime import datetime
+from database import DatabaseRoute, get_database
+from models import Config, AudioFile, ConfigAudio, Track, Event, Action
+from endpoint.audios import AudioFileOut
+from endpoint.tracks import TrackCreate, TrackOut
+from endpoint.events import EventCreate, EventOut
+from endpoint.actions import ActionCreate, ActionOut
+from cache import ACTIONS, AUDIOS, CONFIGS, EVENTS, GRAPH, TRACKS, cached, response_cache
+from listing import ListParams, export_rows, fetch_page, model_fields, parse_fields, row_model
+from responses import Message, RangeFileResponse
+from config import setting
+import render
 
-router = APIRouter(prefix="/api/configs", tags=["Configs"])
+router = APIRouter(prefix="/api/configs", tags=["Configs"], route_class=DatabaseRoute)
 
-# Dependency to get a database session
-def get_database():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# A render URL stays the same while the config changes: clients revalidate (cheap, the ETag is the
+# plan hash) on every use
+RENDER_CACHE_CONTROL = "no-cache"
 
 # Pydantic model for Config
 class ConfigCreate(BaseModel):
@@ -32,26 +42,346 @@ class ConfigUpdate(BaseModel):
     labels: Optional[str] = None
     audio_ids: Optional[List[int]] = None
 
-# Endpoint to list all configs
-@router.get("/list", response_model=List[dict])
-def list_configs(db: Session = Depends(get_database)):
-    configs_list = db.query(Config).all()
-    return [
-        {
-            "id": config.id,
-            "name": config.name,
-            "author": config.author,
-            "interaction_type": config.interaction_type,
-            "bpm": config.bpm,
-            "create_time": config.create_time,
-            "labels": config.labels,
-            "audios": [{"id": audio.audio_file.id, "name": audio.audio_file.name} for audio in config.audios]
-        } for config in configs_list
-    ]
+# Pydantic models for a complete config document (import/export);
+# parent ids are implied by the nesting
+class ActionDocument(ActionCreate):
+    event_id: Optional[int] = None
+
+class EventDocument(EventCreate):
+    track_id: Optional[int] = None
+    actions: List[ActionDocument] = Field(default=[])
+
+class TrackDocument(TrackCreate):
+    config_id: Optional[str] = None
+    events: List[EventDocument] = Field(default=[])
+
+class ConfigDocument(ConfigCreate):
+    tracks: List[TrackDocument] = Field(default=[])
+
+# Pydantic models for Config responses
+class AudioSummary(BaseModel):
+    id: int
+    name: str
+
+class ConfigOut(BaseModel):
+    id: int
+    name: str
+    author: Optional[str] = None
+    interaction_type: Optional[str] = None
+    bpm: Optional[int] = None
+    create_time: Optional[datetime] = None
+    labels: Optional[str] = None
+    audios: List[AudioSummary] = Field(default=[])
+
+# Pydantic models for a config graph (a config with everything below it)
+class EventGraph(EventOut):
+    actions: List[ActionOut]
+
+class TrackGraph(TrackOut):
+    events: List[EventGraph]
+
+class ConfigGraph(ConfigOut):
+    audios: List[AudioFileOut]
+    tracks: List[TrackGraph]
+
+def check_audio_ids(db: Session, audio_ids: List[int]):
+    # One query for all ids, before anything is written
+    found = {audio_id for (audio_id,) in db.query(AudioFile.id).filter(AudioFile.id.in_(audio_ids))}
+    for audio_id in audio_ids:
+        if audio_id not in found:
+            raise HTTPException(status_code=404, detail=f"AudioFile ID {audio_id} not found")
+
+LIST_FIELDS = ["id", "name", "author", "interaction_type", "bpm", "create_time", "labels", "audios"]
+
+def attach_audios(db: Session, configs_list: List[dict]):
+    # The audios of a whole page come from a single query instead of one lazy load per config
+    if not configs_list:
+        return
+    audios_by_config = {config["id"]: [] for config in configs_list}
+    config_audios = (
+        db.query(ConfigAudio.config_id, AudioFile.id, AudioFile.name)
+        .join(AudioFile, ConfigAudio.audio_id == AudioFile.id)
+        .filter(ConfigAudio.config_id.in_(audios_by_config))
+        .order_by(ConfigAudio.config_id, AudioFile.id)
+    )
+    for config_id, audio_id, audio_name in config_audios:
+        audios_by_config[config_id].append({"id": audio_id, "name": audio_name})
+    for config in configs_list:
+        config["audios"] = audios_by_config[config["id"]]
+
+# Pydantic model for Config list rows; fields= may select any subset of the ConfigOut fields
+ConfigRow = row_model(ConfigOut)
+
+# Endpoint to list configs (paginated, see listing.py)
+@router.get("/list", response_model=List[ConfigRow], response_model_exclude_unset=True)
+@cached(CONFIGS, AUDIOS)
+def list_configs(
+    response: Response,
+    params: ListParams = Depends(),
+    interaction_type: Optional[str] = Query(None, description="Only configs with this interaction type"),
+    author: Optional[str] = Query(None, description="Only configs by this author"),
+    bpm_min: Optional[int] = Query(None, description="Lowest BPM, inclusive"),
+    bpm_max: Optional[int] = Query(None, description="Highest BPM, inclusive"),
+    db: Session = Depends(get_database)
+):
+    columns = parse_fields(params.fields, model_fields(Config) + ["audios"], LIST_FIELDS)
+    criteria = []
+    if interaction_type is not None:
+        criteria.append(Config.interaction_type == interaction_type)
+    if author is not None:
+        criteria.append(Config.author == author)
+    if bpm_min is not None:
+        criteria.append(Config.bpm >= bpm_min)
+    if bpm_max is not None:
+        criteria.append(Config.bpm <= bpm_max)
+    enrich = attach_audios if "audios" in columns else None
+    if params.format:
+        return export_rows(Config, columns, criteria, params, enrich=enrich)
+    configs_list = fetch_page(db, Config, [column for column in columns if column != "audios"], criteria, params, response)
+    if enrich is not None:
+        enrich(db, configs_list)
+    return configs_list
+
+def load_config_graph(db: Session, config_id: int) -> Optional[Config]:
+    # Every level is eager loaded with its own IN query, so the whole tree takes
+    # five SELECTs no matter how many audios, tracks, events or actions it has
+    return (
+        db.query(Config)
+        .options(
+            selectinload(Config.audios).joinedload(ConfigAudio.audio_file),
+            selectinload(Config.tracks).selectinload(Track.events).selectinload(Event.actions),
+        )
+        .filter(Config.id == config_id)
+        .first()
+    )
+
+def config_graph_to_dict(config: Config) -> dict:
+    return {
+        "id": config.id,
+        "name": config.name,
+        "author": config.author,
+        "interaction_type": config.interaction_type,
+        "bpm": config.bpm,
+        "create_time": config.create_time,
+        "labels": config.labels,
+        "audios": [
+            {
+                "id": audio.audio_file.id,
+                "name": audio.audio_file.name,
+                "author": audio.audio_file.author,
+                "type": audio.audio_file.type,
+                "genre": audio.audio_file.genre,
+                "key": audio.audio_file.key,
+                "bpm": audio.audio_file.bpm,
+                "file_path": audio.audio_file.file_path,
+                "filename": audio.audio_file.filename,
+                "content_hash": audio.audio_file.content_hash,
+                "duration": audio.audio_file.duration,
+                "sample_rate": audio.audio_file.sample_rate,
+                "channels": audio.audio_file.channels,
+                "loudness": audio.audio_file.loudness,
+                "bpm_estimate": audio.audio_file.bpm_estimate,
+                "analysis_status": audio.audio_file.analysis_status
+            } for audio in sorted(config.audios, key=lambda audio: audio.audio_id)
+        ],
+        "tracks": [
+            {
+                "id": track.id,
+                "config_id": track.config_id,
+                "name": track.name,
+                "type": track.type,
+                "loop": track.loop,
+                "decay": track.decay,
+                "initial_gain": track.initial_gain,
+                "track_initial_gain": track.track_initial_gain,
+                "track_gain_node": track.track_gain_node,
+                "effect_nodes": track.effect_nodes,
+                "events": [
+                    {
+                        "id": event.id,
+                        "track_id": event.track_id,
+                        "type": event.type,
+                        "actions": [
+                            {
+                                "id": action.id,
+                                "event_id": action.event_id,
+                                "target": action.target,
+                                "property": action.property,
+                                "method": action.method,
+                                "value": action.value,
+                                "end_time": action.end_time
+                            } for action in sorted(event.actions, key=lambda action: action.id)
+                        ]
+                    } for event in sorted(track.events, key=lambda event: event.id)
+                ]
+            } for track in sorted(config.tracks, key=lambda track: track.id)
+        ]
+    }
+
+# Endpoint to get a config with its audios, tracks, events and actions in one response
+@router.get("/{config_id}/graph", response_model=ConfigGraph)
+@cached(*GRAPH)
+def get_config_graph(config_id: int, db: Session = Depends(get_database)):
+    db_config = load_config_graph(db, config_id)
+    if not db_config:
+        raise HTTPException(status_code=404, detail="Config not found")
+    return config_graph_to_dict(db_config)
+
+def import_config_document(db: Session, document: ConfigDocument) -> int:
+    """
+    Insert a config and its audio associations, tracks, events and actions in one transaction.
+
+    Each level is written with one multi-row INSERT ... RETURNING whose ids (returned in
+    parameter order) become the parent ids of the next level. Nothing is committed if any
+    statement fails.
+    """
+    check_audio_ids(db, document.audio_ids)
+    db_config = Config(
+        name=document.name,
+        author=document.author,
+        interaction_type=document.interaction_type,
+        bpm=document.bpm,
+        labels=document.labels
+    )
+    db.add(db_config)
+    db.flush()
+
+    if document.audio_ids:
+        db.execute(
+            insert(ConfigAudio),
+            [{"config_id": db_config.id, "audio_id": audio_id} for audio_id in dict.fromkeys(document.audio_ids)]
+        )
+
+    if document.tracks:
+        track_ids = db.execute(
+            insert(Track).returning(Track.id, sort_by_parameter_order=True),
+            [{**track.dict(exclude={"events"}), "config_id": db_config.id} for track in document.tracks]
+        ).scalars().all()
+        events = [(track_id, event) for track_id, track in zip(track_ids, document.tracks) for event in track.events]
+        if events:
+            event_ids = db.execute(
+                insert(Event).returning(Event.id, sort_by_parameter_order=True),
+                [{**event.dict(exclude={"actions"}), "track_id": track_id} for track_id, event in events]
+            ).scalars().all()
+            actions = [
+                {**action.dict(), "event_id": event_id}
+                for event_id, (_, event) in zip(event_ids, events) for action in event.actions
+            ]
+            if actions:
+                db.execute(insert(Action), actions)
+
+    db.commit()
+    response_cache.invalidate(CONFIGS, TRACKS, EVENTS, ACTIONS)
+    return db_config.id
+
+def config_graph_to_document(config: Config) -> dict:
+    # Same shape as ConfigDocument, so an export can be imported again as is
+    graph = config_graph_to_dict(config)
+    return {
+        "name": graph["name"],
+        "author": graph["author"],
+        "interaction_type": graph["interaction_type"],
+        "bpm": graph["bpm"],
+        "labels": graph["labels"],
+        "audio_ids": [audio["id"] for audio in graph["audios"]],
+        "tracks": [
+            {
+                **{key: value for key, value in track.items() if key not in ("id", "config_id", "events")},
+                "events": [
+                    {
+                        "type": event["type"],
+                        "actions": [
+                            {key: value for key, value in action.items() if key not in ("id", "event_id")}
+                            for action in event["actions"]
+                        ]
+                    } for event in track["events"]
+                ]
+            } for track in graph["tracks"]
+        ]
+    }
+
+# Endpoint to create a complete config (audios, tracks, events and actions) from one document
+@router.post("/import", response_model=ConfigGraph)
+def import_config(document: ConfigDocument, db: Session = Depends(get_database)):
+    config_id = import_config_document(db, document)
+    return config_graph_to_dict(load_config_graph(db, config_id))
+
+# Endpoint to export a config as a document accepted by /import
+@router.get("/{config_id}/export", response_model=ConfigDocument, response_model_exclude_unset=True)
+def export_config(config_id: int, db: Session = Depends(get_database)):
+    db_config = load_config_graph(db, config_id)
+    if not db_config:
+        raise HTTPException(status_code=404, detail="Config not found")
+    return config_graph_to_document(db_config)
+
+def load_render_graph(db: Session, config_id: int) -> Optional[dict]:
+    db_config = load_config_graph(db, config_id)
+    return config_graph_to_dict(db_config) if db_config else None
+
+class _ReleasesMix:
+    # Unpins the mix (see MixRenderer.release) once the response was sent, failed or the client left
+    def __init__(self, key: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key = key
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            render.mix_renderer.release(self.key)
+
+class MixFileResponse(_ReleasesMix, RangeFileResponse):
+    pass
+
+class MixStreamingResponse(_ReleasesMix, StreamingResponse):
+    pass
+
+# Endpoint to render a config into one mixed WAV on the server (see render.py). The response
+# streams while the mix is rendered; finished mixes are cached and support HTTP Range requests
+@router.get("/{config_id}/render")
+async def render_config(
+    config_id: int,
+    duration: float = Query(60, gt=0, le=setting.render_max_seconds, description="Length of the mix in seconds"),
+    event: Optional[List[str]] = Query(None, description="Event types whose actions are applied (default: all)"),
+    db: Session = Depends(get_database)
+):
+    # Database work is blocking, keep it off the event loop
+    graph = await run_in_threadpool(load_render_graph, db, config_id)
+    if graph is None:
+        raise HTTPException(status_code=404, detail="Config not found")
+    try:
+        plan = render.build_plan(graph, duration, event)
+    except render.RenderError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    key = render.plan_hash(plan)
+    headers = {"cache-control": RENDER_CACHE_CONTROL, "etag": f'"{key}"'}
+    # The mix stays pinned in the render cache until its response is done
+    path = await run_in_threadpool(render.mix_renderer.cached, key)
+    if path is not None:
+        return MixFileResponse(key, path=path, media_type=render.MEDIA_TYPE, headers=headers)
+    try:
+        job = render.mix_renderer.submit(key, plan)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    # Errors before the first block (e.g. an undecodable audio file) still get a proper status
+    file = None
+    try:
+        file = await job.first_block()
+    except Exception as e:
+        logger.error(f"Failed to render config {config_id}: {e}")
+        raise HTTPException(status_code=500, detail="Internal Server Error while rendering the config")
+    finally:
+        # Also when the client left while waiting, which cancels the request
+        if file is None:
+            render.mix_renderer.release(key)
+    return MixStreamingResponse(
+        key, job.stream(file), media_type=render.MEDIA_TYPE, headers={**headers, "content-length": str(job.size)}
+    )
 
 # Endpoint to create a new config
-@router.post("/", response_model=dict)
+@router.post("/", response_model=ConfigOut)
 def create_config(config: ConfigCreate, db: Session = Depends(get_database)):
+    check_audio_ids(db, config.audio_ids)
     db_config = Config(
         name=config.name,
         author=config.author,
@@ -59,19 +389,11 @@ def create_config(config: ConfigCreate, db: Session = Depends(get_database)):
         bpm=config.bpm,
         labels=config.labels
     )
-    db.add(db_config)
-    db.commit()
-    db.refresh(db_config)
-
     # Add the audio files associations
-    for audio_id in config.audio_ids:
-        audio_file = db.query(AudioFile).filter(AudioFile.id == audio_id).first()
-        if not audio_file:
-            raise HTTPException(status_code=404, detail=f"AudioFile ID {audio_id} not found")
-        config_audio = ConfigAudio(config_id=db_config.id, audio_id=audio_id)
-        db.add(config_audio)
-
+    db_config.audios = [ConfigAudio(audio_id=audio_id) for audio_id in dict.fromkeys(config.audio_ids)]
+    db.add(db_config)
     db.commit()
+    response_cache.invalidate(CONFIGS)
     db.refresh(db_config)
 
     return {
@@ -86,7 +408,7 @@ def create_config(config: ConfigCreate, db: Session = Depends(get_database)):
     }
 
 # Endpoint to delete a config
-@router.delete("/{config_id}", response_model=dict)
+@router.delete("/{config_id}", response_model=Message)
 def delete_config(config_id: int, db: Session = Depends(get_database)):
     db_config = db.query(Config).filter(Config.id == config_id).first()
     if not db_config:
@@ -94,32 +416,30 @@ def delete_config(config_id: int, db: Session = Depends(get_database)):
     db.query(ConfigAudio).filter(ConfigAudio.config_id == config_id).delete()
     db.delete(db_config)
     db.commit()
+    response_cache.invalidate(CONFIGS)
     return {"message": "Config deleted successfully"}
 
 # Endpoint to update a config
-@router.put("/{config_id}", response_model=dict)
+@router.put("/{config_id}", response_model=ConfigOut)
 def update_config(config_id: int, config: ConfigUpdate, db: Session = Depends(get_database)):
     db_config = db.query(Config).filter(Config.id == config_id).first()
     if not db_config:
         raise HTTPException(status_code=404, detail="Config not found")
     
-    update_data = config.dict(exclude_unset=True)
+    if config.audio_ids is not None:
+        check_audio_ids(db, config.audio_ids)
+
+    update_data = config.dict(exclude_unset=True, exclude={"audio_ids"})
     for key, value in update_data.items():
         setattr(db_config, key, value)
-    
-    db.commit()
 
     # Update the audio files associations
     if config.audio_ids is not None:
         db.query(ConfigAudio).filter(ConfigAudio.config_id == config_id).delete()
-        for audio_id in config.audio_ids:
-            audio_file = db.query(AudioFile).filter(AudioFile.id == audio_id).first()
-            if not audio_file:
-                raise HTTPException(status_code=404, detail=f"AudioFile ID {audio_id} not found")
-            config_audio = ConfigAudio(config_id=db_config.id, audio_id=audio_id)
-            db.add(config_audio)
+        db.add_all([ConfigAudio(config_id=db_config.id, audio_id=audio_id) for audio_id in dict.fromkeys(config.audio_ids)])
 
     db.commit()
+    response_cache.invalidate(CONFIGS)
     db.refresh(db_config)
 
     return {
@@ -134,8 +454,9 @@ def update_config(config_id: int, config: ConfigUpdate, db: Session = Depends(ge
     }
 
 # Endpoint to delete all configs
-@router.delete("/delete_all", response_model=dict)
+@router.delete("/delete_all", response_model=Message)
 def delete_all_configs(db: Session = Depends(get_database)):
     db.query(Config).delete()
     db.commit()
+    response_cache.invalidate(CONFIGS)
     return {"message": "All configs deleted successfully"}
\ No newline at end of file
@@ -1,19 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from database import SessionLocal
+from database import DatabaseRoute, get_database
 from models import Event, Track
+from bulk import BulkCreateResult, BulkDelete, BulkDeleteResult, BulkUpdateResult, bulk_create, bulk_delete, bulk_update
+from cache import EVENTS, response_cache
+from listing import ListParams, export_rows, fetch_page, model_fields, parse_fields, row_model
+from responses import Message
 
-router = APIRouter(prefix="/api/events", tags=["Events"])
-
-# Dependency to get a database session
-def get_database():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+router = APIRouter(prefix="/api/events", tags=["Events"], route_class=DatabaseRoute)
 
 # Pydantic model for Event
 class EventCreate(BaseModel):
@@ -24,14 +20,42 @@ class EventUpdate(BaseModel):
     track_id: Optional[int] = None
     type: Optional[str] = None
 
-# Endpoint to list all events
-@router.get("/list", response_model=List[dict])
-def list_events(db: Session = Depends(get_database)):
-    events_list = db.query(Event).all()
-    return [{"id": event.id, "track_id": event.track_id, "type": event.type} for event in events_list]
+class EventBulkUpdate(EventUpdate):
+    id: int
+
+# Pydantic models for Event responses
+class EventOut(BaseModel):
+    id: int
+    track_id: Optional[int] = None
+    type: str
+
+class EventCreated(EventOut):
+    index: int
+
+# Pydantic model for Event list rows; fields= may select any subset of the EventOut fields
+EventRow = row_model(EventOut)
+
+# Endpoint to list events (paginated, see listing.py)
+@router.get("/list", response_model=List[EventRow], response_model_exclude_unset=True)
+def list_events(
+    response: Response,
+    params: ListParams = Depends(),
+    track_id: Optional[int] = Query(None, description="Only events of this track"),
+    type: Optional[str] = Query(None, description="Only events of this type"),
+    db: Session = Depends(get_database)
+):
+    columns = parse_fields(params.fields, model_fields(Event), model_fields(Event))
+    criteria = []
+    if track_id is not None:
+        criteria.append(Event.track_id == track_id)
+    if type is not None:
+        criteria.append(Event.type == type)
+    if params.format:
+        return export_rows(Event, columns, criteria, params)
+    return fetch_page(db, Event, columns, criteria, params, response)
 
 # Endpoint to create a new event
-@router.post("/", response_model=dict)
+@router.post("/", response_model=EventOut)
 def create_event(event: EventCreate, db: Session = Depends(get_database)):
     # Check if the Track id exists in the database
     config = db.query(Track).filter(Track.id == event.track_id).first()
@@ -44,21 +68,42 @@ def create_event(event: EventCreate, db: Session = Depends(get_database)):
     )
     db.add(db_event)
     db.commit()
+    response_cache.invalidate(EVENTS)
     db.refresh(db_event)
     return {"id": db_event.id, "track_id": db_event.track_id, "type": db_event.type}
 
+# Endpoints to create, update and delete many events in one request (see bulk.py)
+@router.post("/bulk", response_model=BulkCreateResult[EventCreated])
+def create_events(events: List[EventCreate], db: Session = Depends(get_database)):
+    result = bulk_create(db, Event, [event.dict() for event in events], Track, "track_id")
+    response_cache.invalidate(EVENTS)
+    return result
+
+@router.put("/bulk", response_model=BulkUpdateResult)
+def update_events(events: List[EventBulkUpdate], db: Session = Depends(get_database)):
+    result = bulk_update(db, Event, [event.dict(exclude_unset=True) for event in events], Track, "track_id")
+    response_cache.invalidate(EVENTS)
+    return result
+
+@router.post("/bulk/delete", response_model=BulkDeleteResult)
+def delete_events(body: BulkDelete, db: Session = Depends(get_database)):
+    result = bulk_delete(db, Event, body.ids)
+    response_cache.invalidate(EVENTS)
+    return result
+
 # Endpoint to delete an event
-@router.delete("/{event_id}", response_model=dict)
+@router.delete("/{event_id}", response_model=Message)
 def delete_event(event_id: int, db: Session = Depends(get_database)):
     db_event = db.query(Event).filter(Event.id == event_id).first()
     if not db_event:
         raise HTTPException(status_code=404, detail="Event not found")
     db.delete(db_event)
     db.commit()
+    response_cache.invalidate(EVENTS)
     return {"message": "Event deleted successfully"}
 
 # Endpoint to update an event
-@router.put("/{event_id}", response_model=dict)
+@router.put("/{event_id}", response_model=EventOut)
 def update_event(event_id: int, event: EventUpdate, db: Session = Depends(get_database)):
     db_event = db.query(Event).filter(Event.id == event_id).first()
     if not db_event:
@@ -69,12 +114,14 @@ def update_event(event_id: int, event: EventUpdate, db: Session = Depends(get_da
         setattr(db_event, key, value)
     
     db.commit()
+    response_cache.invalidate(EVENTS)
     db.refresh(db_event)
     return {"id": db_event.id, "track_id": db_event.track_id, "type": db_event.type}
 
 # Endpoint to delete all events
-@router.delete("/delete_all", response_model=dict)
+@router.delete("/delete_all", response_model=Message)
 def delete_all_events(db: Session = Depends(get_database)):
     db.query(Event).delete()
     db.commit()
+    response_cache.invalidate(EVENTS)
     return {"message": "All events deleted successfully"}
\ No newline at end of file
@@ -0,0 +1,9 @@
+from fastapi import APIRouter, Response
+from metrics import CONTENT_TYPE, render_metrics
+
+router = APIRouter(tags=["Stats"])
+
+# Endpoint to scrape the request and SQL metrics of this worker in the Prometheus text format
+@router.get("/metrics", response_class=Response)
+def get_metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
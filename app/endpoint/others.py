@@ -1,21 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from typing import List
-from database import SessionLocal
+from database import DatabaseRoute, get_database
 from models import *
+from cache import ACTIONS, AUDIOS, CONFIGS, EVENTS, TRACKS, cached
 
-router = APIRouter(prefix="/api/others", tags=["Others"])
-
-# Dependency to get a database session
-def get_database():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+router = APIRouter(prefix="/api/others", tags=["Others"], route_class=DatabaseRoute)
 
 # 抓到指定config底下所有audio id
 @router.get("/{config_id}/audios", response_model=List[int])
+@cached(CONFIGS)
 def get_audio_ids_by_config(config_id: int, db: Session = Depends(get_database)):
     try:
         config = db.query(Config).filter(Config.id == config_id).first()
@@ -28,6 +22,7 @@ def get_audio_ids_by_config(config_id: int, db: Session = Depends(get_database))
 
 # audio由指定type一次抓出所有那個類型的index
 @router.get("/audios/type/{audio_type}", response_model=List[int])
+@cached(AUDIOS)
 def get_audio_ids_by_type(audio_type: str, db: Session = Depends(get_database)):
     try:
         audio_files = db.query(AudioFile).filter(AudioFile.type == audio_type).all()
@@ -40,6 +35,7 @@ def get_audio_ids_by_type(audio_type: str, db: Session = Depends(get_database)):
 
 # 用指定interaction_type去抓出那幾個config
 @router.get("/interaction_type/{interaction_type}", response_model=List[int])
+@cached(CONFIGS)
 def get_configs_by_interaction_type(interaction_type: str, db: Session = Depends(get_database)):
     try:
         configs = db.query(Config).filter(Config.interaction_type == interaction_type).all()
@@ -52,6 +48,7 @@ def get_configs_by_interaction_type(interaction_type: str, db: Session = Depends
 
 # 抓取指定track底下所有event
 @router.get("/{track_id}/events", response_model=List[int])
+@cached(TRACKS, EVENTS)
 def get_events_by_track(track_id: int, db: Session = Depends(get_database)):
     try:
         track = db.query(Track).filter(Track.id == track_id).first()
@@ -64,6 +61,7 @@ def get_events_by_track(track_id: int, db: Session = Depends(get_database)):
 
 # 抓取指定event底下所有action
 @router.get("/events/{event_id}/actions", response_model=List[int])
+@cached(EVENTS, ACTIONS)
 def get_actions_by_event(event_id: int, db: Session = Depends(get_database)):
     try:
         event = db.query(Event).filter(Event.id == event_id).first()
@@ -76,6 +74,7 @@ def get_actions_by_event(event_id: int, db: Session = Depends(get_database)):
 
 # 抓取指定genre的所有audio
 @router.get("/audios/genre/{genre}", response_model=List[int])
+@cached(AUDIOS)
 def get_audio_ids_by_genre(genre: str, db: Session = Depends(get_database)):
     try:
         audio_files = db.query(AudioFile).filter(AudioFile.genre == genre).all()
@@ -0,0 +1,27 @@
+from fastapi import APIRouter
+from cache import response_cache
+from database import pool_stats
+from analysis import analysis_queue
+from render import mix_renderer
+
+router = APIRouter(prefix="/api/stats", tags=["Stats"])
+
+# Endpoint to get the read cache hit/miss counters
+@router.get("/cache", response_model=dict)
+def get_cache_stats():
+    return response_cache.stats()
+
+# Endpoint to get the connection pool checkout wait times and saturation
+@router.get("/pool", response_model=dict)
+def get_pool_stats():
+    return pool_stats()
+
+# Endpoint to get the background audio analysis queue and counters
+@router.get("/analysis", response_model=dict)
+def get_analysis_stats():
+    return analysis_queue.stats()
+
+# Endpoint to get the mixdown renderer counters
+@router.get("/render", response_model=dict)
+def get_render_stats():
+    return mix_renderer.stats()
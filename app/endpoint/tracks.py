@@ -1,19 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from database import SessionLocal
+from database import DatabaseRoute, get_database
 from models import Config, Track
+from bulk import BulkCreateResult, BulkDelete, BulkDeleteResult, BulkUpdateResult, bulk_create, bulk_delete, bulk_update
+from cache import TRACKS, response_cache
+from listing import ListParams, export_rows, fetch_page, model_fields, parse_fields, row_model
+from responses import Message
 
-router = APIRouter(prefix="/api/tracks", tags=["Tracks"])
-
-# Dependency to get a database session
-def get_database():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+router = APIRouter(prefix="/api/tracks", tags=["Tracks"], route_class=DatabaseRoute)
 
 # Pydantic model for Track
 class TrackCreate(BaseModel):
@@ -38,27 +34,49 @@ class TrackUpdate(BaseModel):
     track_gain_node: Optional[dict] = None
     effect_nodes: Optional[dict] = None
 
-# Endpoint to list all tracks
-@router.get("/list", response_model=List[dict])
-def list_tracks(db: Session = Depends(get_database)):
-    tracks_list = db.query(Track).all()
-    return [
-        {
-            "id": track.id,
-            "config_id": track.config_id,
-            "name": track.name,
-            "type": track.type,
-            "loop": track.loop,
-            "decay": track.decay,
-            "initial_gain": track.initial_gain,
-            "track_initial_gain": track.track_initial_gain,
-            "track_gain_node": track.track_gain_node,
-            "effect_nodes": track.effect_nodes
-        } for track in tracks_list
-    ]
+class TrackBulkUpdate(TrackUpdate):
+    id: int
+
+# Pydantic models for Track responses
+class TrackOut(BaseModel):
+    id: int
+    config_id: Optional[int] = None
+    name: str
+    type: str
+    loop: Optional[bool] = None
+    decay: Optional[bool] = None
+    initial_gain: Optional[float] = None
+    track_initial_gain: Optional[float] = None
+    track_gain_node: Optional[dict] = None
+    effect_nodes: Optional[dict] = None
+
+class TrackCreated(TrackOut):
+    index: int
+
+# Pydantic model for Track list rows; fields= may select any subset of the TrackOut fields
+TrackRow = row_model(TrackOut)
+
+# Endpoint to list tracks (paginated, see listing.py)
+@router.get("/list", response_model=List[TrackRow], response_model_exclude_unset=True)
+def list_tracks(
+    response: Response,
+    params: ListParams = Depends(),
+    config_id: Optional[int] = Query(None, description="Only tracks of this config"),
+    type: Optional[str] = Query(None, description="Only tracks of this type"),
+    db: Session = Depends(get_database)
+):
+    columns = parse_fields(params.fields, model_fields(Track), model_fields(Track))
+    criteria = []
+    if config_id is not None:
+        criteria.append(Track.config_id == config_id)
+    if type is not None:
+        criteria.append(Track.type == type)
+    if params.format:
+        return export_rows(Track, columns, criteria, params)
+    return fetch_page(db, Track, columns, criteria, params, response)
 
 # Endpoint to create a new track
-@router.post("/", response_model=dict)
+@router.post("/", response_model=TrackOut)
 def create_track(track: TrackCreate, db: Session = Depends(get_database)):
     # Check if the config_id exists in the database
     config = db.query(Config).filter(Config.id == track.config_id).first()
@@ -78,6 +96,7 @@ def create_track(track: TrackCreate, db: Session = Depends(get_database)):
     )
     db.add(db_track)
     db.commit()
+    response_cache.invalidate(TRACKS)
     db.refresh(db_track)
     return {
         "id": db_track.id,
@@ -92,18 +111,38 @@ def create_track(track: TrackCreate, db: Session = Depends(get_database)):
         "effect_nodes": db_track.effect_nodes
     }
 
+# Endpoints to create, update and delete many tracks in one request (see bulk.py)
+@router.post("/bulk", response_model=BulkCreateResult[TrackCreated])
+def create_tracks(tracks: List[TrackCreate], db: Session = Depends(get_database)):
+    result = bulk_create(db, Track, [track.dict() for track in tracks], Config, "config_id")
+    response_cache.invalidate(TRACKS)
+    return result
+
+@router.put("/bulk", response_model=BulkUpdateResult)
+def update_tracks(tracks: List[TrackBulkUpdate], db: Session = Depends(get_database)):
+    result = bulk_update(db, Track, [track.dict(exclude_unset=True) for track in tracks], Config, "config_id")
+    response_cache.invalidate(TRACKS)
+    return result
+
+@router.post("/bulk/delete", response_model=BulkDeleteResult)
+def delete_tracks(body: BulkDelete, db: Session = Depends(get_database)):
+    result = bulk_delete(db, Track, body.ids)
+    response_cache.invalidate(TRACKS)
+    return result
+
 # Endpoint to delete a track
-@router.delete("/{track_id}", response_model=dict)
+@router.delete("/{track_id}", response_model=Message)
 def delete_track(track_id: int, db: Session = Depends(get_database)):
     db_track = db.query(Track).filter(Track.id == track_id).first()
     if not db_track:
         raise HTTPException(status_code=404, detail="Track not found")
     db.delete(db_track)
     db.commit()
+    response_cache.invalidate(TRACKS)
     return {"message": "Track deleted successfully"}
 
 # Endpoint to update a track
-@router.put("/{track_id}", response_model=dict)
+@router.put("/{track_id}", response_model=TrackOut)
 def update_track(track_id: int, track: TrackUpdate, db: Session = Depends(get_database)):
     db_track = db.query(Track).filter(Track.id == track_id).first()
     if not db_track:
@@ -114,6 +153,7 @@ def update_track(track_id: int, track: TrackUpdate, db: Session = Depends(get_da
         setattr(db_track, key, value)
     
     db.commit()
+    response_cache.invalidate(TRACKS)
     db.refresh(db_track)
     return {
         "id": db_track.id,
@@ -129,8 +169,9 @@ def update_track(track_id: int, track: TrackUpdate, db: Session = Depends(get_da
     }
 
 # Endpoint to delete all tracks
-@router.delete("/delete_all", response_model=dict)
+@router.delete("/delete_all", response_model=Message)
 def delete_all_tracks(db: Session = Depends(get_database)):
     db.query(Track).delete()
     db.commit()
+    response_cache.invalidate(TRACKS)
     return {"message": "All tracks deleted successfully"}
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+Gunicorn settings for production: one uvicorn worker process per CPU core, on uvloop and httptools.
+
+Run from the app directory after the one-shot startup step (see prestart.py):
+
+    pipenv run gunicorn -c gunicorn_conf.py main:app
+
+The values come from the ``server_*`` settings in config.py. The app is imported once in the
+master before the workers are forked (``preload_app``), so workers start quickly and a broken app
+fails the start instead of every worker; per-process resources (cache connections, the analysis
+pool) are started by each worker's lifespan, and database connections are never shared. With
+several workers the read cache must be shared, so ``cache_backend`` "auto" becomes redis.
+"""
+import os
+from uvicorn.workers import UvicornWorker
+from config import setting
+
+# Seconds of the graceful timeout kept for the lifespan shutdown (analysis pool, log flush)
+# after in-flight requests had their chance to finish
+SHUTDOWN_MARGIN = 5
+
+
+class ProductionWorker(UvicornWorker):
+    """Uvicorn worker on uvloop and httptools that stops waiting for open requests before gunicorn kills it."""
+
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - SHUTDOWN_MARGIN)
+
+
+def _worker_count() -> int:
+    if setting.server_workers > 0:
+        return setting.server_workers
+    # CPUs this process may run on (container CPU sets included)
+    return max(1, len(os.sched_getaffinity(0)))
+
+
+def _cache_backend(workers: int) -> str:
+    # Workers only share the read cache through Redis: with private memory caches a write would
+    # invalidate the worker that made it, and the others would serve stale data until the TTL
+    if setting.cache_backend == "auto":
+        return "redis" if workers > 1 else "memory"
+    if setting.cache_backend == "memory" and workers > 1 and setting.cache_ttl_seconds > 0:
+        raise RuntimeError(
+            f"CACHE_BACKEND=memory cannot run {workers} workers: use redis, SERVER_WORKERS=1 or CACHE_TTL_SECONDS=0"
+        )
+    return setting.cache_backend
+
+
+bind = setting.server_bind
+worker_class = "gunicorn_conf.ProductionWorker"
+workers = _worker_count()
+# Read by cache.py when the preloaded app is imported, after this file
+setting.cache_backend = _cache_backend(workers)
+preload_app = True
+timeout = setting.server_timeout
+graceful_timeout = setting.server_graceful_timeout
+keepalive = setting.server_keepalive
+# Requests are logged by the app (request_log.py); gunicorn only logs its own events
+accesslog = None
+errorlog = "-"
+loglevel = "info"
+
+
+def post_fork(server, worker):
+    # Nothing should connect while the app is preloaded, but pooled connections inherited from
+    # the master would be shared by every worker: drop them without closing the master's sockets
+    import database
+
+    database.engine.dispose(close=False)
+    if setting.database_async:
+        database.async_engine.sync_engine.dispose(close=False)
@@ -0,0 +1,170 @@
+from fastapi import HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, create_model
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from typing import Callable, Iterator, List, Optional, Sequence, Type
+from enum import Enum
+import csv
+import io
+import json
+from config import setting
+from database import SessionLocal
+from responses import render_json
+
+# Response header carrying the cursor of the next page (absent on the last page)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# Streaming export formats and their media types
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Rows fetched from the server-side cursor (and written to the client) at a time
+EXPORT_BATCH_SIZE = 1000
+
+
+class ListParams:
+    """
+    Query parameters shared by every ``/list`` endpoint: keyset pagination, field projection and
+    the streaming export format.
+    """
+
+    def __init__(
+        self,
+        cursor: Optional[int] = Query(None, description=f"Only return rows with an id greater than this (taken from the {NEXT_CURSOR_HEADER} header)"),
+        limit: Optional[int] = Query(None, ge=1, le=setting.list_max_limit, description="Maximum number of rows to return (every row when omitted, unless the server sets a default page size)"),
+        fields: Optional[str] = Query(None, description="Comma separated list of fields to return"),
+        format: Optional[str] = Query(None, pattern="^(ndjson|csv)$", description="Stream every matching row as NDJSON or CSV instead of returning one page (limit is ignored)"),
+    ):
+        self.cursor = cursor
+        # None: no page size, every matching row is returned
+        self.limit = limit if limit is not None else (setting.list_default_limit or None)
+        self.fields = fields
+        self.format = format
+
+
+def row_model(model: Type[BaseModel]) -> Type[BaseModel]:
+    """
+    Schema of the rows a ``/list`` endpoint returns for ``model`` (e.g. ``AudioFileOut`` gives
+    ``AudioFileRow``): the same fields, each one present only when selected with ``fields=``.
+    Routes returning it set ``response_model_exclude_unset=True``, so fields that were not
+    selected are left out instead of being sent as null.
+    """
+    fields = {name: (Optional[field.annotation], None) for name, field in model.model_fields.items()}
+    name = model.__name__[:-len("Out")] if model.__name__.endswith("Out") else model.__name__
+    return create_model(
+        f"{name}Row",
+        __doc__=f"{model.__name__} fields selected with fields= (a default set when none are given).",
+        **fields,
+    )
+
+
+def model_fields(model) -> List[str]:
+    return [column.key for column in model.__table__.columns]
+
+
+def parse_fields(fields: Optional[str], allowed: Sequence[str], default: Sequence[str]) -> List[str]:
+    """Validate a ``fields=`` projection. ``id`` is always included since it is the pagination key."""
+    if not fields:
+        return list(default)
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    if "id" not in names:
+        names.insert(0, "id")
+    return names
+
+
+def fetch_page(
+    db: Session,
+    model,
+    columns: Sequence[str],
+    criteria: Sequence,
+    params: ListParams,
+    response: Response,
+) -> List[dict]:
+    """
+    Select one page of ``columns`` from ``model`` matching ``criteria``, ordered by id.
+
+    Only the requested columns are selected and the page is found with ``id > cursor`` on the
+    primary key index, so the cost of a page does not depend on the size of the table. When more
+    rows follow, their cursor is sent back in the ``X-Next-Cursor`` header. Without a limit every
+    matching row is returned and there is no next page.
+    """
+    statement = select(*[getattr(model, column) for column in columns]).where(*criteria)
+    if params.cursor is not None:
+        statement = statement.where(model.id > params.cursor)
+    statement = statement.order_by(model.id)
+    if params.limit is None:
+        return [dict(row._mapping) for row in db.execute(statement)]
+    # One extra row tells whether there is a next page
+    statement = statement.limit(params.limit + 1)
+    rows = [dict(row._mapping) for row in db.execute(statement)]
+    if len(rows) > params.limit:
+        rows = rows[:params.limit]
+        response.headers[NEXT_CURSOR_HEADER] = str(rows[-1]["id"])
+    return rows
+
+
+def _encode_ndjson(rows: List[dict], columns: Sequence[str]) -> bytes:
+    return b"".join(render_json(row) + b"\n" for row in rows)
+
+
+def _csv_value(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _encode_csv(rows: List[dict], columns: Sequence[str]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([_csv_value(row.get(column)) for column in columns])
+    return buffer.getvalue().encode("utf-8")
+
+
+def _stream_rows(
+    statement,
+    columns: Sequence[str],
+    format: str,
+    enrich: Optional[Callable[[Session, List[dict]], None]],
+) -> Iterator[bytes]:
+    if format == "csv":
+        yield _encode_csv([dict(zip(columns, columns))], columns)
+    encode = _encode_csv if format == "csv" else _encode_ndjson
+    # The request's session is closed before the body is sent, so the export opens its own
+    with SessionLocal() as db:
+        result = db.execute(statement.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE))
+        for partition in result.partitions():
+            rows = [dict(row._mapping) for row in partition]
+            if enrich is not None:
+                enrich(db, rows)
+            yield encode(rows, columns)
+
+
+def export_rows(
+    model,
+    columns: Sequence[str],
+    criteria: Sequence,
+    params: ListParams,
+    enrich: Optional[Callable[[Session, List[dict]], None]] = None,
+) -> StreamingResponse:
+    """
+    Stream every row of ``model`` matching ``criteria`` in ``params.format``.
+
+    Rows come from a server-side cursor in batches of ``EXPORT_BATCH_SIZE`` and are encoded batch
+    by batch, so memory stays bounded however large the table is. ``enrich`` may add derived
+    fields to each batch (``columns`` lists every output field, derived ones included).
+    """
+    selected = [column for column in columns if column in model.__table__.columns]
+    statement = select(*[getattr(model, column) for column in selected]).where(*criteria)
+    if params.cursor is not None:
+        statement = statement.where(model.id > params.cursor)
+    statement = statement.order_by(model.id)
+    return StreamingResponse(
+        _stream_rows(statement, columns, params.format, enrich),
+        media_type=EXPORT_MEDIA_TYPES[params.format],
+    )
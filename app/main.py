@@ -1,18 +1,39 @@
-from fastapi import FastAPI, Depends, Request
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware  # Fixed typo in 'CORSMiddleware'
 from loguru import logger
 import os
 import time
-import datetime
 # Local Application Imports
-from database import Base, engine
 import endpoint as endpoint
+import storage
+from listing import NEXT_CURSOR_HEADER
+from cache import response_cache
+from analysis import analysis_queue
+from render import mix_renderer
+from responses import FastJSONResponse
+from compression import CompressionMiddleware
+from metrics import MetricsMiddleware
+from request_log import REQUEST_ID_HEADER, RequestLogMiddleware, configure_logging
 
-# Create tables in the database (if they don't exist already)
-Base.metadata.create_all(bind=engine)
+# The schema is created and updated by prestart.py (alembic upgrade head) before the server
+# starts, so importing the app never touches the database
 
-app = FastAPI(title="Sonicstride 音樂存取")
+# Start and stop per-process resources with each worker
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    response_cache.start()
+    analysis_queue.start()
+    mix_renderer.start()
+    yield
+    mix_renderer.close()
+    analysis_queue.close()
+    response_cache.close()
+    # Let the queued log sinks write what is left
+    await logger.complete()
+
+app = FastAPI(title="Sonicstride 音樂存取", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Adding CORS middleware to allow cross-origin requests
 app.add_middleware(
@@ -21,34 +42,36 @@ app.add_middleware(
     allow_credentials=True,  # Allow credentials such as cookies
     allow_methods=["*"],  # Allow all HTTP methods
     allow_headers=["*"],  # Allow all headers
+    expose_headers=[NEXT_CURSOR_HEADER, REQUEST_ID_HEADER],  # Let browsers read the pagination cursor and request id
 )
 
+# Compress large JSON, NDJSON and CSV responses for clients that accept it
+app.add_middleware(CompressionMiddleware)
+
 # Setting the timezone to Asia/Taipei
 os.environ["TZ"] = "Asia/Taipei"
 time.tzset()
 
-# Configuring logger to create a new log file daily at midnight, 
-# with UTF-8 encoding, and retaining logs for 30 days
-logger.add(
-    "./logs/{time}.log",  # Log file path
-    rotation=datetime.time(0, 0, 0),  # Rotate daily at midnight
-    encoding="utf-8",  # File encoding
-    retention="30 days",  # Keep logs for 30 days
-    level="DEBUG",  # Log level
-)
-
-# Asynchronous function to log incoming requests
-async def log_request(request: Request):
-    logger.info(f"[{request.client.host}] {request.method} {request.url}")
+# Queued log sinks (readable text on stderr, JSON lines in a daily log file) at the configured level
+configure_logging()
 
-# Including the router from the endpoint module and adding log_request as a dependency
-app.include_router(endpoint.ROUTER, dependencies=[Depends(log_request)])
+# Including the router from the endpoint module
+app.include_router(endpoint.ROUTER)
 
 # Middleware to limit file upload size to 100MB
+# (uploads without a Content-Length are capped while they are streamed to disk)
 @app.middleware("http")
 async def limit_upload_size(request, call_next):
-    if request.url.path == "/api/music/upload" and request.method == "POST":
+    if request.url.path == "/api/audiofiles/" and request.method == "POST":
         content_length = request.headers.get('content-length')
-        if content_length and int(content_length) > 100 * 1024 * 1024:  # 100MB limit
+        if content_length and int(content_length) > storage.MAX_UPLOAD_SIZE:
             return JSONResponse(content={"detail": "File too large"}, status_code=413)
-    return await call_next(request)
\ No newline at end of file
+    return await call_next(request)
+
+# Per-route latency, response size and SQL metrics, served on /metrics
+# (added after the other middleware so it wraps them and times everything below it)
+app.add_middleware(MetricsMiddleware)
+
+# Request ids and one structured log record per request (outermost, so every record logged
+# while handling a request carries its id, including the slow request log)
+app.add_middleware(RequestLogMiddleware)
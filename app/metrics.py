@@ -0,0 +1,253 @@
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+import threading
+import time
+from loguru import logger
+from sqlalchemy import event
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from config import setting
+
+# Media type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Route label of requests that matched no route, so unknown paths cannot create new series
+UNMATCHED_ROUTE = "unmatched"
+# Statements included in one slow request log entry
+SLOW_LOG_MAX_STATEMENTS = 50
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """A metric family with a fixed set of label names; one series per combination of label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labels:
+            # A metric without labels has a single series, reported from the start
+            self._series[()] = self._new_state()
+
+    def _new_state(self):
+        return 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = list(self._series.items())
+        for values, state in sorted(series):
+            lines.extend(self._render_series(values, state))
+        return lines
+
+    def _render_series(self, values: Tuple[str, ...], state) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, values)} {_format_value(state)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values: str) -> None:
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + 1
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def add(self, amount: float, *values: str) -> None:
+        with self._lock:
+            self._series[values] = self._series.get(values, 0) + amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labels)
+
+    def _new_state(self):
+        # Per bucket counts (not cumulative), then the +Inf count and the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value: float, *values: str) -> None:
+        with self._lock:
+            state = self._series.get(values)
+            if state is None:
+                state = self._series[values] = self._new_state()
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-1] += value
+
+    def _render_series(self, values: Tuple[str, ...], state) -> List[str]:
+        names = self.labels + ("le",)
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _format_value(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(names, values + (le,))} {cumulative}")
+        labels = _format_labels(self.labels, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REQUESTS = Counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to send the full response.", LATENCY_BUCKETS, ("method", "route")
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Response body size, as sent (after compression).", SIZE_BUCKETS, ("method", "route")
+)
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled.")
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries", "SQL statements executed per request.", QUERY_COUNT_BUCKETS, ("method", "route")
+)
+REQUEST_QUERY_TIME = Histogram(
+    "http_request_db_query_seconds", "Time spent executing SQL per request.", LATENCY_BUCKETS, ("method", "route")
+)
+QUERIES = Counter("db_queries_total", "SQL statements executed, inside requests or not.")
+QUERY_DURATION = Histogram("db_query_duration_seconds", "Execution time of single SQL statements.", LATENCY_BUCKETS)
+
+REGISTRY = (REQUESTS, REQUEST_DURATION, RESPONSE_SIZE, IN_FLIGHT, REQUEST_QUERIES, REQUEST_QUERY_TIME, QUERIES, QUERY_DURATION)
+
+
+def render_metrics() -> bytes:
+    """All metrics of this process in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class RequestQueries:
+    """SQL statements run on behalf of one request. Statements are only kept for the slow request log."""
+
+    __slots__ = ("count", "time", "statements")
+
+    def __init__(self, keep_statements: bool):
+        self.count = 0
+        self.time = 0.0
+        self.statements: Optional[List[Tuple[str, float]]] = [] if keep_statements else None
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.time += duration
+        if self.statements is not None and len(self.statements) < SLOW_LOG_MAX_STATEMENTS:
+            self.statements.append((statement, duration))
+
+
+# Queries of the current request; thread pool calls (sync endpoints, streaming) copy the context,
+# so they add to the same object
+_request_queries: ContextVar[Optional[RequestQueries]] = ContextVar("request_queries", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info["metrics_query_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    started = conn.info.pop("metrics_query_started", None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    QUERIES.inc()
+    QUERY_DURATION.observe(duration)
+    queries = _request_queries.get()
+    if queries is not None:
+        queries.record(statement, duration)
+
+
+def instrument_engine(engine) -> None:
+    """Time every statement of a (sync) engine; pass ``async_engine.sync_engine`` for async engines."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class MetricsMiddleware:
+    """
+    Record latency, response size and SQL statements of every HTTP request, by route template.
+
+    Requests slower than ``metrics_slow_request_ms`` are logged with the statements they ran.
+    Metrics are per process: with several workers, each one reports its own.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        slow_ms = setting.metrics_slow_request_ms
+        queries = RequestQueries(keep_statements=slow_ms > 0)
+        token = _request_queries.set(queries)
+        # Unhandled errors are turned into a 500 by the outer error middleware
+        status, content_length, body_size = 500, None, 0
+
+        async def send_with_metrics(message: Message) -> None:
+            nonlocal status, content_length, body_size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # File responses may bypass the body messages (pathsend), their length is in the header
+                content_length = Headers(raw=message["headers"]).get("content-length")
+            elif message["type"] == "http.response.body":
+                body_size += len(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        IN_FLIGHT.add(1)
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            IN_FLIGHT.add(-1)
+            duration = time.perf_counter() - started
+            _request_queries.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", None) or UNMATCHED_ROUTE
+            method = scope["method"]
+            REQUESTS.inc(method, route, str(status))
+            REQUEST_DURATION.observe(duration, method, route)
+            RESPONSE_SIZE.observe(int(content_length) if content_length is not None else body_size, method, route)
+            REQUEST_QUERIES.observe(queries.count, method, route)
+            REQUEST_QUERY_TIME.observe(queries.time, method, route)
+            if slow_ms > 0 and duration * 1000 >= slow_ms:
+                _log_slow_request(scope, status, duration, queries)
+
+
+def _log_slow_request(scope: Scope, status: int, duration: float, queries: RequestQueries) -> None:
+    path = scope["path"] + ("?" + scope["query_string"].decode("latin-1") if scope.get("query_string") else "")
+    lines = [
+        f"Slow request: {scope['method']} {path} -> {status} in {duration * 1000:.1f}ms, "
+        f"{queries.count} SQL statements in {queries.time * 1000:.1f}ms"
+    ]
+    for statement, statement_duration in queries.statements:
+        lines.append(f"  {statement_duration * 1000:8.1f}ms  {' '.join(statement.split())}")
+    if queries.count > len(queries.statements):
+        lines.append(f"  ... {queries.count - len(queries.statements)} more")
+    logger.warning("\n".join(lines))
@@ -0,0 +1,51 @@
+from alembic import context, op
+import sqlalchemy as sa
+
+# The revisions only create what is missing, so they apply both to empty databases and to
+# databases created by Base.metadata.create_all. Offline (--sql) there is nothing to inspect and
+# every statement is emitted.
+
+
+def has_table(table: str) -> bool:
+    if context.is_offline_mode():
+        return False
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def has_column(table: str, column: str) -> bool:
+    if context.is_offline_mode():
+        return False
+    return any(existing["name"] == column for existing in sa.inspect(op.get_bind()).get_columns(table))
+
+
+def has_index(table: str, index: str) -> bool:
+    if context.is_offline_mode():
+        return False
+    return any(existing["name"] == index for existing in sa.inspect(op.get_bind()).get_indexes(table))
+
+
+def create_index_online(index: str, table: str, columns) -> None:
+    """
+    Create an index without blocking writes to ``table``.
+
+    On PostgreSQL the index is built ``CONCURRENTLY``, which cannot run inside a transaction, so
+    it gets its own autocommit block. Databases created by ``create_all`` already have the index
+    and are skipped.
+    """
+    if has_index(table, index):
+        return
+    if op.get_bind().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.create_index(index, table, columns, postgresql_concurrently=True)
+    else:
+        op.create_index(index, table, columns)
+
+
+def drop_index_online(index: str, table: str) -> None:
+    if not has_index(table, index):
+        return
+    if op.get_bind().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.drop_index(index, table_name=table, postgresql_concurrently=True)
+    else:
+        op.drop_index(index, table_name=table)
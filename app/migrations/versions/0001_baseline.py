@@ -0,0 +1,98 @@
+"""Baseline: the schema as created by Base.metadata.create_all before migrations existed
+
+Databases that already have these tables are left untouched, so this revision can be applied
+to existing deployments as well as to empty databases.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import has_table
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+GENRES = (
+    "Ambient", "Nature_Sounds", "Instrumental", "Lofi", "Classical", "Jazz", "Electronic", "Meditative",
+    "Binaural_Beats", "ASMR", "Chillhop", "Soundscapes", "World_Music", "Folk", "Rain_Sounds", "Ocean_Waves",
+    "White_Noise", "Other",
+)
+
+
+def upgrade() -> None:
+    if not has_table("configs"):
+        op.create_table(
+            "configs",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("name", sa.String, nullable=False),
+            sa.Column("author", sa.String),
+            sa.Column("interaction_type", sa.String),
+            sa.Column("bpm", sa.Integer),
+            sa.Column("create_time", sa.TIMESTAMP, server_default=sa.func.now()),
+            sa.Column("labels", sa.String),
+        )
+        op.create_index("ix_configs_id", "configs", ["id"])
+    if not has_table("audio_files"):
+        op.create_table(
+            "audio_files",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("name", sa.String, nullable=False),
+            sa.Column("author", sa.String),
+            sa.Column("type", sa.String, nullable=False),
+            sa.Column("genre", sa.Enum(*GENRES, name="genreenum")),
+            sa.Column("key", sa.String),
+            sa.Column("bpm", sa.Integer),
+            sa.Column("file_path", sa.String, nullable=False),
+        )
+        op.create_index("ix_audio_files_id", "audio_files", ["id"])
+    if not has_table("config_audios"):
+        op.create_table(
+            "config_audios",
+            sa.Column("config_id", sa.Integer, sa.ForeignKey("configs.id"), primary_key=True),
+            sa.Column("audio_id", sa.Integer, sa.ForeignKey("audio_files.id"), primary_key=True),
+        )
+    if not has_table("tracks"):
+        op.create_table(
+            "tracks",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("config_id", sa.Integer, sa.ForeignKey("configs.id")),
+            sa.Column("name", sa.String, nullable=False),
+            sa.Column("type", sa.String, nullable=False),
+            sa.Column("loop", sa.Boolean),
+            sa.Column("decay", sa.Boolean),
+            sa.Column("initial_gain", sa.Float),
+            sa.Column("track_initial_gain", sa.Float),
+            sa.Column("track_gain_node", sa.JSON),
+            sa.Column("effect_nodes", sa.JSON),
+        )
+        op.create_index("ix_tracks_id", "tracks", ["id"])
+    if not has_table("events"):
+        op.create_table(
+            "events",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("track_id", sa.Integer, sa.ForeignKey("tracks.id")),
+            sa.Column("type", sa.String, nullable=False),
+        )
+        op.create_index("ix_events_id", "events", ["id"])
+    if not has_table("actions"):
+        op.create_table(
+            "actions",
+            sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+            sa.Column("event_id", sa.Integer, sa.ForeignKey("events.id")),
+            sa.Column("target", sa.String),
+            sa.Column("property", sa.String),
+            sa.Column("method", sa.String),
+            sa.Column("value", sa.Float),
+            sa.Column("end_time", sa.Float),
+        )
+        op.create_index("ix_actions_id", "actions", ["id"])
+
+
+def downgrade() -> None:
+    for table in ("actions", "events", "tracks", "config_audios", "audio_files", "configs"):
+        op.drop_table(table)
+    sa.Enum(name="genreenum").drop(op.get_bind(), checkfirst=True)
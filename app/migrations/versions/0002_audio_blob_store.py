@@ -0,0 +1,39 @@
+"""Audio blob store: original filename and content hash of audio files, reference counted blobs
+
+create_all never altered existing tables, so databases created before these columns existed
+are missing them.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import create_index_online, drop_index_online, has_column, has_table
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if not has_column("audio_files", "filename"):
+        op.add_column("audio_files", sa.Column("filename", sa.String))
+    if not has_column("audio_files", "content_hash"):
+        op.add_column("audio_files", sa.Column("content_hash", sa.String(64)))
+    if not has_table("audio_blobs"):
+        op.create_table(
+            "audio_blobs",
+            sa.Column("content_hash", sa.String(64), primary_key=True),
+            sa.Column("size", sa.BigInteger, nullable=False),
+            sa.Column("ref_count", sa.Integer, nullable=False),
+        )
+    create_index_online("ix_audio_files_content_hash", "audio_files", ["content_hash"])
+
+
+def downgrade() -> None:
+    drop_index_online("ix_audio_files_content_hash", "audio_files")
+    op.drop_table("audio_blobs")
+    op.drop_column("audio_files", "content_hash")
+    op.drop_column("audio_files", "filename")
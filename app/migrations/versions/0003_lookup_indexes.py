@@ -0,0 +1,37 @@
+"""Indexes for the lookup filters and the parent/child foreign keys
+
+Covers the /api/others lookups (audio type and genre, config interaction type), the child
+lookups of a config graph (tracks by config, events by track, actions by event) and a reverse
+(audio_id, config_id) index for finding the configs using an audio file; the config_audios
+primary key already covers lookups by config. Indexes are built without locking writes.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from migrations.helpers import create_index_online, drop_index_online
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ("ix_audio_files_type", "audio_files", ["type"]),
+    ("ix_audio_files_genre", "audio_files", ["genre"]),
+    ("ix_configs_interaction_type", "configs", ["interaction_type"]),
+    ("ix_tracks_config_id", "tracks", ["config_id"]),
+    ("ix_events_track_id", "events", ["track_id"]),
+    ("ix_actions_event_id", "actions", ["event_id"]),
+    ("ix_config_audios_audio_id_config_id", "config_audios", ["audio_id", "config_id"]),
+)
+
+
+def upgrade() -> None:
+    for index, table, columns in INDEXES:
+        create_index_online(index, table, columns)
+
+
+def downgrade() -> None:
+    for index, table, _ in INDEXES:
+        drop_index_online(index, table)
@@ -0,0 +1,35 @@
+"""Audio analysis results: duration, sample rate, channels, loudness, tempo estimate and status
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import has_column
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    ("duration", sa.Float),
+    ("sample_rate", sa.Integer),
+    ("channels", sa.Integer),
+    ("loudness", sa.Float),
+    ("bpm_estimate", sa.Float),
+    ("analysis_status", sa.String(16)),
+)
+
+
+def upgrade() -> None:
+    # Nullable columns without defaults: adding them does not rewrite the table
+    for name, column_type in COLUMNS:
+        if not has_column("audio_files", name):
+            op.add_column("audio_files", sa.Column(name, column_type))
+
+
+def downgrade() -> None:
+    for name, _ in reversed(COLUMNS):
+        op.drop_column("audio_files", name)
@@ -0,0 +1,23 @@
+"""Index on audio_files.bpm
+
+Serves the bpm range filters of /api/audiofiles/list and the ordered scan that builds the
+in-memory tempo index behind /api/audiofiles/match. Built without locking writes.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from migrations.helpers import create_index_online, drop_index_online
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    create_index_online("ix_audio_files_bpm", "audio_files", ["bpm"])
+
+
+def downgrade() -> None:
+    drop_index_online("ix_audio_files_bpm", "audio_files")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, ForeignKey, JSON, TIMESTAMP, Enum, func
+from sqlalchemy import Column, String, Integer, BigInteger, Float, Boolean, ForeignKey, Index, JSON, TIMESTAMP, Enum, func
 from sqlalchemy.orm import relationship
 from enum import Enum as PyEnum
 from database import Base
@@ -33,7 +33,7 @@ class Config(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     name = Column(String, nullable=False)
     author = Column(String, default='Sonicstride')
-    interaction_type = Column(String)
+    interaction_type = Column(String, index=True)
     bpm = Column(Integer)
     create_time = Column(TIMESTAMP, server_default=func.now())
     labels = Column(String)
@@ -46,18 +46,36 @@ class AudioFile(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     name = Column(String, nullable=False)
     author = Column(String)
-    type = Column(String, nullable=False)
-    genre = Column(Enum(GenreEnum))
+    type = Column(String, nullable=False, index=True)
+    genre = Column(Enum(GenreEnum), index=True)
     key = Column(String)
-    bpm = Column(Integer)
+    bpm = Column(Integer, index=True)
     file_path = Column(String, nullable=False)
+    filename = Column(String)  # Original name of the uploaded file
+    content_hash = Column(String(64), index=True)  # SHA-256 of the file content, used as strong ETag
+    # Filled in by the background analysis (see analysis.py)
+    duration = Column(Float)  # Seconds
+    sample_rate = Column(Integer)
+    channels = Column(Integer)
+    loudness = Column(Float)  # RMS level in dBFS
+    bpm_estimate = Column(Float)  # Estimated tempo, also copied to bpm when the uploader gave none
+    analysis_status = Column(String(16))  # pending, done or failed; NULL for files never analyzed
 
     configs = relationship("ConfigAudio", back_populates="audio_file")
 
+class AudioBlob(Base):
+    # Content-addressed file shared by every AudioFile with the same content_hash
+    __tablename__ = 'audio_blobs'
+    content_hash = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+
 class ConfigAudio(Base):
     __tablename__ = 'config_audios'
     config_id = Column(Integer, ForeignKey('configs.id'), primary_key=True)
     audio_id = Column(Integer, ForeignKey('audio_files.id'), primary_key=True)
+    # The primary key serves lookups by config, this one serves lookups by audio file
+    __table_args__ = (Index('ix_config_audios_audio_id_config_id', 'audio_id', 'config_id'),)
 
     config = relationship("Config", back_populates="audios")
     audio_file = relationship("AudioFile", back_populates="configs")
@@ -65,7 +83,7 @@ class ConfigAudio(Base):
 class Track(Base):
     __tablename__ = 'tracks'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    config_id = Column(Integer, ForeignKey('configs.id'))
+    config_id = Column(Integer, ForeignKey('configs.id'), index=True)
     name = Column(String, nullable=False)
     type = Column(String, nullable=False)
     loop = Column(Boolean)
@@ -81,7 +99,7 @@ class Track(Base):
 class Event(Base):
     __tablename__ = 'events'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    track_id = Column(Integer, ForeignKey('tracks.id'))
+    track_id = Column(Integer, ForeignKey('tracks.id'), index=True)
     type = Column(String, nullable=False)
 
     track = relationship("Track", back_populates="events")
@@ -90,7 +108,7 @@ class Event(Base):
 class Action(Base):
     __tablename__ = 'actions'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    event_id = Column(Integer, ForeignKey('events.id'))
+    event_id = Column(Integer, ForeignKey('events.id'), index=True)
     target = Column(String)
     property = Column(String)
     method = Column(String)
@@ -0,0 +1,56 @@
+"""
+One-shot startup step, run once before the server starts its workers: wait until the database
+accepts connections, then apply the migrations (alembic upgrade head). Workers no longer create
+the schema when the app is imported, so several of them starting together cannot race each other.
+
+    pipenv run python prestart.py
+"""
+import os
+import sys
+import time
+from alembic import command
+from alembic.config import Config
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+# Local Application Imports
+from database import engine
+
+# Seconds to wait for the database (it may still be starting, e.g. with docker-compose up)
+DATABASE_WAIT_SECONDS = 60
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+
+
+def wait_for_database(timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return
+        except OperationalError as e:
+            if time.monotonic() >= deadline:
+                raise
+            logger.info(f"Waiting for the database: {str(e).splitlines()[0]}")
+            time.sleep(1)
+
+
+def upgrade_schema() -> None:
+    command.upgrade(Config(ALEMBIC_INI), "head")
+
+
+def main() -> int:
+    try:
+        wait_for_database(DATABASE_WAIT_SECONDS)
+    except OperationalError as e:
+        logger.error(f"Database not reachable after {DATABASE_WAIT_SECONDS}s: {e}")
+        return 1
+    upgrade_schema()
+    # Connections of this process are not needed by the server
+    engine.dispose()
+    logger.info("Database schema is up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,511 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
+import asyncio
+import glob
+import hashlib
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import numpy as np
+import orjson
+from fastapi.concurrency import run_in_threadpool
+from loguru import logger
+from config import setting
+from analysis import decode_audio
+
+# Mixes are rendered as 16 bit stereo WAV at this rate
+RENDER_RATE = 44100
+RENDER_CHANNELS = 2
+MEDIA_TYPE = "audio/wav"
+WAV_HEADER_SIZE = 44
+# Frames rendered and written at a time; a stream can start once the first block is on disk
+BLOCK_FRAMES = RENDER_RATE * 2
+# Rendered mixes, named by the hash of their render plan (the directory is relative to the app directory)
+RENDER_DIR = "renders"
+# Part of every plan hash: bump it when the output of the renderer changes
+RENDER_VERSION = 1
+# Seconds of the exponential fade out of tracks with decay, and its depth (e^-5, about -43 dB)
+DECAY_SECONDS = 2
+DECAY_RATE = 5
+# Effect nodes understood by the renderer (others are ignored); low and high pass filters have a
+# second order Butterworth magnitude response, band pass filters the response of a biquad with their Q
+FILTER_TYPES = ("lowpass", "highpass", "bandpass", "gain")
+FILTER_ORDER = 2
+# Silence appended to one-shot sources before filtering, so the filter tail does not wrap around
+FILTER_PADDING_SECONDS = 0.5
+# Decoded past the end of a one-shot source's part of the mix, for the resampler's last frames
+RESAMPLE_SLACK_SECONDS = 0.1
+# Automation methods with a ramp; any other method sets the value at its time
+LINEAR_RAMP = "linearRampToValueAtTime"
+EXPONENTIAL_RAMP = "exponentialRampToValueAtTime"
+# Action target of the track gain node; every other target automates the source gain
+TRACK_TARGET = "track"
+# How often a stream looks for newly rendered blocks, and how much it reads at once
+STREAM_POLL_SECONDS = 0.05
+STREAM_CHUNK_SIZE = 256 * 1024
+# Mixes used or rendered this recently are never evicted (pins only cover this process' requests)
+EVICT_GRACE_SECONDS = 60
+
+
+class RenderError(Exception):
+    pass
+
+
+def _gain(*candidates) -> float:
+    # First usable value: an explicit gain, a node config holding one, else unity gain
+    for candidate in candidates:
+        if isinstance(candidate, dict):
+            candidate = candidate.get("gain")
+        if isinstance(candidate, (int, float)) and not isinstance(candidate, bool):
+            return float(candidate)
+    return 1.0
+
+
+def _filters(effect_nodes) -> List[list]:
+    """
+    ``[type, frequency, q, gain]`` of every supported node in ``effect_nodes``, a dict of node
+    configs by name; the name is the node type unless its config has a ``type``.
+    """
+    if not isinstance(effect_nodes, dict):
+        return []
+    nodes = [{"type": name, **node} for name, node in effect_nodes.items() if isinstance(node, dict)]
+    filters = []
+    for node in nodes:
+        kind = str(node.get("type", "")).lower()
+        if kind not in FILTER_TYPES:
+            continue
+        try:
+            frequency = float(node.get("frequency", 350))
+            q = float(node.get("Q", node.get("q", 1)))
+            gain = float(node.get("gain", 1))
+        except (TypeError, ValueError):
+            continue
+        if kind != "gain" and not 0 < frequency < RENDER_RATE / 2:
+            continue
+        filters.append([kind, frequency, max(q, 1e-3), gain])
+    return filters
+
+
+def _track_audio(track: dict, audios: List[dict], position: int) -> Optional[dict]:
+    # The config audio named like the track, else the n-th audio of the track's type for the
+    # n-th track of that type
+    for audio in audios:
+        if audio["name"] == track["name"]:
+            return audio
+    same_type = [audio for audio in audios if audio["type"] == track["type"]]
+    return same_type[position] if position < len(same_type) else None
+
+
+def build_plan(graph: dict, seconds: float, event_types: Optional[List[str]] = None) -> dict:
+    """
+    Everything a render worker needs, from a config graph (see ``configs.config_graph_to_dict``).
+
+    Each track plays one of the config's audio files through a source gain (``initial_gain``),
+    its effect nodes and a track gain (``track_initial_gain``/``track_gain_node``). The actions of
+    the track's events (all of them, or those of ``event_types``) automate the track gain
+    (target ``"track"``) or the source gain, Web Audio style: ``end_time`` is when ``value`` is
+    reached. Tracks loop for the whole mix when ``loop`` is set and fade out when ``decay`` is.
+    Raises ``RenderError`` when no track has an audio file to play.
+    """
+    tracks, positions = [], {}
+    for track in graph["tracks"]:
+        position = positions[track["type"]] = positions.get(track["type"], -1) + 1
+        audio = _track_audio(track, graph["audios"], position)
+        if audio is None:
+            continue
+        try:
+            stat_result = os.stat(audio["file_path"])
+        except OSError:
+            raise RenderError(f"AudioFile {audio['id']} is missing its file")
+        automation = {"source": [], "track": []}
+        for event in track["events"]:
+            if event_types is not None and event["type"] not in event_types:
+                continue
+            for action in event["actions"]:
+                if action["property"] != "gain" or action["value"] is None or action["end_time"] is None:
+                    continue
+                target = "track" if action["target"] == TRACK_TARGET else "source"
+                automation[target].append([float(action["end_time"]), action["method"], float(action["value"])])
+        tracks.append({
+            "path": audio["file_path"],
+            # Identifies the file content in the plan hash (older files have no content hash)
+            "content": audio["content_hash"] or f"{stat_result.st_size}-{stat_result.st_mtime_ns}",
+            "loop": bool(track["loop"]),
+            "decay": bool(track["decay"]),
+            "source_gain": _gain(track["initial_gain"]),
+            "track_gain": _gain(track["track_initial_gain"], track["track_gain_node"]),
+            "filters": _filters(track["effect_nodes"]),
+            # Stable sort: actions at the same time keep their order
+            "source_automation": sorted(automation["source"], key=lambda point: point[0]),
+            "track_automation": sorted(automation["track"], key=lambda point: point[0]),
+        })
+    if not tracks:
+        raise RenderError("The config has no track with an audio file")
+    return {"version": RENDER_VERSION, "rate": RENDER_RATE, "seconds": seconds, "tracks": tracks}
+
+
+def plan_hash(plan: dict) -> str:
+    return hashlib.sha256(orjson.dumps(plan, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def render_path(key: str) -> str:
+    return os.path.join(RENDER_DIR, f"{key}.wav")
+
+
+def render_size(plan: dict) -> int:
+    """Size of the rendered WAV file in bytes, known before rendering."""
+    return WAV_HEADER_SIZE + _frame_count(plan) * RENDER_CHANNELS * 2
+
+
+def _frame_count(plan: dict) -> int:
+    return int(round(plan["seconds"] * plan["rate"]))
+
+
+def _wav_header(frames: int, rate: int) -> bytes:
+    data_size = frames * RENDER_CHANNELS * 2
+    return (
+        b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, RENDER_CHANNELS, rate, rate * RENDER_CHANNELS * 2, RENDER_CHANNELS * 2, 16)
+        + b"data" + struct.pack("<I", data_size)
+    )
+
+
+def _to_stereo(samples: np.ndarray) -> np.ndarray:
+    if samples.shape[1] == 1:
+        return np.repeat(samples, 2, axis=1)
+    return samples[:, :2]
+
+
+def _resample(samples: np.ndarray, rate: int, target_rate: int) -> np.ndarray:
+    # Linear interpolation, per channel
+    if rate == target_rate or not len(samples):
+        return samples
+    positions = np.arange(int(len(samples) * target_rate / rate)) * (rate / target_rate)
+    indexes = np.arange(len(samples))
+    return np.stack([np.interp(positions, indexes, channel) for channel in samples.T], axis=1).astype(np.float32)
+
+
+def filter_response(filters: List[list], frequencies: np.ndarray) -> np.ndarray:
+    """Magnitude response of a chain of effect nodes (see ``FILTER_TYPES``) at ``frequencies``."""
+    response = np.ones(len(frequencies))
+    with np.errstate(divide="ignore"):
+        for kind, frequency, q, gain in filters:
+            ratio = frequencies / frequency
+            if kind == "lowpass":
+                response /= np.sqrt(1 + ratio ** (2 * FILTER_ORDER))
+            elif kind == "highpass":
+                response *= np.where(ratio > 0, 1 / np.sqrt(1 + (1 / ratio) ** (2 * FILTER_ORDER)), 0)
+            elif kind == "bandpass":
+                response *= np.where(ratio > 0, 1 / np.sqrt(1 + q ** 2 * (ratio - 1 / ratio) ** 2), 0)
+            else:
+                response *= gain
+    return response
+
+
+def apply_filters(samples: np.ndarray, rate: int, filters: List[list], circular: bool) -> np.ndarray:
+    """
+    Filter ``samples`` in the frequency domain, zero phase. Looping sources are filtered
+    circularly (the loop point stays seamless); one-shot ones are padded and keep their tail.
+    """
+    if not filters or not len(samples):
+        return samples
+    size = len(samples) if circular else len(samples) + int(FILTER_PADDING_SECONDS * rate)
+    spectrum = np.fft.rfft(samples, size, axis=0)
+    spectrum *= filter_response(filters, np.fft.rfftfreq(size, 1 / rate))[:, None]
+    return np.fft.irfft(spectrum, size, axis=0).astype(np.float32)
+
+
+def automation_envelope(initial: float, points: List[list], times: np.ndarray):
+    """
+    Value of an automated gain at ``times`` (seconds, ascending); a plain float without automation.
+
+    ``points`` are ``[time, method, value]`` sorted by time. Ramps run from the previous point
+    (or from the start at ``initial``) to their own; exponential ramps between values of different
+    sign or zero hold the previous value instead, as in Web Audio.
+    """
+    if not points:
+        return initial
+    values = np.empty(len(times), dtype=np.float32)
+    previous_time, previous_value = 0.0, initial
+    for time, method, value in points:
+        low, high = np.searchsorted(times, [previous_time, time])
+        span = times[low:high]
+        if method == LINEAR_RAMP and time > previous_time:
+            values[low:high] = previous_value + (value - previous_value) * (span - previous_time) / (time - previous_time)
+        elif method == EXPONENTIAL_RAMP and time > previous_time and previous_value * value > 0:
+            values[low:high] = previous_value * (value / previous_value) ** ((span - previous_time) / (time - previous_time))
+        else:
+            values[low:high] = previous_value
+        previous_time, previous_value = max(previous_time, time), value
+    values[np.searchsorted(times, previous_time):] = previous_value
+    return values
+
+
+def _load_source(track: dict, rate: int, frames: int) -> np.ndarray:
+    if track["loop"]:
+        # No mix is longer than the longest render, so neither is the part of a loop that is heard
+        max_seconds = setting.render_max_seconds
+    else:
+        # Only what can be heard before the end of the mix is decoded, resampled and filtered
+        max_seconds = frames / rate + RESAMPLE_SLACK_SECONDS
+    samples, source_rate = decode_audio(track["path"], max_seconds)
+    samples = _to_stereo(samples)
+    if not track["loop"]:
+        samples = samples[:int(np.ceil(frames * source_rate / rate)) + 1]
+    samples = _resample(samples, source_rate, rate)
+    return apply_filters(samples, rate, track["filters"], circular=track["loop"])
+
+
+def _mix_block(mix: np.ndarray, track: dict, source: np.ndarray, start: int, rate: int, frames: int) -> None:
+    if not len(source):
+        return
+    stop = start + len(mix)
+    if track["loop"]:
+        segment = np.take(source, np.arange(start, stop), axis=0, mode="wrap")
+    else:
+        segment = source[start:stop]
+        if not len(segment):
+            return
+    times = np.arange(start, start + len(segment)) / rate
+    gain = (
+        automation_envelope(track["source_gain"], track["source_automation"], times)
+        * automation_envelope(track["track_gain"], track["track_automation"], times)
+    )
+    if track["decay"]:
+        # Fade out towards the end of what the track plays
+        end = frames if track["loop"] else min(frames, len(source))
+        fade_start = max(0, end - DECAY_SECONDS * rate)
+        progress = np.clip((np.arange(start, start + len(segment)) - fade_start) / max(1, end - fade_start), 0, 1)
+        gain = gain * np.exp(-DECAY_RATE * progress)
+    if np.ndim(gain):
+        mix[:len(segment)] += segment * gain[:, None]
+    else:
+        mix[:len(segment)] += segment * gain
+
+
+def render_mix(plan: dict, part_path: str, path: str) -> str:
+    """
+    Render ``plan`` block by block into ``part_path`` and move it to ``path`` once complete.
+    Runs in the render worker processes; readers may stream the part file while it grows.
+    """
+    rate, frames = plan["rate"], _frame_count(plan)
+    try:
+        sources = [_load_source(track, rate, frames) for track in plan["tracks"]]
+        with open(part_path, "wb") as file:
+            file.write(_wav_header(frames, rate))
+            for start in range(0, frames, BLOCK_FRAMES):
+                mix = np.zeros((min(BLOCK_FRAMES, frames - start), RENDER_CHANNELS), dtype=np.float32)
+                for track, source in zip(plan["tracks"], sources):
+                    _mix_block(mix, track, source, start, rate, frames)
+                # Like an audio output, the sum is clipped to full scale
+                file.write((np.clip(mix, -1, 1) * 32767).astype("<i2").tobytes())
+                file.flush()
+        os.replace(part_path, path)
+    except BaseException:
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return path
+
+
+class RenderJob:
+    """A mix being rendered; streams read its part file until ``size`` bytes were sent."""
+
+    def __init__(self, key: str, size: int):
+        self.key = key
+        self.size = size
+        self.path = render_path(key)
+        # Per process, so workers of other API processes rendering the same mix do not collide
+        self.part_path = f"{self.path}.{os.getpid()}.part"
+        self.future: Optional[Future] = None
+
+    def _failed(self) -> Optional[BaseException]:
+        if not self.future.done():
+            return None
+        return self.future.exception() if not self.future.cancelled() else RenderError("Render cancelled")
+
+    async def first_block(self) -> BinaryIO:
+        """
+        Wait until the beginning of the mix can be streamed and open it, for ``stream``; raises the
+        render's error if it failed. The open file stays readable when the part file is renamed.
+        """
+        while True:
+            if self.future.done():
+                error = self._failed()
+                if error is not None:
+                    raise error
+                try:
+                    return open(self.path, "rb")
+                except FileNotFoundError:
+                    raise RenderError(f"Render {self.key} was removed before it could be streamed")
+            try:
+                if os.path.getsize(self.part_path) > WAV_HEADER_SIZE:
+                    return open(self.part_path, "rb")
+            except FileNotFoundError:
+                # Not started yet, or just renamed
+                pass
+            await asyncio.sleep(STREAM_POLL_SECONDS)
+
+    async def stream(self, file: BinaryIO) -> AsyncIterator[bytes]:
+        """The WAV file as it is rendered, read from the file opened by ``first_block``."""
+        sent, finished = 0, False
+        try:
+            while sent < self.size:
+                chunk = await run_in_threadpool(file.read, STREAM_CHUNK_SIZE)
+                if chunk:
+                    sent += len(chunk)
+                    yield chunk
+                    continue
+                if finished:
+                    # The response is cut short, clients see fewer bytes than announced
+                    error = self._failed() or RenderError(f"only {sent} of {self.size} bytes were rendered")
+                    logger.error(f"Render {self.key} failed while streaming: {error}")
+                    return
+                # Read once more after the render ended, its last block may have been written since
+                finished = self.future.done()
+                if not finished:
+                    await asyncio.sleep(STREAM_POLL_SECONDS)
+        finally:
+            file.close()
+
+
+class MixRenderer:
+    """
+    Offline mixdown of configs in a process pool, cached on disk by the hash of the render plan.
+
+    A plan (see ``build_plan``) captures everything that affects the output, so an edited config
+    or a re-uploaded audio file gets a new hash and the old mix simply ages out: the least
+    recently used mixes are removed once the cache exceeds ``render_cache_max_mb``. Concurrent
+    requests for a mix being rendered share the render and stream the same growing file.
+
+    ``cached`` and ``submit`` pin the mix for the request: it is not removed until ``release``,
+    nor while it is being rendered. Pins are per process, so a mix another API process may be
+    about to open is protected by its modification time instead: ``cached`` touches it and
+    nothing touched within ``EVICT_GRACE_SECONDS`` is evicted.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._jobs: Dict[str, RenderJob] = {}
+        self._pins: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.cache_hits = 0
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    def start(self) -> None:
+        if self.running or self.workers <= 0:
+            return
+        os.makedirs(RENDER_DIR, exist_ok=True)
+        # Spawned workers do not inherit the API process' threads, sockets and connection pools
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def close(self) -> None:
+        if not self.running:
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def cached(self, key: str) -> Optional[str]:
+        """Path of a finished mix, marked as recently used and pinned; ``None`` if it is not rendered."""
+        path = render_path(key)
+        with self._lock:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+            self._pin(key)
+            self.cache_hits += 1
+        return path
+
+    def submit(self, key: str, plan: dict) -> RenderJob:
+        """Start rendering ``plan``, or join the render already running for it; pins the mix."""
+        with self._lock:
+            if not self.running:
+                raise RuntimeError("The renderer is not running")
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._jobs[key] = RenderJob(key, render_size(plan))
+                job.future = self._executor.submit(render_mix, plan, job.part_path, job.path)
+                job.future.add_done_callback(lambda future, key=key: self._finished(key, future))
+            self._pin(key)
+        return job
+
+    def release(self, key: str) -> None:
+        """Unpin a mix returned by ``cached`` or ``submit`` once its response is done."""
+        with self._lock:
+            if self._pins[key] > 1:
+                self._pins[key] -= 1
+            else:
+                del self._pins[key]
+
+    def _pin(self, key: str) -> None:
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def _finished(self, key: str, future: Future) -> None:
+        with self._lock:
+            self._jobs.pop(key, None)
+            if not future.cancelled():
+                if future.exception() is not None:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.warning(f"Render {key} failed: {future.exception()}")
+            return
+        try:
+            self._evict()
+        except OSError as e:
+            logger.error(f"Failed to trim the render cache: {e}")
+
+    def _evict(self) -> None:
+        entries: List[Tuple[float, int, str]] = []
+        for path in glob.glob(os.path.join(RENDER_DIR, "*.wav")):
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat_result.st_mtime, stat_result.st_size, path))
+        budget = setting.render_cache_max_mb * 1024 * 1024
+        total = sum(size for _, size, _ in entries)
+        recent = time.time() - EVICT_GRACE_SECONDS
+        for mtime, size, path in sorted(entries):
+            # Oldest first: once a mix is recent, so are all the remaining ones
+            if total <= budget or mtime > recent:
+                break
+            key = os.path.basename(path)[:-len(".wav")]
+            # Under the lock: a mix cannot be pinned between the check and its removal
+            with self._lock:
+                if key in self._jobs or key in self._pins:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            rendering = len(self._jobs)
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "rendering": rendering,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cache_hits": self.cache_hits,
+        }
+
+
+mix_renderer = MixRenderer(setting.render_workers)
@@ -0,0 +1,124 @@
+from typing import Optional, Tuple
+import io
+import subprocess
+import wave
+import numpy as np
+import storage
+
+# Waveform peaks: the file is split into this many equal buckets (fewer for very short files)
+# and each bucket is stored as a (min, max) pair of signed 8 bit samples, interleaved
+PEAK_BUCKETS = 1000
+# A file read block by block keeps (min, max) pairs of about this many envelope blocks per bucket,
+# or of ENVELOPE_BLOCK_FRAMES frames each when its length is not known in advance
+ENVELOPE_BLOCKS_PER_BUCKET = 8
+ENVELOPE_BLOCK_FRAMES = 256
+PEAKS_MEDIA_TYPE = "application/octet-stream"
+# Preview clip: the first seconds of the file, mono, at about this rate, faded out at the end
+PREVIEW_SECONDS = 30
+PREVIEW_RATE = 22050
+PREVIEW_FADE_SECONDS = 1
+# MP3 bitrate of the preview (encoded by ffmpeg; without ffmpeg the preview is an 8 bit WAV)
+PREVIEW_BITRATE = "64k"
+
+
+class PeakEnvelope:
+    """
+    Waveform peaks of a file that is decoded block by block: ``add`` the blocks of float samples
+    shaped (frames, channels) in order, then reduce them with ``peaks``. Only a min/max pair per
+    envelope block is kept, so memory does not grow with the samples.
+    """
+
+    def __init__(self, expected_frames: Optional[int] = None, block_frames: Optional[int] = None):
+        if block_frames is None:
+            if expected_frames:
+                block_frames = max(1, expected_frames // (PEAK_BUCKETS * ENVELOPE_BLOCKS_PER_BUCKET))
+            else:
+                block_frames = ENVELOPE_BLOCK_FRAMES
+        self.block_frames = block_frames
+        self.frames = 0
+        self._low = []
+        self._high = []
+        # Frames of the last, incomplete envelope block
+        self._rest_low = np.empty(0, dtype=np.float32)
+        self._rest_high = np.empty(0, dtype=np.float32)
+
+    def add(self, samples: np.ndarray) -> None:
+        if not len(samples):
+            return
+        self.frames += len(samples)
+        low = np.concatenate([self._rest_low, samples.min(axis=1)])
+        high = np.concatenate([self._rest_high, samples.max(axis=1)])
+        complete = len(low) // self.block_frames * self.block_frames
+        if complete:
+            self._low.append(low[:complete].reshape(-1, self.block_frames).min(axis=1))
+            self._high.append(high[:complete].reshape(-1, self.block_frames).max(axis=1))
+        self._rest_low, self._rest_high = low[complete:], high[complete:]
+
+    def peaks(self) -> bytes:
+        """Min/max envelope over all channels, in ``PEAK_BUCKETS`` buckets (fewer for very short files)."""
+        if self.frames == 0:
+            return b""
+        low, high = list(self._low), list(self._high)
+        if len(self._rest_low):
+            low.append(self._rest_low.min(keepdims=True))
+            high.append(self._rest_high.max(keepdims=True))
+        low, high = np.concatenate(low), np.concatenate(high)
+        starts = np.linspace(0, self.frames, min(PEAK_BUCKETS, self.frames), endpoint=False).astype(np.int64)
+        blocks = starts // self.block_frames
+        peaks = np.stack([np.minimum.reduceat(low, blocks), np.maximum.reduceat(high, blocks)], axis=1)
+        return np.clip(np.round(peaks * 127), -128, 127).astype(np.int8).tobytes()
+
+
+def compute_peaks(samples: np.ndarray) -> bytes:
+    """Min/max envelope over all channels of float samples shaped (frames, channels)."""
+    envelope = PeakEnvelope(block_frames=1)
+    envelope.add(samples)
+    return envelope.peaks()
+
+
+def _preview_signal(samples: np.ndarray, rate: int) -> Tuple[np.ndarray, int]:
+    # Mono mix of the beginning, decimated by block averaging
+    factor = max(1, rate // PREVIEW_RATE)
+    clip = samples[:PREVIEW_SECONDS * rate // factor * factor].mean(axis=1)
+    signal = clip.reshape(-1, factor).mean(axis=1) if factor > 1 else clip
+    preview_rate = round(rate / factor)
+    fade = min(len(signal), PREVIEW_FADE_SECONDS * preview_rate)
+    if fade:
+        signal[len(signal) - fade:] *= np.linspace(1, 0, fade, dtype=signal.dtype)
+    return signal, preview_rate
+
+
+def encode_preview(samples: np.ndarray, rate: int) -> bytes:
+    signal, preview_rate = _preview_signal(samples, rate)
+    signal = np.clip(signal, -1, 1)
+    pcm = (signal * 32767).astype("<i2").tobytes()
+    try:
+        encoded = subprocess.run(
+            ["ffmpeg", "-v", "error", "-f", "s16le", "-ar", str(preview_rate), "-ac", "1", "-i", "-",
+             "-b:a", PREVIEW_BITRATE, "-f", "mp3", "-"],
+            input=pcm, capture_output=True, check=True, timeout=120,
+        )
+        return encoded.stdout
+    except (FileNotFoundError, subprocess.SubprocessError):
+        pass
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(1)
+        wav.setframerate(preview_rate)
+        # 8 bit WAV samples are unsigned
+        wav.writeframes(np.round(signal * 127 + 128).astype(np.uint8).tobytes())
+    return buffer.getvalue()
+
+
+def preview_media_type(path: str) -> str:
+    return "audio/wav" if storage.is_wav(path) else "audio/mpeg"
+
+
+def write_renditions(content_hash: str, peaks: bytes, samples: np.ndarray, rate: int) -> None:
+    """
+    Write the peaks of a blob and its preview, encoded from the decoded samples of its beginning.
+    Runs in the analysis workers.
+    """
+    storage.write_rendition(content_hash, "peaks", peaks)
+    storage.write_rendition(content_hash, "preview", encode_preview(samples, rate))
@@ -0,0 +1,272 @@
+from typing import BinaryIO, List, Optional
+import asyncio
+import glob
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+import uuid
+import orjson
+from loguru import logger
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from config import setting
+
+# Log files, one per day (the directory is relative to the app directory), and days they are kept
+LOG_DIRECTORY = "./logs"
+LOG_RETENTION_DAYS = 30
+# Header carrying the request id, in both directions
+REQUEST_ID_HEADER = "X-Request-ID"
+# Request ids sent by clients or proxies are kept when they look like one, otherwise replaced
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+# Successful requests of these methods are subject to log_request_sample_rate
+SAMPLED_METHODS = ("GET", "HEAD")
+# Record fields that are not copied from ``extra``
+RESERVED_EXTRA = ("json",)
+# Seconds between two batched writes of a queued sink, and records a sink queues at most: when
+# its target cannot keep up, further records are dropped (and counted) rather than using memory
+WRITE_INTERVAL = 0.05
+MAX_QUEUED_RECORDS = 10000
+
+
+def _json_format(record) -> str:
+    """
+    Loguru format function writing every record as one JSON object per line.
+
+    The fields bound to the record (``logger.bind``/``contextualize``, e.g. the request id) become
+    top level keys.
+    """
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "module": record["name"],
+    }
+    for key, value in record["extra"].items():
+        if key not in RESERVED_EXTRA:
+            entry[key] = value
+    if record["exception"] is not None:
+        entry["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    # Values orjson does not know are logged as their str()
+    record["extra"]["json"] = orjson.dumps(entry, default=str).decode("utf-8")
+    return "{extra[json]}\n"
+
+
+class DailyLogFile:
+    """
+    Text file named after the current day (``2024-01-31.log``); files older than the retention are removed.
+
+    Every worker process appends to the same file: it is opened with ``O_APPEND`` and unbuffered,
+    and each ``write`` of whole records is one ``write()`` call, which the kernel appends at once,
+    so records of different processes never interleave.
+    """
+
+    def __init__(self, directory: str, retention_days: int):
+        self.directory = directory
+        self.retention_days = retention_days
+        self._day: Optional[str] = None
+        self._file: Optional[BinaryIO] = None
+
+    def write(self, text: str) -> None:
+        day = time.strftime("%Y-%m-%d")
+        if day != self._day:
+            self.close()
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(os.path.join(self.directory, f"{day}.log"), "ab", buffering=0)
+            self._day = day
+            self._remove_expired()
+        data = text.encode("utf-8")
+        # Regular files are written in full; the loop only guards against a short write
+        while data:
+            data = data[self._file.write(data):]
+
+    def flush(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _remove_expired(self) -> None:
+        expired = time.time() - self.retention_days * 86400
+        for path in glob.glob(os.path.join(self.directory, "*.log")):
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class QueuedWriter:
+    """
+    Loguru sink whose writes happen on a background thread.
+
+    The logging call only appends the formatted record to an in-process queue; every
+    ``WRITE_INTERVAL`` the thread writes whatever has accumulated to ``target`` in one call and
+    flushes it, so logging neither waits for I/O nor wakes the thread per record. (Loguru's own
+    ``enqueue=True`` pickles every record through a multiprocessing pipe, which costs more per
+    request than writing synchronously; see benchmarks/bench_logging.py.) At most
+    ``MAX_QUEUED_RECORDS`` wait: past that records are dropped and counted in ``dropped``, and
+    the thread reports the count on stderr. Forked worker processes start their own thread.
+    """
+
+    def __init__(self, target, name: str):
+        self.target = target
+        self.name = name
+        self._start()
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self) -> None:
+        self._queue: "queue.Queue" = queue.Queue(maxsize=MAX_QUEUED_RECORDS)
+        self.dropped = 0
+        self._reported = 0
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def write(self, message: str) -> None:
+        # Loguru calls a sink under its handler's lock, so the count needs no lock of its own
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            items = []
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not items:
+                time.sleep(WRITE_INTERVAL)
+                continue
+            texts: List[str] = [item for item in items if isinstance(item, str)]
+            try:
+                if texts:
+                    self.target.write("".join(texts))
+                    self.target.flush()
+            except Exception as e:
+                print(f"Failed to write log records: {e}", file=sys.stderr)
+            dropped = self.dropped
+            if dropped > self._reported:
+                print(f"{self.name}: {dropped - self._reported} log records dropped, the queue was full", file=sys.stderr)
+                self._reported = dropped
+            # Markers put by complete() and stop(): the records queued before them are written
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if None in items:
+                return
+
+    def _flushed(self, stop: bool) -> threading.Event:
+        done = threading.Event()
+        self._queue.put(done)
+        if stop:
+            self._queue.put(None)
+        return done
+
+    async def complete(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self._flushed(stop=False).wait)
+
+    def stop(self) -> None:
+        self._flushed(stop=True)
+        self._thread.join()
+        if isinstance(self.target, DailyLogFile):
+            self.target.close()
+
+
+def configure_logging() -> None:
+    """
+    Replace loguru's default sink by queued sinks at ``log_level``: readable text on stderr and
+    JSON lines in a daily log file. Requests never wait for a write to the terminal or the disk.
+    """
+    logger.remove()
+    logger.add(QueuedWriter(sys.stderr, "log-stderr"), level=setting.log_level, colorize=False)
+    logger.add(
+        QueuedWriter(DailyLogFile(LOG_DIRECTORY, LOG_RETENTION_DAYS), "log-file"),
+        format=_json_format,
+        level=setting.log_level,
+    )
+
+
+def _sampled_out(method: str, status: int) -> bool:
+    # Errors and writes are always logged, successful reads only at the configured rate
+    rate = setting.log_request_sample_rate
+    return rate < 1 and status < 400 and method in SAMPLED_METHODS and random.random() >= rate
+
+
+def _request_id(scope: Scope) -> str:
+    request_id = Headers(scope=scope).get(REQUEST_ID_HEADER)
+    if request_id is not None and REQUEST_ID_PATTERN.match(request_id):
+        return request_id
+    return uuid.uuid4().hex
+
+
+class RequestLogMiddleware:
+    """
+    Give every HTTP request an id and write one structured log record per request.
+
+    The id is taken from the ``X-Request-ID`` request header or generated, returned in the
+    response header of the same name and bound to every record logged while the request is
+    handled. The request record carries method, path, route, status, duration and response size;
+    successful GET/HEAD requests are sampled with ``log_request_sample_rate``.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = _request_id(scope)
+        # Unhandled errors are turned into a 500 by the outer error middleware
+        status, content_length, body_size = 500, None, 0
+
+        async def send_with_request_id(message: Message) -> None:
+            nonlocal status, content_length, body_size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append(REQUEST_ID_HEADER, request_id)
+                content_length = headers.get("content-length")
+            elif message["type"] == "http.response.body":
+                body_size += len(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        with logger.contextualize(request_id=request_id):
+            try:
+                await self.app(scope, receive, send_with_request_id)
+            finally:
+                duration = time.perf_counter() - started
+                method = scope["method"]
+                if not _sampled_out(method, status):
+                    _log_request(scope, status, duration, int(content_length) if content_length else body_size)
+
+
+def _log_request(scope: Scope, status: int, duration: float, size: int) -> None:
+    route = getattr(scope.get("route"), "path", None)
+    client: Optional[tuple] = scope.get("client")
+    level = "ERROR" if status >= 500 else "WARNING" if status >= 400 else "INFO"
+    # Keyword arguments become fields of the record (and fill in the message)
+    logger.log(
+        level,
+        "{method} {path} -> {status} in {duration_ms}ms",
+        method=scope["method"],
+        path=scope["path"],
+        query=scope["query_string"].decode("latin-1"),
+        route=route,
+        status=status,
+        duration_ms=round(duration * 1000, 2),
+        response_bytes=size,
+        client=client[0] if client else None,
+        sample_rate=setting.log_request_sample_rate if scope["method"] in SAMPLED_METHODS and status < 400 else 1,
+    )
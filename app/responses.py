@@ -0,0 +1,363 @@
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, List, Optional, Tuple
+import functools
+import inspect
+import os
+import secrets
+import stat
+import anyio
+import orjson
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import ResponseValidationError
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
+
+# Headers a 304 response keeps from the full response (RFC 7232, section 4.1)
+NOT_MODIFIED_HEADERS = ("cache-control", "content-location", "date", "etag", "expires", "last-modified", "vary")
+
+# orjson options for every JSON body: int keys (e.g. id maps) and NumPy values are allowed
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# Ranges beyond this count are answered with the full body instead of a huge multipart response
+MAX_RANGES = 16
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse an RFC 7233 ``Range`` header into a list of inclusive ``(start, end)`` byte ranges.
+
+    Returns ``None`` when the header is malformed (the caller should then ignore it and send the
+    full body) and an empty list when it is well-formed but none of the ranges can be satisfied.
+    Overlapping and adjacent ranges are coalesced.
+    """
+    unit, _, range_set = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not range_set.strip():
+        return None
+
+    ranges = []
+    for spec in range_set.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition("-")
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if first == "":
+                # Suffix range: the final N bytes of the file
+                suffix_length = int(last)
+                if suffix_length < 0:
+                    return None
+                if suffix_length == 0 or file_size == 0:
+                    continue
+                ranges.append((max(file_size - suffix_length, 0), file_size - 1))
+            else:
+                start = int(first)
+                end = int(last) if last else None
+                if start < 0 or (end is not None and end < start):
+                    return None
+                if start >= file_size:
+                    continue
+                ranges.append((start, file_size - 1 if end is None else min(end, file_size - 1)))
+        except ValueError:
+            return None
+
+    ranges.sort()
+    merged: List[Tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RangeFileResponse(FileResponse):
+    """
+    ``FileResponse`` with conditional GET (RFC 7232) and HTTP byte-range support (RFC 7233).
+
+    Answers ``If-None-Match``/``If-Modified-Since`` with ``304 Not Modified``, and handles single and
+    multi-range requests (``206 Partial Content``), ``If-Range`` validation and unsatisfiable
+    ranges (``416``). Pass ``headers={"etag": ...}`` to validate against a content hash instead of
+    the default mtime/size based ETag. Bodies are sent through the ASGI ``zerocopysend``/``pathsend``
+    extensions when the server offers them, and in bounded chunks read off the event loop otherwise.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.stat_result is None:
+            try:
+                self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f"File at path {self.path} does not exist.")
+            if not stat.S_ISREG(self.stat_result.st_mode):
+                raise RuntimeError(f"File at path {self.path} is not a file.")
+            self.set_stat_headers(self.stat_result)
+        self.headers.setdefault("accept-ranges", "bytes")
+
+        file_size = self.stat_result.st_size
+        request_headers = Headers(scope=scope)
+        if self.status_code == 200 and self._is_not_modified(request_headers):
+            await self._send_not_modified(send)
+            return
+
+        ranges = None
+        if self.status_code == 200 and "range" in request_headers and self._if_range_matches(request_headers):
+            ranges = parse_range_header(request_headers["range"], file_size)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                ranges = None
+
+        send_body = scope["method"].upper() != "HEAD"
+        if ranges is None:
+            await self._send_full(scope, send, send_body)
+        elif not ranges:
+            await self._send_unsatisfiable(send, file_size)
+        elif len(ranges) == 1:
+            await self._send_single_range(scope, send, ranges[0], file_size, send_body)
+        else:
+            await self._send_multiple_ranges(send, ranges, file_size, send_body)
+
+        if self.background is not None:
+            await self.background()
+
+    def _is_not_modified(self, request_headers: Headers) -> bool:
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            # If-None-Match uses the weak comparison and takes precedence over If-Modified-Since
+            etag = self.headers.get("etag", "").replace("W/", "")
+            tags = [tag.strip().replace("W/", "") for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = request_headers.get("if-modified-since")
+        if if_modified_since is None:
+            return False
+        try:
+            return parsedate_to_datetime(self.headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError, KeyError):
+            return False
+
+    async def _send_not_modified(self, send: Send) -> None:
+        self.status_code = 304
+        headers = [
+            (name, value) for name, value in self.raw_headers if name.decode("latin-1") in NOT_MODIFIED_HEADERS
+        ]
+        await send({"type": "http.response.start", "status": 304, "headers": headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    def _if_range_matches(self, request_headers: Headers) -> bool:
+        if_range = request_headers.get("if-range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            # Only a strong ETag comparison may validate a range request
+            return not if_range.startswith("W/") and if_range == self.headers.get("etag")
+        try:
+            return parsedate_to_datetime(if_range) == parsedate_to_datetime(self.headers["last-modified"])
+        except (TypeError, ValueError, KeyError):
+            return False
+
+    async def _send_full(self, scope: Scope, send: Send, send_body: bool) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not send_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.pathsend" in scope.get("extensions", {}):
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+        else:
+            await self._send_file_range(scope, send, 0, self.stat_result.st_size, more_body=False)
+
+    async def _send_unsatisfiable(self, send: Send, file_size: int) -> None:
+        self.status_code = 416
+        self.headers["content-range"] = f"bytes */{file_size}"
+        self.headers["content-length"] = "0"
+        del self.headers["content-type"]
+        await send({"type": "http.response.start", "status": 416, "headers": self.raw_headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_single_range(
+        self, scope: Scope, send: Send, byte_range: Tuple[int, int], file_size: int, send_body: bool
+    ) -> None:
+        start, end = byte_range
+        self.status_code = 206
+        self.headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+        self.headers["content-length"] = str(end - start + 1)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        if send_body:
+            await self._send_file_range(scope, send, start, end - start + 1, more_body=False)
+        else:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_multiple_ranges(
+        self, send: Send, ranges: List[Tuple[int, int]], file_size: int, send_body: bool
+    ) -> None:
+        boundary = secrets.token_hex(16)
+        part_content_type = self.media_type or "application/octet-stream"
+        part_headers = [
+            (
+                f"--{boundary}\r\n"
+                f"Content-Type: {part_content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+            ).encode("latin-1")
+            for start, end in ranges
+        ]
+        closing = f"--{boundary}--\r\n".encode("latin-1")
+        content_length = sum(len(header) + (end - start + 1) + 2 for header, (start, end) in zip(part_headers, ranges))
+        content_length += len(closing)
+
+        self.status_code = 206
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(content_length)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        if not send_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            for header, (start, end) in zip(part_headers, ranges):
+                await send({"type": "http.response.body", "body": header, "more_body": True})
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+        await send({"type": "http.response.body", "body": closing, "more_body": False})
+
+    async def _send_file_range(self, scope: Scope, send: Send, offset: int, count: int, more_body: bool) -> None:
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                # Let the server sendfile() straight from the descriptor
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": file.wrapped,
+                        "offset": offset,
+                        "count": count,
+                        "more_body": more_body,
+                    }
+                )
+                return
+            await file.seek(offset)
+            remaining = count
+            while True:
+                chunk = await file.read(min(self.chunk_size, remaining)) if remaining > 0 else b""
+                remaining -= len(chunk)
+                last_chunk = remaining <= 0 or not chunk
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": more_body or not last_chunk,
+                    }
+                )
+                if last_chunk:
+                    break
+
+
+# Pydantic model for confirmation messages
+class Message(BaseModel):
+    message: str
+
+
+def _orjson_default(value: Any) -> Any:
+    # orjson handles dicts, lists, str/int/float, datetimes, UUIDs and enums itself;
+    # anything else goes through FastAPI's encoder
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    return jsonable_encoder(value)
+
+
+def render_json(content: Any) -> bytes:
+    """Encode ``content`` as compact UTF-8 JSON with orjson (the serializer for every API body)."""
+    return orjson.dumps(content, default=_orjson_default, option=ORJSON_OPTIONS)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson, the default response class of the app."""
+
+    def render(self, content: Any) -> bytes:
+        return render_json(content)
+
+
+def response_encoder(response_model: Any = None, exclude_unset: bool = False) -> Callable[[Any], bytes]:
+    """
+    JSON encoder for the results of an endpoint declaring ``response_model``.
+
+    Results are validated against the model (ORM objects are read by attribute) and encoded by
+    pydantic-core in the same pass over the data, so only declared fields are sent and a result
+    that does not match its schema fails the request instead of reaching the client. Without a
+    model results are encoded as they are by ``render_json``.
+    """
+    if response_model is None:
+        return render_json
+    adapter = TypeAdapter(response_model)
+
+    def encode(content: Any) -> bytes:
+        try:
+            validated = adapter.validate_python(content, from_attributes=True)
+        except ValidationError as e:
+            raise ResponseValidationError(errors=e.errors(include_url=False))
+        return adapter.dump_json(validated, exclude_unset=exclude_unset)
+
+    return encode
+
+
+def render_endpoint(
+    endpoint,
+    status_code: Optional[int] = None,
+    response_model: Any = None,
+    exclude_unset: bool = False,
+    run_encoder: Optional[Callable[[Callable[[Any], bytes], Any], bytes]] = None,
+):
+    """
+    Make ``endpoint`` return a JSON ``Response`` of its result, encoded by ``response_encoder``.
+
+    FastAPI would otherwise validate the result against the route's ``response_model``, turn the
+    validated model back into plain values with ``jsonable_encoder`` and only then encode them,
+    walking every value of a large list in Python several times; here validation and encoding are
+    one pass in pydantic-core. Headers and the status code set on the endpoint's ``response`` are
+    kept; results that are already a ``Response`` are returned as is. Endpoints wrapped by
+    ``cache.cached`` encode the entries they store with the same encoder. ``run_encoder(encode,
+    result)``, when given, is called instead of ``encode(result)``, e.g. to move the work to a thread.
+    """
+    encode = response_encoder(response_model, exclude_unset)
+    if hasattr(endpoint, "encode_result"):
+        endpoint.encode_result = encode
+    signature = inspect.signature(endpoint)
+    parameters = list(signature.parameters.values())
+    response_name = next((parameter.name for parameter in parameters if parameter.annotation is Response), None)
+    if response_name is None:
+        # FastAPI injects the Response by annotation
+        parameters.append(inspect.Parameter("_render_response", inspect.Parameter.KEYWORD_ONLY, annotation=Response))
+
+    def render(result: Any, response: Response) -> Response:
+        if isinstance(result, Response):
+            return result
+        body = run_encoder(encode, result) if run_encoder else encode(result)
+        rendered = Response(
+            body, status_code=response.status_code or status_code or 200, media_type="application/json"
+        )
+        rendered.headers.raw.extend(response.headers.raw)
+        return rendered
+
+    def pop_response(kwargs: dict) -> Response:
+        return kwargs[response_name] if response_name else kwargs.pop("_render_response")
+
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(**kwargs):
+            response = pop_response(kwargs)
+            return render(await endpoint(**kwargs), response)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(**kwargs):
+            response = pop_response(kwargs)
+            return render(endpoint(**kwargs), response)
+
+    wrapper.__signature__ = signature.replace(parameters=parameters)
+    return wrapper
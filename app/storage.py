@@ -0,0 +1,268 @@
+from typing import BinaryIO, List
+import gzip
+import hashlib
+import os
+import tempfile
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from loguru import logger
+from database import run_blocking
+from models import AudioBlob
+from compression import brotli
+
+# Directory that holds the uploaded audio files
+AUDIO_DIR = "audio_files"
+# Uploads are copied in chunks of this size so memory use does not grow with the file
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Largest accepted upload (100MB)
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+# Pre-compressed variants stored next to a blob, by Content-Encoding. They are written once per
+# blob, so the strongest levels that stay reasonably fast are used.
+SIDECAR_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+SIDECAR_GZIP_LEVEL = 9
+SIDECAR_BROTLI_QUALITY = 9
+# A variant is only kept when it saves at least this share of the original size
+SIDECAR_MIN_SAVING = 0.1
+# Files derived from a blob by the analysis workers (see renditions.py), by name
+RENDITION_SUFFIXES = {"peaks": ".peaks", "preview": ".preview"}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class StagedUpload:
+    """An upload written to a temporary file, waiting to be moved into place."""
+
+    def __init__(self, temp_path: str, content_hash: str, size: int):
+        self.temp_path = temp_path
+        self.content_hash = content_hash
+        self.size = size
+
+    def commit(self, destination: str) -> None:
+        # mkstemp creates owner-only files, give the final file the usual permissions
+        os.chmod(self.temp_path, 0o644)
+        # os.replace is atomic, so readers never see a partially written file
+        os.replace(self.temp_path, destination)
+
+    def discard(self) -> None:
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def _copy_to_temp(source: BinaryIO, directory: str) -> StagedUpload:
+    os.makedirs(directory, exist_ok=True)
+    # The temporary file lives next to its destination so the final rename stays on one filesystem
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise UploadTooLarge()
+                sha256.update(chunk)
+                temp_file.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return StagedUpload(temp_path, sha256.hexdigest(), size)
+
+
+async def stage_upload(upload: UploadFile, directory: str = AUDIO_DIR) -> StagedUpload:
+    """
+    Stream an uploaded file into a temporary file in ``directory``, hashing it on the way.
+
+    The copy runs in the threadpool in bounded chunks, so it neither blocks the event loop nor
+    holds the whole file in memory. Raises ``UploadTooLarge`` past ``MAX_UPLOAD_SIZE``.
+    """
+    return await run_in_threadpool(_copy_to_temp, upload.file, directory)
+
+
+def blob_path(content_hash: str) -> str:
+    """Location of a content-addressed blob, sharded on the first two hash bytes (``ab/cd/abcd...``)."""
+    return os.path.join(AUDIO_DIR, content_hash[:2], content_hash[2:4], content_hash)
+
+
+def store_blob(staged: StagedUpload) -> str:
+    """Move a staged upload to its blob path and return that path."""
+    destination = blob_path(staged.content_hash)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    # Replacing an existing blob is as cheap as discarding the upload (same content, one rename),
+    # and it restores the file if it was removed while this upload was in flight
+    staged.commit(destination)
+    return destination
+
+
+def _remove_blob_files(content_hash: str) -> None:
+    paths = [blob_path(content_hash)]
+    paths += [sidecar_path(content_hash, encoding) for encoding in SIDECAR_SUFFIXES]
+    paths += [rendition_path(content_hash, name) for name in RENDITION_SUFFIXES]
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def sidecar_path(content_hash: str, encoding: str) -> str:
+    return blob_path(content_hash) + SIDECAR_SUFFIXES[encoding]
+
+
+def available_sidecars(content_hash: str) -> List[str]:
+    """Content codings a blob has a pre-compressed variant for, preferred first."""
+    return [encoding for encoding in SIDECAR_SUFFIXES if os.path.exists(sidecar_path(content_hash, encoding))]
+
+
+def rendition_path(content_hash: str, name: str) -> str:
+    return blob_path(content_hash) + RENDITION_SUFFIXES[name]
+
+
+def write_rendition(content_hash: str, name: str, data: bytes) -> None:
+    """Atomically write a rendition of a blob, replacing any previous one."""
+    source = blob_path(content_hash)
+    destination = rendition_path(content_hash, name)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(source), prefix=".rendition-", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if not os.path.exists(source):
+        # The blob was removed while its rendition was being written
+        os.remove(destination)
+
+
+def is_wav(path: str) -> bool:
+    with open(path, "rb") as file:
+        header = file.read(12)
+    return header[:4] == b"RIFF" and header[8:12] == b"WAVE"
+
+
+def _write_sidecar(content_hash: str, encoding: str) -> None:
+    source = blob_path(content_hash)
+    destination = sidecar_path(content_hash, encoding)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(source), prefix=".sidecar-", suffix=".part")
+    try:
+        with open(source, "rb") as blob, os.fdopen(fd, "wb") as temp_file:
+            if encoding == "br":
+                compressor = brotli.Compressor(quality=SIDECAR_BROTLI_QUALITY)
+                while True:
+                    chunk = blob.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    temp_file.write(compressor.process(chunk))
+                temp_file.write(compressor.finish())
+            else:
+                # mtime=0 keeps the variant identical for identical content
+                with gzip.GzipFile(fileobj=temp_file, mode="wb", compresslevel=SIDECAR_GZIP_LEVEL, mtime=0) as gzip_file:
+                    while True:
+                        chunk = blob.read(UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        gzip_file.write(chunk)
+        if os.path.getsize(temp_path) > os.path.getsize(source) * (1 - SIDECAR_MIN_SAVING):
+            os.remove(temp_path)
+            return
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if not os.path.exists(source):
+        # The blob was removed while its variant was being written
+        os.remove(destination)
+
+
+def precompress_blob(content_hash: str) -> None:
+    """
+    Write the pre-compressed variants of a blob, unless they already exist.
+
+    Only WAV files are compressed: MP3 and other encoded formats do not shrink. Runs in the
+    analysis worker processes (see ``analysis.analyze_file``), never in the API process where
+    compressing up to ``MAX_UPLOAD_SIZE`` at these levels would hold a threadpool slot for
+    seconds; download requests serve the identity file until the variants are in place.
+    """
+    try:
+        if not is_wav(blob_path(content_hash)):
+            return
+        for encoding in SIDECAR_SUFFIXES:
+            if encoding == "br" and brotli is None:
+                continue
+            if not os.path.exists(sidecar_path(content_hash, encoding)):
+                _write_sidecar(content_hash, encoding)
+    except OSError as e:
+        logger.error(f"Failed to pre-compress blob {content_hash}: {e}")
+
+
+def acquire_blob(db: Session, content_hash: str, size: int) -> None:
+    """Add a reference to a blob, creating its row on first use. Commit is left to the caller."""
+    updated = db.query(AudioBlob).filter(AudioBlob.content_hash == content_hash).update(
+        {AudioBlob.ref_count: AudioBlob.ref_count + 1}, synchronize_session=False
+    )
+    if updated:
+        return
+    try:
+        with db.begin_nested():
+            db.add(AudioBlob(content_hash=content_hash, size=size, ref_count=1))
+    except IntegrityError:
+        # A concurrent upload of the same content created the row first
+        db.query(AudioBlob).filter(AudioBlob.content_hash == content_hash).update(
+            {AudioBlob.ref_count: AudioBlob.ref_count + 1}, synchronize_session=False
+        )
+
+
+def release_blob(db: Session, content_hash: str) -> bool:
+    """
+    Drop a reference to a blob. Commit is left to the caller.
+
+    Returns ``True`` when this was the last reference; the caller should then ``remove_blob`` once
+    the transaction has committed. The row is kept (with no references) until then, so a
+    concurrent upload of the same content finds it and waits for the removal.
+    """
+    updated = db.query(AudioBlob).filter(AudioBlob.content_hash == content_hash).update(
+        {AudioBlob.ref_count: AudioBlob.ref_count - 1}, synchronize_session=False
+    )
+    if not updated:
+        # Files stored before the blob store existed are not reference counted
+        return False
+    ref_count = db.query(AudioBlob.ref_count).filter(AudioBlob.content_hash == content_hash).scalar()
+    return ref_count <= 0
+
+
+def remove_blob(db: Session, content_hash: str) -> bool:
+    """
+    Delete a blob without references, its row and its files, in a transaction of its own.
+
+    The row is locked and checked again first: an upload of the same content may have taken a
+    new reference since it was released. That upload's ``acquire_blob`` waits on the lock and,
+    once the row is gone, creates a new one and moves its own file into place afterwards.
+    Returns ``True`` when the blob was removed.
+    """
+    try:
+        blob = db.query(AudioBlob).filter(AudioBlob.content_hash == content_hash).with_for_update().first()
+        if blob is None or blob.ref_count > 0:
+            db.rollback()
+            return False
+        db.delete(blob)
+        # Flushed before the files go, so the write lock is held on databases without row locks
+        db.flush()
+        run_blocking(_remove_blob_files, content_hash)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
@@ -0,0 +1,132 @@
+from typing import List, Optional, Tuple
+import threading
+import time
+import numpy as np
+from sqlalchemy.orm import Session
+from models import AudioFile
+from cache import AUDIOS, response_cache
+
+# Tempo relations considered when matching a cadence: a file at half or double the requested
+# tempo still puts a beat on every step (or every other step). Listed in tie-break order.
+RELATIONS = (("direct", 1.0), ("half", 0.5), ("double", 2.0))
+# Columns kept in memory for every audio file with a tempo, returned with each match
+MATCH_FIELDS = ("id", "name", "type", "genre", "key", "bpm")
+TYPE, GENRE, BPM = (MATCH_FIELDS.index(field) for field in ("type", "genre", "bpm"))
+# Seconds a snapshot is used at most, even when no invalidation was seen (a worker only sees
+# its own writes with the memory cache backend, or misses some when Redis is unreachable)
+MAX_AGE_SECONDS = 60
+
+
+class TempoSnapshot:
+    """
+    Immutable copy of the matchable audio files: ``rows`` are tuples of ``MATCH_FIELDS``, sorted
+    by bpm.
+
+    Tempos are a sorted NumPy array, so the candidates of one tempo relation are a contiguous
+    slice found by binary search; genre and type are small integer codes so filters are
+    vectorized comparisons on that slice. Only the matches returned are turned into dicts.
+    """
+
+    def __init__(self, rows: List[tuple], generation: Tuple[int, ...]):
+        self.generation = generation
+        self.built_at = time.monotonic()
+        self.rows = rows
+        self.tempos = np.fromiter((row[BPM] for row in rows), dtype=np.float64, count=len(rows))
+        self.genre_codes, self.genres = self._encode(rows, GENRE)
+        self.type_codes, self.types = self._encode(rows, TYPE)
+
+    @staticmethod
+    def _encode(rows: List[tuple], column: int):
+        codes = {}
+        values = np.fromiter(
+            (codes.setdefault(row[column], len(codes)) for row in rows), dtype=np.int32, count=len(rows)
+        )
+        return codes, values
+
+    def is_current(self, generation: Tuple[int, ...]) -> bool:
+        return self.generation == generation and time.monotonic() - self.built_at < MAX_AGE_SECONDS
+
+    def match(self, bpm: float, tolerance: float, genre=None, type: Optional[str] = None, limit: int = 20) -> List[dict]:
+        """
+        Audio files whose tempo, or half or double of it, is within ``tolerance`` of ``bpm``.
+
+        Matches are ranked by how far their (scaled) tempo is from ``bpm``; on ties direct matches
+        come before half and double tempo ones. A file matching several relations (only possible
+        with a very wide tolerance) is returned once, for its best one.
+        """
+        genre_code = self.genre_codes.get(genre) if genre is not None else None
+        type_code = self.type_codes.get(type) if type is not None else None
+        if (genre is not None and genre_code is None) or (type is not None and type_code is None):
+            return []
+        positions, distances, relations = [], [], []
+        for rank, (_, factor) in enumerate(RELATIONS):
+            low = np.searchsorted(self.tempos, (bpm - tolerance) * factor, side="left")
+            high = np.searchsorted(self.tempos, (bpm + tolerance) * factor, side="right")
+            candidates = np.arange(low, high)
+            if genre_code is not None:
+                candidates = candidates[self.genres[candidates] == genre_code]
+            if type_code is not None:
+                candidates = candidates[self.types[candidates] == type_code]
+            positions.append(candidates)
+            distances.append(np.abs(self.tempos[candidates] / factor - bpm))
+            relations.append(np.full(len(candidates), rank))
+        positions = np.concatenate(positions)
+        distances = np.concatenate(distances)
+        relations = np.concatenate(relations)
+        order = np.lexsort((relations, distances))
+        # Keep the first (best) occurrence of every file
+        _, first = np.unique(positions[order], return_index=True)
+        order = order[np.sort(first)][:limit]
+        return [
+            {
+                **dict(zip(MATCH_FIELDS, self.rows[position])),
+                "relation": RELATIONS[relation][0],
+                "distance": round(float(distance), 2),
+            }
+            for position, relation, distance in zip(positions[order], relations[order], distances[order])
+        ]
+
+
+class TempoIndex:
+    """
+    In-memory tempo index of the audio library, one per worker process.
+
+    The snapshot is rebuilt from the database after any write to the audio files: it remembers
+    the ``AUDIOS`` cache generation it was built at and is stale once that moves on (with the
+    redis cache backend this also covers writes made through other workers). Snapshots older
+    than ``MAX_AGE_SECONDS`` are rebuilt as well. While one request rebuilds, concurrent requests
+    keep matching against the previous snapshot.
+    """
+
+    def __init__(self):
+        self._snapshot: Optional[TempoSnapshot] = None
+        self._lock = threading.Lock()
+
+    def snapshot(self, db: Session) -> TempoSnapshot:
+        generation = response_cache.generations((AUDIOS,))
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.is_current(generation):
+            return snapshot
+        # Only one rebuild at a time; others use the stale snapshot if there is one
+        if not self._lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            snapshot = self._snapshot
+            if snapshot is None or not snapshot.is_current(generation):
+                snapshot = self._snapshot = self.build(db, generation)
+            return snapshot
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def build(db: Session, generation: Tuple[int, ...]) -> TempoSnapshot:
+        # The generation is read before the query, so a write racing the rebuild triggers another one
+        columns = [getattr(AudioFile, field) for field in MATCH_FIELDS]
+        rows = db.query(*columns).filter(AudioFile.bpm.isnot(None)).order_by(AudioFile.bpm, AudioFile.id).all()
+        return TempoSnapshot(rows, generation)
+
+    def match(self, db: Session, bpm: float, tolerance: float, genre=None, type: Optional[str] = None, limit: int = 20) -> List[dict]:
+        return self.snapshot(db).match(bpm, tolerance, genre, type, limit)
+
+
+tempo_index = TempoIndex()
@@ -0,0 +1,112 @@
+"""
+Compare requests/sec of the sync (threadpool) and async (asyncpg) database paths.
+
+Starts the API twice with uvicorn, once with DATABASE_ASYNC=false and once with
+DATABASE_ASYNC=true, against the database configured in the environment, and drives the given
+paths with many concurrent clients. The read cache is disabled so every request reaches the
+database.
+
+    pipenv run python benchmarks/bench_async.py --concurrency 200 --duration 20 \
+        --path /api/configs/list --path /api/configs/1/graph
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def start_server(port: int, database_async: bool) -> subprocess.Popen:
+    env = dict(os.environ, DATABASE_ASYNC=str(database_async).lower(), CACHE_TTL_SECONDS="0")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=APP_DIR,
+        env=env,
+    )
+
+
+async def wait_ready(base_url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/openapi.json")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start")
+
+
+async def run_load(base_url: str, paths, concurrency: int, duration: float) -> dict:
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async def worker(client: httpx.AsyncClient, offset: int, deadline: float) -> None:
+        nonlocal errors
+        index = offset
+        while time.monotonic() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                if response.status_code >= 500:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*(worker(client, offset, deadline) for offset in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", action="append", dest="paths", help="Path to request (repeatable)")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    paths = args.paths or ["/api/configs/list", "/api/audiofiles/list"]
+
+    results = {}
+    for database_async in (False, True):
+        server = start_server(args.port, database_async)
+        try:
+            base_url = f"http://127.0.0.1:{args.port}"
+            await wait_ready(base_url)
+            results["async" if database_async else "sync"] = await run_load(base_url, paths, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{'mode':<6} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    for mode, result in results.items():
+        print(
+            f"{mode:<6} {result['requests_per_second']:>10.1f} {result['p50_ms']:>10.1f} "
+            f"{result['p95_ms']:>10.1f} {result['p99_ms']:>10.1f} {result['errors']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""
+Per-request cost of request logging, before and after the structured, queued request log.
+
+Drives a minimal app through the ASGI interface in-process (no sockets, no database), so only
+the routing and logging work is timed. Every variant writes to a log file in a temporary
+directory:
+
+    none         no request logging (baseline)
+    before       log_request router dependency with an f-string message, synchronous DEBUG file sink
+    enqueue      RequestLogMiddleware, JSON file sink with loguru's enqueue=True (for comparison)
+    after        RequestLogMiddleware, JSON lines through request_log.QueuedWriter, every request logged
+    sampled      as after, with log_request_sample_rate=0.1 (1 in 10 successful GETs logged)
+
+"request us" is the time spent in the request path (best of --rounds runs), "overhead" the
+difference to the baseline; "drain ms" is how long a queued sink still needed to write its
+backlog afterwards.
+
+    pipenv run python benchmarks/bench_logging.py --requests 20000 --rounds 3
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+# Only the logging code is used, the settings just have to be present
+for name in ("DATABASE_URL", "DATABASE_NAME", "DATABASE_USER", "DATABASE_PASSWORD", "DATABASE_PORT"):
+    os.environ.setdefault(name, "benchmark")
+
+from fastapi import APIRouter, Depends, FastAPI, Request
+from loguru import logger
+import request_log
+from config import setting
+
+SCOPE = {
+    "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+    "path": "/api/ping", "raw_path": b"/api/ping", "query_string": b"limit=10", "root_path": "",
+    "headers": [(b"host", b"benchmark"), (b"user-agent", b"bench_logging")],
+    "client": ("127.0.0.1", 50000), "server": ("benchmark", 80),
+}
+
+
+async def log_request(request: Request):
+    # The request logging this benchmark replaces (a router dependency in main.py)
+    logger.info(f"[{request.client.host}] {request.method} {request.url}")
+
+
+def build_app(dependencies=(), middleware=None) -> FastAPI:
+    app = FastAPI()
+    router = APIRouter()
+
+    @router.get("/api/ping")
+    async def ping():
+        return {"pong": True}
+
+    app.include_router(router, dependencies=list(dependencies))
+    if middleware is not None:
+        app.add_middleware(middleware)
+    return app
+
+
+async def drive(app: FastAPI, requests: int) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    # Warm up (builds the middleware stack)
+    for _ in range(100):
+        await app(dict(SCOPE), receive, send)
+    started = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(SCOPE), receive, send)
+    return time.perf_counter() - started
+
+
+def run(app: FastAPI, requests: int, add_sink, sample_rate: float = 1.0) -> tuple:
+    logger.remove()
+    if add_sink is not None:
+        add_sink()
+    setting.log_request_sample_rate = sample_rate
+    seconds = asyncio.run(drive(app, requests))
+    started = time.perf_counter()
+    logger.remove()  # Waits for queued sinks to finish writing
+    drain = time.perf_counter() - started
+    return seconds / requests * 1e6, drain * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000, help="Requests per run")
+    parser.add_argument("--rounds", type=int, default=3, help="Runs per variant, the fastest is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        def before_sink():
+            # The sink main.py used to add
+            logger.add(os.path.join(directory, "{time}.log"), rotation=datetime.time(0, 0, 0), encoding="utf-8", level="DEBUG")
+
+        def enqueue_sink():
+            logger.add(
+                os.path.join(directory, "enqueue.log"), format=request_log._json_format, encoding="utf-8",
+                level="INFO", enqueue=True,
+            )
+
+        def after_sink():
+            sink = request_log.QueuedWriter(request_log.DailyLogFile(directory, 1), "bench-log")
+            logger.add(sink, format=request_log._json_format, level="INFO")
+
+        variants = [
+            ("none", build_app(), None, 1.0),
+            ("before", build_app(dependencies=[Depends(log_request)]), before_sink, 1.0),
+            ("enqueue", build_app(middleware=request_log.RequestLogMiddleware), enqueue_sink, 1.0),
+            ("after", build_app(middleware=request_log.RequestLogMiddleware), after_sink, 1.0),
+            ("sampled", build_app(middleware=request_log.RequestLogMiddleware), after_sink, 0.1),
+        ]
+        results = {
+            name: min(run(app, args.requests, add_sink, rate) for _ in range(args.rounds))
+            for name, app, add_sink, rate in variants
+        }
+    baseline = results["none"][0]
+    print(f"{'variant':<10} {'request us':>11} {'overhead us':>12} {'drain ms':>9}")
+    for name, (per_request, drain) in results.items():
+        print(f"{name:<10} {per_request:>11.1f} {per_request - baseline:>12.1f} {drain:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Micro-benchmark of response serialization, per row, for every resource.
+
+Rows are built in memory in the shape the endpoints return (dicts from Core rows, nested dicts
+for a config graph), so only serialization is measured; no database is needed. Three paths are
+compared:
+
+    fastapi   response_model validation, jsonable_encoder and json.dumps (FastAPI's default)
+    pydantic  validation and dump_json through the typed response schema in one pass, the path
+              used by the API routers (responses.response_encoder)
+    orjson    responses.render_json without validation, used for results without a schema
+              and the NDJSON export
+
+    pipenv run python benchmarks/bench_serialization.py --rows 1000 --repeat 20
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+# Only the schemas are imported, the settings just have to be present
+for name in ("DATABASE_URL", "DATABASE_NAME", "DATABASE_USER", "DATABASE_PASSWORD", "DATABASE_PORT"):
+    os.environ.setdefault(name, "benchmark")
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from models import GenreEnum
+from responses import render_json, response_encoder
+from endpoint.actions import ActionOut
+from endpoint.audios import AudioFileOut
+from endpoint.configs import ConfigGraph, ConfigOut
+from endpoint.events import EventOut
+from endpoint.tracks import TrackOut
+
+
+def audio_row(i: int) -> dict:
+    return {
+        "id": i, "name": f"audio {i}", "author": "Sonicstride", "type": "sample", "genre": GenreEnum.Ambient,
+        "key": "C", "bpm": 120, "file_path": f"audio_files/ab/cd/{i:064x}", "filename": f"audio_{i}.wav",
+        "content_hash": f"{i:064x}",
+    }
+
+
+def config_row(i: int) -> dict:
+    return {
+        "id": i, "name": f"config {i}", "author": "Sonicstride", "interaction_type": "Running", "bpm": 120,
+        "create_time": datetime.datetime(2024, 1, 1, 12, 0, i % 60), "labels": "calm,focus",
+        "audios": [{"id": j, "name": f"audio {j}"} for j in range(4)],
+    }
+
+
+def track_row(i: int) -> dict:
+    return {
+        "id": i, "config_id": 1, "name": f"track {i}", "type": "sample", "loop": True, "decay": False,
+        "initial_gain": 0.8, "track_initial_gain": 1.0, "track_gain_node": {"gain": 0.5},
+        "effect_nodes": {"lowpass": {"frequency": 800, "q": 1.2}, "delay": {"time": 0.25}},
+    }
+
+
+def event_row(i: int) -> dict:
+    return {"id": i, "track_id": 1, "type": "start"}
+
+
+def action_row(i: int) -> dict:
+    return {"id": i, "event_id": 1, "target": "gain", "property": "gain", "method": "linearRamp", "value": 0.5, "end_time": 2.0}
+
+
+def config_graph(rows: int) -> dict:
+    # One config whose tracks, events and actions add up to about ``rows`` rows
+    tracks = []
+    for t in range(max(rows // 10, 1)):
+        events = [
+            {**event_row(t * 3 + e), "actions": [action_row((t * 3 + e) * 2 + a) for a in range(2)]}
+            for e in range(3)
+        ]
+        tracks.append({**track_row(t), "events": events})
+    return {**config_row(1), "audios": [audio_row(j) for j in range(4)], "tracks": tracks}
+
+
+def fastapi_default(content) -> bytes:
+    # What FastAPI does with a validated response_model and the default JSONResponse
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="Rows per response")
+    parser.add_argument("--repeat", type=int, default=20, help="Responses encoded per measurement")
+    args = parser.parse_args()
+
+    # (resource, response content, rows in it, typed schema)
+    cases = [
+        ("audiofiles", [audio_row(i) for i in range(args.rows)], args.rows, List[AudioFileOut]),
+        ("configs", [config_row(i) for i in range(args.rows)], args.rows, List[ConfigOut]),
+        ("tracks", [track_row(i) for i in range(args.rows)], args.rows, List[TrackOut]),
+        ("events", [event_row(i) for i in range(args.rows)], args.rows, List[EventOut]),
+        ("actions", [action_row(i) for i in range(args.rows)], args.rows, List[ActionOut]),
+    ]
+    graph = config_graph(args.rows)
+    graph_rows = 1 + len(graph["audios"]) + sum(
+        1 + sum(1 + len(event["actions"]) for event in track["events"]) for track in graph["tracks"]
+    )
+    cases.append(("config graph", graph, graph_rows, ConfigGraph))
+
+    print(f"{'resource':<14} {'rows':>6} {'fastapi us/row':>15} {'pydantic us/row':>16} {'orjson us/row':>14} {'speedup':>8}")
+    for resource, content, rows, typed in cases:
+        typed_adapter = TypeAdapter(typed)
+        paths = {
+            "fastapi": lambda content: fastapi_default(typed_adapter.dump_python(typed_adapter.validate_python(content))),
+            "pydantic": response_encoder(typed),
+            "orjson": render_json,
+        }
+        per_row = {}
+        for name, encode in paths.items():
+            encode(content)  # warm up
+            seconds = min(timeit.repeat(lambda: encode(content), number=args.repeat, repeat=3))
+            per_row[name] = seconds / args.repeat / rows * 1e6
+        print(
+            f"{resource:<14} {rows:>6} {per_row['fastapi']:>15.2f} {per_row['pydantic']:>16.2f} "
+            f"{per_row['orjson']:>14.2f} {per_row['fastapi'] / per_row['pydantic']:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# The app modules import each other by top-level name (as when run from app/) and read their
+# settings from the environment; the database settings are required but never used by the tests
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIRECTORY)
+for name in ("DATABASE_URL", "DATABASE_NAME", "DATABASE_USER", "DATABASE_PASSWORD", "DATABASE_PORT"):
+    os.environ.setdefault(name, "test")
+
+import request_log  # noqa: E402
+
+# Keep the app's log files out of the working tree
+request_log.LOG_DIRECTORY = tempfile.mkdtemp(prefix="sonicstride-test-logs-")
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    # Every test starts on a new database: drop what earlier tests cached
+    from cache import GRAPH, response_cache
+
+    response_cache.invalidate(*GRAPH)
+
+
+@pytest.fixture
+def engine():
+    # One in-memory SQLite database per test, shared by every session and thread
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.pool import StaticPool
+    import database
+    import models  # noqa: F401 (registers the tables on the metadata)
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    # Enforce foreign keys like PostgreSQL does
+    event.listen(engine, "connect", lambda connection, record: connection.execute("PRAGMA foreign_keys=ON"))
+    database.Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def client(engine):
+    from fastapi.testclient import TestClient
+    from sqlalchemy.orm import sessionmaker
+    import database
+    import main
+
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def get_test_database():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    main.app.dependency_overrides[database.get_database] = get_test_database
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
@@ -0,0 +1,82 @@
+"""
+Reference-counted blob store (see storage.py): uploads of the same content share one blob, which
+is removed with its last reference.
+"""
+import os
+import pytest
+from sqlalchemy.orm import sessionmaker
+import storage
+from models import AudioBlob
+
+
+@pytest.fixture(autouse=True)
+def audio_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "AUDIO_DIR", str(tmp_path / "audio_files"))
+
+
+@pytest.fixture
+def db(engine):
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def upload(client, content: bytes, name: str = "audio") -> dict:
+    response = client.post(
+        "/api/audiofiles/",
+        data={"name": name, "type": "sample"},
+        files={"audio_file": (f"{name}.wav", content, "audio/wav")},
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+def ref_count(db, content_hash: str):
+    db.expire_all()
+    blob = db.get(AudioBlob, content_hash)
+    return blob.ref_count if blob is not None else None
+
+
+def test_same_content_shares_one_blob_until_the_last_delete(client, db):
+    first = upload(client, b"RIFF same content", "first")
+    second = upload(client, b"RIFF same content", "second")
+    content_hash = first["content_hash"]
+    assert second["content_hash"] == content_hash
+    assert first["file_path"] == second["file_path"] == storage.blob_path(content_hash)
+    assert ref_count(db, content_hash) == 2
+    storage.write_rendition(content_hash, "peaks", b"\x00\x01")
+
+    assert client.delete(f"/api/audiofiles/{first['id']}").status_code == 200
+    assert ref_count(db, content_hash) == 1
+    assert os.path.exists(storage.blob_path(content_hash))
+
+    assert client.delete(f"/api/audiofiles/{second['id']}").status_code == 200
+    assert ref_count(db, content_hash) is None
+    assert not os.path.exists(storage.blob_path(content_hash))
+    assert not os.path.exists(storage.rendition_path(content_hash, "peaks"))
+
+
+def test_different_content_gets_different_blobs(client, db):
+    first = upload(client, b"RIFF one")
+    second = upload(client, b"RIFF two")
+    assert first["content_hash"] != second["content_hash"]
+    assert ref_count(db, first["content_hash"]) == ref_count(db, second["content_hash"]) == 1
+
+
+def test_blob_referenced_again_after_release_is_kept(client, db):
+    content_hash = upload(client, b"RIFF reused")["content_hash"]
+    assert storage.release_blob(db, content_hash)
+    db.commit()
+    # An upload of the same content takes a new reference before the removal runs
+    storage.acquire_blob(db, content_hash, 11)
+    db.commit()
+    assert not storage.remove_blob(db, content_hash)
+    assert ref_count(db, content_hash) == 1
+    assert os.path.exists(storage.blob_path(content_hash))
+
+
+def test_delete_all_removes_every_blob(client, db):
+    hashes = [upload(client, content)["content_hash"] for content in (b"RIFF a", b"RIFF a", b"RIFF b")]
+    assert client.delete("/api/audiofiles/delete_all").status_code == 200
+    assert db.query(AudioBlob).count() == 0
+    assert not any(os.path.exists(storage.blob_path(content_hash)) for content_hash in hashes)
@@ -0,0 +1,115 @@
+"""
+Bulk create, update and delete endpoints (see bulk.py): bad items are reported by index while the
+good ones are written, deletes treat children like the single delete, and the number of SQL
+statements does not grow with the batch.
+"""
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from models import Config, Event, Track
+
+
+@pytest.fixture
+def db(engine):
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def config_id(db):
+    config = Config(name="config", interaction_type="running", bpm=120)
+    db.add(config)
+    db.commit()
+    return config.id
+
+
+def add_tracks(db, config_id: int, count: int) -> list:
+    tracks = [Track(config_id=config_id, name=f"track {index}", type="sample") for index in range(count)]
+    db.add_all(tracks)
+    db.commit()
+    return [track.id for track in tracks]
+
+
+def count_statements(engine, call):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = call()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return response, len(statements)
+
+
+def test_bulk_create_reports_unknown_parents_and_creates_the_rest(client, config_id):
+    items = [
+        {"config_id": str(config_id), "name": "a", "type": "sample"},
+        {"config_id": "9999", "name": "b", "type": "sample"},
+        {"config_id": str(config_id), "name": "c", "type": "section"},
+    ]
+    response = client.post("/api/tracks/bulk", json=items)
+    assert response.status_code == 200
+    result = response.json()
+    assert [(row["index"], row["name"]) for row in result["created"]] == [(0, "a"), (2, "c")]
+    assert result["errors"] == [{"index": 1, "detail": "Config ID 9999 not found"}]
+
+
+def test_bulk_update_reports_unknown_ids_and_null_parents(client, db, config_id):
+    ids = add_tracks(db, config_id, 2)
+    items = [
+        {"id": ids[0], "name": "renamed"},
+        {"id": 9999, "name": "missing"},
+        {"id": ids[1], "config_id": None},
+    ]
+    response = client.put("/api/tracks/bulk", json=items)
+    assert response.status_code == 200
+    assert response.json() == {
+        "updated": [ids[0]],
+        "errors": [
+            {"index": 1, "detail": "Track ID 9999 not found"},
+            {"index": 2, "detail": "config_id is required"},
+        ],
+    }
+    db.expire_all()
+    assert db.get(Track, ids[0]).name == "renamed"
+    assert db.get(Track, ids[1]).config_id == config_id
+
+
+def test_bulk_delete_keeps_children_like_the_single_delete(client, db, config_id):
+    ids = add_tracks(db, config_id, 2)
+    db.add(Event(track_id=ids[0], type="start"))
+    db.commit()
+    response = client.post("/api/tracks/bulk/delete", json={"ids": [ids[0], 9999, ids[1]]})
+    assert response.status_code == 200
+    assert response.json() == {
+        "deleted": [ids[0], ids[1]],
+        "errors": [{"index": 1, "detail": "Track ID 9999 not found"}],
+    }
+    db.expire_all()
+    assert db.query(Track).count() == 0
+    # As with DELETE /api/tracks/{id}, the event stays without a track
+    assert [event.track_id for event in db.query(Event)] == [None]
+
+
+@pytest.mark.parametrize("size", [10, 100])
+def test_bulk_statement_count_does_not_grow_with_items(engine, client, db, config_id, size):
+    create = [{"config_id": str(config_id), "name": f"t{index}", "type": "sample"} for index in range(size)]
+    response, create_statements = count_statements(engine, lambda: client.post("/api/tracks/bulk", json=create))
+    ids = [row["id"] for row in response.json()["created"]]
+    assert len(ids) == size
+    if engine.dialect.name != "sqlite":
+        # Validation query and one multi-row INSERT (SQLite cannot return the rows of a batch in
+        # order, so SQLAlchemy inserts them one by one there)
+        assert create_statements == 2
+    update = [{"id": row_id, "config_id": str(config_id), "name": "renamed"} for row_id in ids]
+    response, update_statements = count_statements(engine, lambda: client.put("/api/tracks/bulk", json=update))
+    assert len(response.json()["updated"]) == size
+    delete = {"ids": ids}
+    response, delete_statements = count_statements(engine, lambda: client.post("/api/tracks/bulk/delete", json=delete))
+    assert len(response.json()["deleted"]) == size
+    # Parent and id validation queries and one executemany UPDATE; the children UPDATE and one DELETE
+    assert (update_statements, delete_statements) == (3, 2)
@@ -0,0 +1,157 @@
+"""
+Read-through response cache (see cache.py): hits skip the database, writes invalidate the
+namespaces they touch, and the memory and Redis backends behave alike.
+"""
+from sqlalchemy import event
+import cache
+from cache import AUDIOS, CONFIGS, MemoryBackend, RedisBackend, cached_value
+from listing import NEXT_CURSOR_HEADER
+
+
+def count_statements(engine, call):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = call()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return response, len(statements)
+
+
+def create_config(client, name: str) -> dict:
+    response = client.post("/api/configs/", json={"name": name})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_hit_skips_the_database_and_keeps_headers(engine, client):
+    for name in ("a", "b"):
+        create_config(client, name)
+    first, statements = count_statements(engine, lambda: client.get("/api/configs/list?limit=1"))
+    assert statements > 0
+    second, statements = count_statements(engine, lambda: client.get("/api/configs/list?limit=1"))
+    assert statements == 0
+    assert second.json() == first.json()
+    assert second.headers[NEXT_CURSOR_HEADER] == first.headers[NEXT_CURSOR_HEADER]
+
+
+def test_query_string_is_part_of_the_key(client):
+    for name in ("a", "b"):
+        create_config(client, name)
+    assert len(client.get("/api/configs/list?limit=1").json()) == 1
+    assert len(client.get("/api/configs/list?limit=2").json()) == 2
+
+
+def test_write_invalidates_its_namespace(client):
+    config = create_config(client, "before")
+    assert [row["name"] for row in client.get("/api/configs/list").json()] == ["before"]
+    assert client.put(f"/api/configs/{config['id']}", json={"name": "after"}).status_code == 200
+    assert [row["name"] for row in client.get("/api/configs/list").json()] == ["after"]
+
+
+def test_graph_is_invalidated_by_writes_to_its_children(client):
+    config = create_config(client, "graph")
+    assert client.get(f"/api/configs/{config['id']}/graph").json()["tracks"] == []
+    track = {"config_id": str(config["id"]), "name": "track", "type": "sample"}
+    assert client.post("/api/tracks/", json=track).status_code == 200
+    assert [row["name"] for row in client.get(f"/api/configs/{config['id']}/graph").json()["tracks"]] == ["track"]
+
+
+class FakeRedis:
+    """The few redis.Redis calls RedisBackend makes, in memory; TTLs are recorded, not applied."""
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+        self.hashes = {}
+        self.published = []
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, px=None):
+        if px is not None and px <= 0:
+            raise ValueError("invalid expire time in 'set' command")
+        self.values[key] = value
+        self.ttls[key] = px
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def hincrby(self, key, field, amount):
+        values = self.hashes.setdefault(key, {})
+        values[field] = values.get(field, 0) + amount
+        return values[field]
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(ttl=60, max_entries=2)
+    backend.set("a", b"1")
+    backend.set("b", b"2")
+    assert backend.get("a") == b"1"
+    backend.set("c", b"3")
+    assert backend.get("b") is None
+    assert (backend.get("a"), backend.get("c")) == (b"1", b"3")
+
+
+def test_memory_backend_expires_entries(monkeypatch):
+    backend = MemoryBackend(ttl=60, max_entries=10)
+    backend.set("a", b"1")
+    now = cache.time.monotonic()
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now + 61)
+    assert backend.get("a") is None
+
+
+def test_redis_backend_shares_entries_and_generations():
+    client = FakeRedis()
+    writer, reader = RedisBackend(60, client), RedisBackend(60, client)
+    writer.set("key", b"value")
+    assert reader.get("key") == b"value"
+    assert client.ttls[RedisBackend.KEY_PREFIX + "key"] == 60000
+    assert reader.generations((AUDIOS, CONFIGS)) == (0, 0)
+    writer.invalidate(AUDIOS)
+    # Not started, so the reader reads the shared counters; started workers get the message
+    assert reader.generations((AUDIOS, CONFIGS)) == (1, 0)
+    assert client.published == [(RedisBackend.CHANNEL, f"{AUDIOS}=1")]
+
+
+def test_redis_backend_treats_errors_as_misses():
+    client = FakeRedis()
+    client.get = lambda key: (_ for _ in ()).throw(ConnectionError("down"))
+    backend = RedisBackend(60, client)
+    assert backend.get("key") is None
+    assert backend.misses == 1
+
+
+def test_zero_ttl_disables_the_cache(engine, client, monkeypatch):
+    backend = RedisBackend(0, FakeRedis())
+    monkeypatch.setattr(cache, "response_cache", backend)
+    assert not backend.enabled
+    create_config(client, "a")
+    for _ in range(2):
+        _, statements = count_statements(engine, lambda: client.get("/api/configs/list"))
+        assert statements > 0
+    assert cached_value([CONFIGS], "key", lambda: {"built": True}) == {"built": True}
+    assert backend.client.values == {}
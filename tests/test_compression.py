@@ -0,0 +1,81 @@
+"""
+CompressionMiddleware: negotiation, which responses are compressed, and streamed chunks that can
+be decoded as they arrive.
+"""
+import asyncio
+import zlib
+import brotli
+import pytest
+from compression import CompressionMiddleware, negotiate_encoding
+
+LARGE = b'{"rows": [' + b",".join(b'{"id": %d}' % index for index in range(500)) + b"]}"
+
+
+def run(app, accept_encoding: str = "gzip, br"):
+    """Send one GET through the middleware; returns the response start message and body messages."""
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(CompressionMiddleware(app)(scope, receive, send))
+    return messages[0], messages[1:]
+
+
+def response(body_chunks, media_type: str = "application/json", status: int = 200):
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", media_type.encode())]})
+        for index, chunk in enumerate(body_chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": index < len(body_chunks) - 1})
+    return app
+
+
+def headers(start) -> dict:
+    return {name.decode(): value.decode() for name, value in start["headers"]}
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip, br", "br"),
+    ("gzip;q=1, br;q=0.5", "gzip"),
+    ("br;q=0, *", "gzip"),
+    ("identity", None),
+    ("", None),
+])
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding, ("br", "gzip")) == expected
+
+
+def test_large_json_is_compressed():
+    start, bodies = run(response([LARGE]), "gzip")
+    assert headers(start)["content-encoding"] == "gzip"
+    assert headers(start)["vary"] == "Accept-Encoding"
+    assert int(headers(start)["content-length"]) == len(bodies[0]["body"])
+    assert zlib.decompress(bodies[0]["body"], 31) == LARGE
+
+
+@pytest.mark.parametrize("app", [
+    response([b'{"small": true}']),
+    response([LARGE], media_type="audio/wav"),
+    response([LARGE], status=206),
+])
+def test_small_other_and_partial_responses_pass_through(app):
+    start, bodies = run(app)
+    assert "content-encoding" not in headers(start)
+    assert b"".join(body["body"] for body in bodies) in (LARGE, b'{"small": true}')
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_streamed_chunks_decode_as_they_arrive(encoding):
+    chunks = [b'{"id": %d}\n' % index for index in range(5)]
+    start, bodies = run(response(chunks, media_type="application/x-ndjson"), encoding)
+    assert headers(start)["content-encoding"] == encoding
+    assert "content-length" not in headers(start)
+    decoder = zlib.decompressobj(31) if encoding == "gzip" else brotli.Decompressor()
+    decode = decoder.decompress if encoding == "gzip" else decoder.process
+    # Every chunk is flushed: each message decodes to its chunk without the ones after it
+    for chunk, body in zip(chunks, bodies):
+        assert decode(body["body"]) == chunk
@@ -0,0 +1,67 @@
+"""
+/api/configs/list must load a page with a fixed number of SQL statements, whatever the number of
+configs and audio files on it (no lazy load per config).
+"""
+from typing import Tuple
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from cache import CONFIGS, response_cache
+from models import AudioFile, Config, ConfigAudio
+
+AUDIOS_PER_CONFIG = 3
+# Small enough that the largest size fits on one page
+SIZES = (20, 200)
+
+
+def seed(engine, configs: int) -> None:
+    db = sessionmaker(bind=engine)()
+    try:
+        db.query(ConfigAudio).delete()
+        db.query(Config).delete()
+        db.query(AudioFile).delete()
+        audios = [
+            AudioFile(name=f"audio {index}", type="sample", file_path=f"audio_files/{index}.wav", filename=f"{index}.wav")
+            for index in range(configs * AUDIOS_PER_CONFIG)
+        ]
+        db.add_all(audios)
+        db.flush()
+        for index in range(configs):
+            config = Config(name=f"config {index}", interaction_type="running", bpm=120)
+            db.add(config)
+            db.flush()
+            for audio in audios[index * AUDIOS_PER_CONFIG:(index + 1) * AUDIOS_PER_CONFIG]:
+                db.add(ConfigAudio(config_id=config.id, audio_id=audio.id))
+        db.commit()
+    finally:
+        db.close()
+    # Seeded behind the endpoints' back, drop any cached page
+    response_cache.invalidate(CONFIGS)
+
+
+def count_list_statements(engine, client, **params) -> Tuple[list, int]:
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get("/api/configs/list", params={"limit": max(SIZES), **params})
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200
+    return response.json(), len(statements)
+
+
+@pytest.mark.parametrize("params", [{}, {"fields": "id,name,audios"}, {"fields": "id,name"}])
+def test_list_configs_statement_count_does_not_grow_with_rows(engine, client, params):
+    counts = []
+    for size in SIZES:
+        seed(engine, size)
+        configs, statements = count_list_statements(engine, client, **params)
+        assert len(configs) == size
+        if "audios" in configs[0]:
+            assert all(len(config["audios"]) == AUDIOS_PER_CONFIG for config in configs)
+        counts.append(statements)
+    assert counts[0] == counts[1], f"SQL statements grew with the number of configs: {counts}"
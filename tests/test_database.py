@@ -0,0 +1,38 @@
+"""
+run_encoder: endpoint results are encoded through run_blocking (off the event loop in async mode),
+except ORM objects, which may still load attributes from the session.
+"""
+import pytest
+import database
+from models import Track
+from responses import render_json
+
+
+@pytest.fixture
+def offloaded(monkeypatch):
+    calls = []
+
+    def run_blocking(function, *args, **kwargs):
+        calls.append(args)
+        return function(*args, **kwargs)
+
+    monkeypatch.setattr(database, "run_blocking", run_blocking)
+    return calls
+
+
+@pytest.mark.parametrize("content", [[{"id": 1}], {"id": 1}, []])
+def test_plain_results_are_encoded_through_run_blocking(offloaded, content):
+    assert database.run_encoder(render_json, content) == render_json(content)
+    assert offloaded == [(content,)]
+
+
+@pytest.mark.parametrize("content", [Track(id=1), [Track(id=1)]])
+def test_orm_results_are_encoded_in_place(offloaded, content):
+    database.run_encoder(lambda value: b"{}", content)
+    assert offloaded == []
+
+
+def test_routes_and_cached_endpoints_use_run_encoder(client, offloaded):
+    # /api/tracks/list is cached: its entry and the response are encoded once, through run_blocking
+    assert client.get("/api/tracks/list").json() == []
+    assert offloaded == [([],)]
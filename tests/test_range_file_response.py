@@ -0,0 +1,121 @@
+"""
+RangeFileResponse: byte ranges (RFC 7233) and conditional requests (RFC 7232) over a small file.
+"""
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from responses import RangeFileResponse, parse_range_header
+
+BODY = bytes(range(256)) * 4
+ETAG = '"blob-hash"'
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "audio.bin"
+    path.write_bytes(BODY)
+    app = FastAPI()
+
+    @app.api_route("/file", methods=["GET", "HEAD"])
+    def serve():
+        return RangeFileResponse(path, media_type="audio/wav", headers={"etag": ETAG})
+
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", [(0, 9)]),
+    ("bytes=1000-", [(1000, 1023)]),
+    ("bytes=-24", [(1000, 1023)]),
+    ("bytes=0-2000", [(0, 1023)]),
+    ("bytes=10-19,0-9,15-30", [(0, 30)]),
+    ("bytes=5000-", []),
+    ("bytes=-0", []),
+    ("bytes=9-0", None),
+    ("items=0-9", None),
+    ("bytes=a-b", None),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, len(BODY)) == expected
+
+
+def test_full_body_advertises_ranges(client):
+    response = client.get("/file")
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.content == BODY
+
+
+def test_single_range(client):
+    response = client.get("/file", headers={"range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(BODY)}"
+    assert response.headers["content-length"] == "100"
+    assert response.content == BODY[100:200]
+
+
+def test_suffix_range(client):
+    response = client.get("/file", headers={"range": "bytes=-10"})
+    assert response.status_code == 206
+    assert response.content == BODY[-10:]
+
+
+def test_multiple_ranges_are_sent_as_multipart(client):
+    response = client.get("/file", headers={"range": "bytes=0-9,500-509"})
+    assert response.status_code == 206
+    content_type = response.headers["content-type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("boundary=")[1]
+    assert int(response.headers["content-length"]) == len(response.content)
+    parts = response.content.split(f"--{boundary}".encode())
+    assert parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + BODY[0:10] + b"\r\n")
+    assert f"Content-Range: bytes 500-509/{len(BODY)}".encode() in parts[2]
+    assert parts[2].endswith(b"\r\n\r\n" + BODY[500:510] + b"\r\n")
+
+
+def test_unsatisfiable_range(client):
+    response = client.get("/file", headers={"range": "bytes=5000-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(BODY)}"
+    assert response.content == b""
+
+
+def test_malformed_range_is_ignored(client):
+    response = client.get("/file", headers={"range": "bytes=9-0"})
+    assert response.status_code == 200
+    assert response.content == BODY
+
+
+def test_head_range_has_no_body(client):
+    response = client.head("/file", headers={"range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.headers["content-length"] == "10"
+    assert response.content == b""
+
+
+def test_if_none_match_gets_not_modified(client):
+    response = client.get("/file", headers={"if-none-match": f'"other", W/{ETAG}'})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == ETAG
+    assert "content-length" not in response.headers
+
+
+def test_if_none_match_takes_precedence_over_if_modified_since(client):
+    last_modified = client.get("/file").headers["last-modified"]
+    response = client.get("/file", headers={"if-none-match": '"other"', "if-modified-since": last_modified})
+    assert response.status_code == 200
+
+
+def test_if_modified_since(client):
+    last_modified = client.get("/file").headers["last-modified"]
+    assert client.get("/file", headers={"if-modified-since": last_modified}).status_code == 304
+    assert client.get("/file", headers={"if-modified-since": "Mon, 01 Jan 2001 00:00:00 GMT"}).status_code == 200
+
+
+@pytest.mark.parametrize("if_range, status", [(ETAG, 206), ('"other"', 200), (f"W/{ETAG}", 200)])
+def test_if_range(client, if_range, status):
+    response = client.get("/file", headers={"range": "bytes=0-9", "if-range": if_range})
+    assert response.status_code == status
+    assert response.content == (BODY[:10] if status == 206 else BODY)
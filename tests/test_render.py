@@ -0,0 +1,141 @@
+"""
+render_mix output, what is decoded of each source, and the render cache: eviction, pins and
+their release when a request is cancelled.
+"""
+import asyncio
+import os
+import time
+import wave
+import numpy as np
+import pytest
+import render
+from config import setting
+from render import MixRenderer, render_mix, render_size
+
+SOURCE_RATE = 8000
+
+
+@pytest.fixture(autouse=True)
+def render_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(render, "RENDER_DIR", str(tmp_path / "renders"))
+    os.makedirs(render.RENDER_DIR)
+
+
+def write_wav(path, seconds: float, value: float = 0.5) -> str:
+    with wave.open(str(path), "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(SOURCE_RATE)
+        file.writeframes(np.full(int(seconds * SOURCE_RATE), int(value * 32767), dtype="<i2").tobytes())
+    return str(path)
+
+
+def track(path: str, **overrides) -> dict:
+    return {
+        "path": path, "content": "hash", "loop": False, "decay": False, "source_gain": 1.0, "track_gain": 1.0,
+        "filters": [], "source_automation": [], "track_automation": [], **overrides,
+    }
+
+
+def plan(*tracks, seconds: float = 0.5) -> dict:
+    return {"version": render.RENDER_VERSION, "rate": render.RENDER_RATE, "seconds": seconds, "tracks": list(tracks)}
+
+
+def rendered(mix_plan: dict, tmp_path) -> np.ndarray:
+    path = str(tmp_path / "mix.wav")
+    render_mix(mix_plan, path + ".part", path)
+    assert os.path.getsize(path) == render_size(mix_plan)
+    assert not os.path.exists(path + ".part")
+    with wave.open(path) as file:
+        assert (file.getnchannels(), file.getframerate()) == (render.RENDER_CHANNELS, render.RENDER_RATE)
+        samples = np.frombuffer(file.readframes(file.getnframes()), dtype="<i2")
+    return samples.reshape(-1, render.RENDER_CHANNELS) / 32767
+
+
+def test_one_shot_source_is_followed_by_silence(tmp_path):
+    samples = rendered(plan(track(write_wav(tmp_path / "a.wav", 0.1))), tmp_path)
+    assert len(samples) == int(0.5 * render.RENDER_RATE)
+    assert np.allclose(samples[:4000], 0.5, atol=1e-3)
+    assert not samples[5000:].any()
+
+
+def test_looped_source_plays_for_the_whole_mix(tmp_path):
+    samples = rendered(plan(track(write_wav(tmp_path / "a.wav", 0.1), loop=True)), tmp_path)
+    assert np.allclose(samples, 0.5, atol=1e-3)
+
+
+def test_tracks_are_summed_with_their_gains_and_clipped(tmp_path):
+    path = write_wav(tmp_path / "a.wav", 1)
+    assert np.allclose(rendered(plan(track(path, source_gain=0.5), track(path)), tmp_path), 0.75, atol=1e-3)
+    assert np.allclose(rendered(plan(track(path, track_gain=4)), tmp_path), 1, atol=1e-3)
+
+
+def test_decay_fades_the_track_out(tmp_path):
+    samples = rendered(plan(track(write_wav(tmp_path / "a.wav", 1), decay=True)), tmp_path)
+    assert samples[0, 0] > samples[-1, 0] > 0
+
+
+def test_only_the_audible_part_of_a_source_is_decoded(tmp_path, monkeypatch):
+    decoded = []
+
+    def decode_audio(path, max_seconds=None):
+        decoded.append(max_seconds)
+        return np.zeros((SOURCE_RATE, 1), dtype=np.float32), SOURCE_RATE
+
+    monkeypatch.setattr(render, "decode_audio", decode_audio)
+    rendered(plan(track("a.wav"), track("b.wav", loop=True)), tmp_path)
+    assert decoded == [0.5 + render.RESAMPLE_SLACK_SECONDS, setting.render_max_seconds]
+
+
+def add_mix(key: str, age: float = 3600) -> str:
+    path = render.render_path(key)
+    with open(path, "wb") as file:
+        file.write(b"\x00" * 1024)
+    used = time.time() - age
+    os.utime(path, (used, used))
+    return path
+
+
+def test_eviction_keeps_pinned_and_recently_used_mixes(monkeypatch):
+    monkeypatch.setattr(setting, "render_cache_max_mb", 0)
+    renderer = MixRenderer(0)
+    old, pinned, recent = add_mix("old"), add_mix("pinned"), add_mix("recent", age=1)
+    assert renderer.cached("pinned") == pinned
+    # cached() marks the mix as used: age it again to only test the pin
+    os.utime(pinned, (0, 0))
+    renderer._evict()
+    assert not os.path.exists(old)
+    assert os.path.exists(pinned) and os.path.exists(recent)
+    renderer.release("pinned")
+    renderer._evict()
+    assert not os.path.exists(pinned)
+    assert os.path.exists(recent)
+
+
+def test_eviction_stops_within_the_budget(monkeypatch):
+    monkeypatch.setattr(setting, "render_cache_max_mb", 2048 / (1024 * 1024))
+    paths = [add_mix(key, age) for key, age in (("a", 300), ("b", 200), ("c", 100))]
+    MixRenderer(0)._evict()
+    assert [os.path.exists(path) for path in paths] == [False, True, True]
+
+
+def test_cancelled_render_request_releases_its_pin(monkeypatch):
+    from endpoint import configs
+
+    class Job:
+        async def first_block(self):
+            raise asyncio.CancelledError()
+
+    renderer = MixRenderer(0)
+
+    def submit(key, mix_plan):
+        renderer._pin(key)
+        return Job()
+
+    monkeypatch.setattr(renderer, "submit", submit)
+    monkeypatch.setattr(render, "mix_renderer", renderer)
+    monkeypatch.setattr(configs, "load_render_graph", lambda db, config_id: {})
+    monkeypatch.setattr(render, "build_plan", lambda graph, seconds, event_types: plan(seconds=seconds))
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(configs.render_config(1, duration=1, event=None, db=None))
+    assert renderer._pins == {}
@@ -0,0 +1,57 @@
+"""
+Queued log sinks: a full queue drops and counts records, and daily log files shared by several
+writers (one per worker process) only ever contain whole records.
+"""
+import os
+import threading
+import orjson
+import request_log
+from request_log import DailyLogFile, QueuedWriter
+
+
+class BlockingTarget:
+    """Holds the first write until released, so the queue fills up."""
+
+    def __init__(self):
+        self.texts = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, text: str) -> None:
+        self.writing.set()
+        self.release.wait()
+        self.texts.append(text)
+
+    def flush(self) -> None:
+        pass
+
+
+def test_full_queue_drops_and_counts_records(monkeypatch):
+    monkeypatch.setattr(request_log, "MAX_QUEUED_RECORDS", 5)
+    target = BlockingTarget()
+    writer = QueuedWriter(target, "log-test")
+    writer.write("first\n")
+    assert target.writing.wait(5)
+    for index in range(8):
+        writer.write(f"{index}\n")
+    assert writer.dropped == 3
+    target.release.set()
+    writer.stop()
+    assert "".join(target.texts) == "first\n0\n1\n2\n3\n4\n"
+
+
+def test_writers_of_one_daily_file_keep_records_whole(tmp_path):
+    records = {name: [orjson.dumps({"writer": name, "index": index, "pad": "x" * 300}).decode() + "\n" for index in range(200)]
+               for name in ("a", "b")}
+    files = {name: DailyLogFile(str(tmp_path), 30) for name in records}
+    for index in range(0, 200, 10):
+        for name, log_file in files.items():
+            log_file.write("".join(records[name][index:index + 10]))
+    for log_file in files.values():
+        log_file.close()
+    (path,) = tmp_path.glob("*.log")
+    lines = [orjson.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 400
+    for name in records:
+        assert [line["index"] for line in lines if line["writer"] == name] == list(range(200))
+    assert os.path.getsize(path) == sum(len(text) for texts in records.values() for text in texts)
@@ -0,0 +1,106 @@
+"""
+TempoSnapshot matching and when TempoIndex rebuilds its snapshot.
+"""
+import pytest
+import tempo_index
+from cache import AUDIOS, response_cache
+from tempo_index import TempoIndex, TempoSnapshot
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    # Count the rebuilds instead of querying a database
+    built = []
+
+    def build(db, generation):
+        built.append(generation)
+        return TempoSnapshot([], generation)
+
+    monkeypatch.setattr(TempoIndex, "build", staticmethod(build))
+    return built
+
+
+def test_snapshot_is_reused_until_the_audios_generation_moves(builds):
+    index = TempoIndex()
+    first = index.snapshot(None)
+    assert index.snapshot(None) is first
+    response_cache.invalidate(AUDIOS)
+    assert index.snapshot(None) is not first
+    assert len(builds) == 2
+
+
+def test_snapshot_is_rebuilt_once_older_than_the_max_age(builds, monkeypatch):
+    index = TempoIndex()
+    first = index.snapshot(None)
+    monkeypatch.setattr(tempo_index.time, "monotonic", lambda: first.built_at + tempo_index.MAX_AGE_SECONDS)
+    assert index.snapshot(None) is not first
+    assert len(builds) == 2
+
+
+ROWS = [
+    # id, name, type, genre, key, bpm
+    (1, "slow", "sample", "house", "C", 60),
+    (2, "walk", "sample", "pop", "D", 118),
+    (3, "run", "section", "house", "E", 120),
+    (4, "jog", "sample", "house", "F", 123),
+    (5, "sprint", "sample", "house", "G", 240),
+    (6, "other", "sample", "rock", "A", 180),
+]
+
+
+def matches(snapshot, *args, **kwargs):
+    return [(match["id"], match["relation"], match["distance"]) for match in snapshot.match(*args, **kwargs)]
+
+
+def snapshot() -> TempoSnapshot:
+    return TempoSnapshot(sorted(ROWS, key=lambda row: row[5]), (0,))
+
+
+def test_matches_are_ranked_by_distance_direct_first():
+    assert matches(snapshot(), 120, 3) == [
+        (3, "direct", 0.0), (1, "half", 0.0), (5, "double", 0.0), (2, "direct", 2.0), (4, "direct", 3.0),
+    ]
+
+
+def test_filters_and_limit():
+    assert matches(snapshot(), 120, 3, genre="house", type="sample") == [
+        (1, "half", 0.0), (5, "double", 0.0), (4, "direct", 3.0),
+    ]
+    assert matches(snapshot(), 120, 3, limit=2) == [(3, "direct", 0.0), (1, "half", 0.0)]
+
+
+def test_unknown_filter_values_match_nothing():
+    assert matches(snapshot(), 120, 3, genre="jazz") == []
+    assert matches(snapshot(), 120, 3, type="loop") == []
+
+
+def test_file_matching_several_relations_is_returned_once():
+    # With a very wide tolerance 120 bpm is both a direct and a double tempo match for 100
+    assert [match[0] for match in matches(snapshot(), 100, 60)].count(3) == 1
+
+
+def test_match_rows_carry_the_match_fields():
+    match = snapshot().match(120, 0)[0]
+    assert match == {
+        "id": 3, "name": "run", "type": "section", "genre": "house", "key": "E", "bpm": 120,
+        "relation": "direct", "distance": 0.0,
+    }
+
+
+def test_match_endpoint_filters_by_genre(client, engine):
+    from sqlalchemy.orm import sessionmaker
+    from models import AudioFile, GenreEnum
+
+    db = sessionmaker(bind=engine)()
+    db.add_all([
+        AudioFile(name="jazz", type="sample", genre=GenreEnum.Jazz, bpm=120, file_path="a", filename="a"),
+        AudioFile(name="lofi", type="sample", genre=GenreEnum.Lofi, bpm=61, file_path="b", filename="b"),
+    ])
+    db.commit()
+    db.close()
+    response_cache.invalidate(AUDIOS)
+    response = client.get("/api/audiofiles/match", params={"bpm": 120, "tolerance": 2})
+    assert [(match["name"], match["relation"]) for match in response.json()] == [("jazz", "direct"), ("lofi", "half")]
+    assert "server-timing" in response.headers
+    response = client.get("/api/audiofiles/match", params={"bpm": 120, "tolerance": 2, "genre": "Lofi"})
+    assert [match["name"] for match in response.json()] == ["lofi"]